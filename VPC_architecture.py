@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import boto3
+from botocore.config import Config
 import sys
 import pathlib
 import argparse
@@ -8,6 +9,8 @@ import os
 from typing import List
 import time
 import socket
+import gzip
+import re
 
 # -----------------------------
 # PARAMÈTRES & ENV
@@ -45,6 +48,12 @@ INSTANCE_TYPE_DB = "t2.micro"
 UBUNTU_AMI = _cfg.get("UBUNTU_AMI", "ami-0ecb62995f68bb549")  
 NUM_DB_WORKERS = 2
 
+# EC2 rejects user data larger than 16 KB (before base64)
+USER_DATA_LIMIT = 16 * 1024
+# Scripts still over the limit once gzipped are fetched from S3 at boot (bucket created on demand)
+USER_DATA_BUCKET = _cfg.get("USER_DATA_BUCKET")
+USER_DATA_URL_TTL = 6 * 3600
+
 session = boto3.Session(
     aws_access_key_id=AWS_ACCESS_KEY_ID,
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
@@ -54,6 +63,8 @@ session = boto3.Session(
 
 ec2 = session.resource("ec2", region_name=AWS_REGION)
 ec2_client = session.client("ec2", region_name=AWS_REGION)
+# SigV4: buckets created since 2020 reject SigV2 presigned URLs
+s3_client = session.client("s3", region_name=AWS_REGION, config=Config(signature_version="s3v4"))
 
 
 # ----------------------------------------
@@ -64,6 +75,53 @@ def load_file(path: str) -> str:
     with open(path, "r") as f:
         return f.read()
 
+_INCLUDE_RE = re.compile(r"^#@include (\S+)$", re.M)
+
+BOOTSTRAP_USER_DATA = """#!/bin/bash
+set -euo pipefail
+curl -fsS --retry 30 --retry-delay 5 --retry-all-errors -o /root/user-data.sh '{url}'
+exec bash /root/user-data.sh
+"""
+
+def user_data_bucket_name() -> str:
+    if USER_DATA_BUCKET:
+        return USER_DATA_BUCKET
+    account = session.client("sts").get_caller_identity()["Account"]
+    return f"log8415e-user-data-{account}-{AWS_REGION}"
+
+def host_user_data(path: str, script: str) -> str:
+    """Upload `script` to S3; returns a small user-data script that downloads and runs it."""
+    bucket = user_data_bucket_name()
+    try:
+        s3_client.head_bucket(Bucket=bucket)
+    except s3_client.exceptions.ClientError:
+        location = {} if AWS_REGION == "us-east-1" else {"CreateBucketConfiguration": {"LocationConstraint": AWS_REGION}}
+        s3_client.create_bucket(Bucket=bucket, **location)
+    key = f"user-data/{os.path.basename(path)}"
+    s3_client.put_object(Bucket=bucket, Key=key, Body=script.encode("utf-8"))
+    url = s3_client.generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=USER_DATA_URL_TTL,
+    )
+    print(f"[INFO] {path} is over the user-data limit, served from s3://{bucket}/{key}")
+    return BOOTSTRAP_USER_DATA.format(url=url)
+
+def load_user_data(path: str):
+    """Read a user-data script, gzipped if it is over the EC2 limit (cloud-init inflates it),
+    or hosted on S3 if even that is too big.
+
+    `#@include <file>` lines are replaced by that file (relative to the script),
+    which is how code shared between instances is shipped.
+    """
+    base = os.path.dirname(path)
+    script = _INCLUDE_RE.sub(lambda m: load_file(os.path.join(base, m.group(1))).rstrip("\n"), load_file(path))
+    if len(script.encode("utf-8")) <= USER_DATA_LIMIT:
+        return script
+    data = gzip.compress(script.encode("utf-8"))
+    if len(data) > USER_DATA_LIMIT:
+        # Private instances reach S3 through the NAT gateway
+        return host_user_data(path, script)
+    return data
+
 def save_ids(data: dict) -> None:
     """Save network IDs to .env file."""
     env_path = pathlib.Path(ENV_FILE)
@@ -330,11 +388,11 @@ def launch_instances(
     sg_db,
 ):
 
-    gatekeeper_user_data = load_file("user_data/gatekeeper_setup.sh")
-    proxy_user_data = load_file("user_data/proxy_setup.sh")
-    db_manager_data = load_file("user_data/db_manager_setup.sh")
-    db_worker_ud = load_file("user_data/db_worker_setup.sh")
-    bench_ud = load_file("user_data/sysbench_setup.sh")
+    gatekeeper_user_data = load_user_data("user_data/gatekeeper_setup.sh")
+    proxy_user_data = load_user_data("user_data/proxy_setup.sh")
+    db_manager_data = load_user_data("user_data/db_manager_setup.sh")
+    db_worker_ud = load_user_data("user_data/db_worker_setup.sh")
+    bench_ud = load_user_data("user_data/sysbench_setup.sh")
 
     print("Launching Gatekeeper EC2")
     gatekeeper = ec2.create_instances(
@@ -626,6 +684,19 @@ def cmd_destroy(args):
     vpc.delete()
     print("VPC deleted successfully.")
 
+    # ================================
+    # 8. DELETE USER-DATA BUCKET
+    # ================================
+    bucket = user_data_bucket_name()
+    try:
+        s3_client.head_bucket(Bucket=bucket)
+    except s3_client.exceptions.ClientError:
+        return 0
+    print(f"Deleting user-data bucket {bucket}")
+    for obj in s3_client.list_objects_v2(Bucket=bucket).get("Contents", []):
+        s3_client.delete_object(Bucket=bucket, Key=obj["Key"])
+    s3_client.delete_bucket(Bucket=bucket)
+
     return 0
 
 # ============================================================
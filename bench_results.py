@@ -0,0 +1,278 @@
+"""Benchmark result files: one schema for benchmark.py and sysbench runs, and a run-to-run comparison.
+
+    python bench_results.py sysbench /var/log/sysbench_results.txt [-o results/]
+    python bench_results.py compare results/base.json results/new.json [--alpha 0.01] [--threshold 0.05]
+
+A run is a JSON document:
+
+    {"schema": 1, "tool": "benchmark" | "sysbench", "started_at": ISO-8601,
+     "config": {...}, "results": [result, ...]}
+
+and each result describes one series of requests:
+
+    {"name": "p2c/read", "strategy": "p2c", "operation": "read",
+     "requests": 1000, "ops": 1000, "errors": 0, "elapsed_s": 4.2, "throughput": 238.1,
+     "latency_ms": {"p50": .., "p90": .., "p99": .., "p99.9": .., "mean": .., "max": ..},
+     "targets": {"10.0.3.11": 510, ...},
+     "histogram_us": {"<highest us of bucket>": count, ...}}
+
+throughput is ops (statements) per second; requests and ops differ for batched writes.
+Keys that a tool cannot provide are left out (sysbench only reports one percentile
+and no histogram). A CSV with one row per result is written next to the JSON.
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sys
+from datetime import datetime, timezone
+
+SCHEMA = 1
+CSV_LATENCY = ("p50", "p90", "p95", "p99", "p99.9", "mean", "max")
+
+# compare: a result regresses when its latency is worse with p < ALPHA (one-sided
+# Mann-Whitney U on the histograms) and the median or p99 grew by more than THRESHOLD,
+# or when its throughput fell by more than THRESHOLD
+ALPHA = 0.01
+THRESHOLD = 0.05
+
+# -----------------------------
+# Writing runs
+# -----------------------------
+
+def new_run(tool: str, config: dict) -> dict:
+    return {
+        "schema": SCHEMA,
+        "tool": tool,
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": config,
+        "results": [],
+    }
+
+
+def run_basename(run: dict) -> str:
+    stamp = run["started_at"].replace(":", "").replace("-", "").replace("+0000", "Z")
+    return f"{run['tool']}-{stamp}"
+
+
+def write_csv(run: dict, path: str):
+    with open(path, "w", newline="", encoding="utf-8") as fh:
+        w = csv.writer(fh)
+        w.writerow(["started_at", "tool", "name", "strategy", "operation", "requests", "errors",
+                    "elapsed_s", "throughput", *(f"{k}_ms" for k in CSV_LATENCY), "targets"])
+        for r in run["results"]:
+            lat = r.get("latency_ms", {})
+            targets = ";".join(f"{h}:{n}" for h, n in r.get("targets", {}).items())
+            w.writerow([run["started_at"], run["tool"], r["name"], r.get("strategy", ""), r.get("operation", ""),
+                        r.get("requests", ""), r.get("errors", ""), r.get("elapsed_s", ""), r.get("throughput", ""),
+                        *(lat.get(k, "") for k in CSV_LATENCY), targets])
+
+
+def write_run(run: dict, out_dir: str) -> str:
+    """Write <out_dir>/<tool>-<timestamp>.json and .csv; returns the JSON path."""
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, run_basename(run))
+    with open(base + ".json", "w", encoding="utf-8") as fh:
+        json.dump(run, fh, indent=2)
+    write_csv(run, base + ".csv")
+    return base + ".json"
+
+
+def load_run(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as fh:
+        run = json.load(fh)
+    if run.get("schema") != SCHEMA:
+        raise ValueError(f"{path}: unsupported schema {run.get('schema')!r}")
+    return run
+
+# -----------------------------
+# sysbench text output
+# -----------------------------
+
+_RUN_RE = re.compile(r"^==== SYSBENCH RESULTS (\S+) ====", re.M)
+_SECTION_RE = re.compile(r"^---- RUN (\S+) \((?:worker )?(\S+)\) ----", re.M)
+_STAT_RE = re.compile(r"^\s*([a-z0-9 ]+?):\s+([\d.]+)s?(?:\s+\(([\d.]+) per sec\.\))?", re.M | re.I)
+
+
+def _section_stats(text: str) -> dict:
+    stats, group = {}, ""
+    for line in text.splitlines():
+        if line and not line[0].isspace() and line.rstrip().endswith(":"):
+            group = line.strip().rstrip(":").lower()
+            continue
+        m = _STAT_RE.match(line)
+        if m:
+            key = m.group(1).strip().lower()
+            stats[(group, key)] = float(m.group(2))
+            if m.group(3) is not None:
+                stats[(group, key + " per sec")] = float(m.group(3))
+    return stats
+
+
+def parse_sysbench(text: str) -> dict:
+    """The last run in a sysbench_setup.sh log (runs are appended) as a run document."""
+    starts = list(_RUN_RE.finditer(text))
+    started_at = None
+    if starts:
+        started_at = starts[-1].group(1)
+        text = text[starts[-1].end():]
+
+    threads = re.search(r"^Number of threads:\s*(\d+)", text, re.M)
+    run = new_run("sysbench", {"threads": int(threads.group(1)) if threads else None})
+    if started_at:
+        run["started_at"] = started_at
+
+    sections = list(_SECTION_RE.finditer(text))
+    for i, m in enumerate(sections):
+        end = sections[i + 1].start() if i + 1 < len(sections) else len(text)
+        body = text[m.end():end].split("\n---- ", 1)[0]
+        test, host = m.group(1), m.group(2)
+        st = _section_stats(body)
+        events = st.get(("general statistics", "total number of events"), 0.0)
+        elapsed = st.get(("general statistics", "total time"), 0.0)
+        latency = {}
+        for (group, key), v in st.items():
+            if group != "latency (ms)":
+                continue
+            if key == "avg":
+                latency["mean"] = v
+            elif key in ("min", "max"):
+                latency[key] = v
+            else:
+                pct = re.match(r"(\d+(?:\.\d+)?)th percentile", key)
+                if pct:
+                    latency[f"p{float(pct.group(1)):g}"] = v
+        run["results"].append({
+            "name": f"{test}@{host}",
+            "strategy": "direct",
+            "operation": test,
+            "requests": int(events),
+            "errors": int(st.get(("sql statistics", "ignored errors"), 0)),
+            "elapsed_s": elapsed,
+            "throughput": st.get(("sql statistics", "transactions per sec"), events / elapsed if elapsed else 0.0),
+            "queries_per_sec": st.get(("sql statistics", "queries per sec")),
+            "latency_ms": latency,
+            "targets": {host: int(events)},
+        })
+    return run
+
+# -----------------------------
+# Comparing runs
+# -----------------------------
+
+def mann_whitney_greater(a: dict, b: dict) -> float:
+    """One-sided p-value that latencies in histogram b tend to be larger than in a.
+
+    Histograms map a bucket's value to its count; samples in one bucket are ties,
+    handled with average ranks and the usual variance correction.
+    """
+    a = {int(k): n for k, n in a.items()}
+    b = {int(k): n for k, n in b.items()}
+    na, nb = sum(a.values()), sum(b.values())
+    n = na + nb
+    if not na or not nb or n < 3:
+        return 1.0
+    rank, rank_b, ties = 0, 0.0, 0.0
+    for v in sorted(set(a) | set(b)):
+        t = a.get(v, 0) + b.get(v, 0)
+        rank_b += b.get(v, 0) * (rank + (t + 1) / 2.0)
+        ties += t ** 3 - t
+        rank += t
+    u = rank_b - nb * (nb + 1) / 2.0
+    var = na * nb / 12.0 * ((n + 1) - ties / (n * (n - 1)))
+    if var <= 0:
+        return 1.0
+    z = (u - na * nb / 2.0) / math.sqrt(var)
+    return 0.5 * math.erfc(z / math.sqrt(2.0))
+
+
+def _change(old, new):
+    if old is None or new is None or not old:
+        return None
+    return (new - old) / old
+
+
+def compare_results(base: dict, new: dict, alpha: float = ALPHA, threshold: float = THRESHOLD) -> dict:
+    lat_b, lat_n = base.get("latency_ms", {}), new.get("latency_ms", {})
+    row = {
+        "name": new["name"],
+        "throughput": (base.get("throughput"), new.get("throughput"), _change(base.get("throughput"), new.get("throughput"))),
+        "latency": {k: (lat_b.get(k), lat_n.get(k), _change(lat_b.get(k), lat_n.get(k)))
+                    for k in ("p50", "p95", "p99") if k in lat_b and k in lat_n},
+        "p_value": None,
+        "reasons": [],
+    }
+    tp = row["throughput"][2]
+    if tp is not None and tp < -threshold:
+        row["reasons"].append(f"throughput {tp:+.1%}")
+    if "histogram_us" in base and "histogram_us" in new:
+        p = row["p_value"] = mann_whitney_greater(base["histogram_us"], new["histogram_us"])
+        worse = [f"{k} {c:+.1%}" for k, (_, _, c) in row["latency"].items()
+                 if k in ("p50", "p99") and c is not None and c > threshold]
+        if p < alpha and worse:
+            row["reasons"].append(f"latency {', '.join(worse)} (p={p:.2g})")
+    else:
+        # No samples to test (sysbench): fall back to the threshold on the percentile it reports
+        for k, (_, _, c) in row["latency"].items():
+            if c is not None and c > threshold:
+                row["reasons"].append(f"{k} {c:+.1%} (no test)")
+    return row
+
+
+def compare(base: dict, new: dict, alpha: float = ALPHA, threshold: float = THRESHOLD) -> list:
+    """One row per result present in both runs, matched by name."""
+    old = {r["name"]: r for r in base["results"]}
+    return [compare_results(old[r["name"]], r, alpha, threshold) for r in new["results"] if r["name"] in old]
+
+
+def _fmt(v) -> str:
+    return "-" if v is None else f"{v:.2f}"
+
+
+def print_comparison(rows: list):
+    # Tail: p99, or p95 for sysbench
+    print(f"{'result':<26}{'ops/s':>20}{'change':>9}{'p50 ms':>18}{'tail ms':>18}{'p':>9}  verdict")
+    none = (None, None, None)
+    for r in rows:
+        tb, tn, tc = r["throughput"]
+        lat = r["latency"]
+        cols = [f"{_fmt(b)} > {_fmt(n)}" for b, n, _ in (lat.get("p50", none), lat.get("p99", lat.get("p95", none)))]
+        p = "-" if r["p_value"] is None else f"{r['p_value']:.2g}"
+        verdict = "REGRESSION: " + "; ".join(r["reasons"]) if r["reasons"] else "ok"
+        change = "-" if tc is None else f"{tc:+.1%}"
+        print(f"{r['name']:<26}{_fmt(tb) + ' > ' + _fmt(tn):>20}{change:>9}{cols[0]:>18}{cols[1]:>18}{p:>9}  {verdict}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("sysbench", help="convert a sysbench_setup.sh log to a result file")
+    p.add_argument("log")
+    p.add_argument("-o", "--out-dir", default="results")
+
+    p = sub.add_parser("compare", help="flag regressions of NEW against BASE (exit status 1 if any)")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--alpha", type=float, default=ALPHA)
+    p.add_argument("--threshold", type=float, default=THRESHOLD)
+
+    args = parser.parse_args(argv)
+    if args.command == "sysbench":
+        with open(args.log, "r", encoding="utf-8") as fh:
+            run = parse_sysbench(fh.read())
+        print(write_run(run, args.out_dir))
+        return 0
+
+    rows = compare(load_run(args.base), load_run(args.new), args.alpha, args.threshold)
+    if not rows:
+        print("No results in common")
+        return 2
+    print_comparison(rows)
+    return 1 if any(r["reasons"] for r in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,26 @@
 import time
 import requests
 from collections import Counter
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import argparse
+import bench_results
+import gzip
+import itertools
+import json
+import math
 import os
+import threading
+import workload
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # -----------------------------
 # PARAMÈTRES & ENV
@@ -31,50 +49,215 @@ AWS_ACCESS_KEY_ID = _cfg.get("aws_access_key_id")
 AWS_SECRET_ACCESS_KEY = _cfg.get("aws_secret_access_key")
 AWS_SESSION_TOKEN = _cfg.get("aws_session_token")
 
-STRATEGIES = ["direct", "random", "latency"]
+STRATEGIES = ["direct", "random", "latency", "lag_aware", "p2c", "hedged"]
+# Any of these can be picked with --strategies
+KNOWN_STRATEGIES = STRATEGIES + ["round_robin"]
 N_WRITES = 1000
 N_READS = 1000
 TIMEOUT = 10
+# > 0: send the writes through /query/batch, BATCH_SIZE statements per request
+BATCH_SIZE = int(_cfg.get("BATCH_SIZE", "0"))
+
+# Load generator: CONCURRENCY requests in flight, each worker on its own keep-alive session.
+# TARGET_RATE > 0 (requests/s) makes it open loop: request i is due at start + i / TARGET_RATE
+# whatever happened to the ones before, and its latency counts from that due time, so a
+# stall shows up in the percentiles instead of silently slowing the load (coordinated omission)
+CONCURRENCY = int(_cfg.get("CONCURRENCY", "1"))
+TARGET_RATE = float(_cfg.get("TARGET_RATE", "0"))
+PERCENTILES = (50, 90, 99, 99.9)
+
+# Every run is also written as JSON + CSV here (see bench_results.py; "" disables)
+RESULTS_DIR = _cfg.get("RESULTS_DIR", "results")
+# Set by local_topology.py: what it started (engines, backends), recorded in the run's config
+BENCH_TOPOLOGY = json.loads(_cfg.get("BENCH_TOPOLOGY") or "null")
+
+# Response formats compared on a wide result, FORMAT_ROUNDS rounds each after the strategy
+# runs. Off by default so it adds no load to a measured run; e.g. FORMAT_ROUNDS=20 to opt in
+COLUMNAR_JSON = "application/vnd.proxy.columnar+json"
+MSGPACK = "application/x-msgpack"
+FORMAT_ROUNDS = int(_cfg.get("FORMAT_ROUNDS", "0"))
+FORMAT_QUERY = "SELECT * FROM sakila.film LIMIT 1000"
 
 # -----------------------------
 # GET GATEKEEPER IP
 # -----------------------------
 
-def get_gatekeeper_ip():
+def ec2_client():
+    import boto3  # only needed when the gatekeeper is looked up on AWS
+
     session = boto3.Session(
         aws_access_key_id=AWS_ACCESS_KEY_ID or None,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY or None,
         aws_session_token=AWS_SESSION_TOKEN or None,
         region_name=AWS_REGION,
     )
-    ec2 = session.client("ec2")
+    return session.client("ec2")
 
-    r = ec2.describe_instances(
+def running_instances(name: str = "*"):
+    r = ec2_client().describe_instances(
         Filters=[
-            {"Name": "tag:Name", "Values": ["Gatekeeper-EC2"]},
+            {"Name": "tag:Name", "Values": [name]},
             {"Name": "instance-state-name", "Values": ["running"]},
         ]
     )
     for res in r["Reservations"]:
-        for inst in res["Instances"]:
-            ip = inst.get("PublicIpAddress")
-            if ip:
-                return ip
+        yield from res["Instances"]
+
+def get_gatekeeper_ip():
+    for inst in running_instances("Gatekeeper-EC2"):
+        ip = inst.get("PublicIpAddress")
+        if ip:
+            return ip
     raise RuntimeError("Gatekeeper instance not found or has no public IP")
 
-GATEKEEPER_IP = get_gatekeeper_ip()
-GK_URL = f"http://{GATEKEEPER_IP}:8080/query"
+def get_instance_types() -> dict:
+    """{Name tag: instance type} of the running instances, for the result file."""
+    types = {}
+    for inst in running_instances():
+        name = next((t["Value"] for t in inst.get("Tags", []) if t["Key"] == "Name"), inst["InstanceId"])
+        types[name] = inst["InstanceType"]
+    return types
+
+# Set by resolve_target(): --url / GATEKEEPER_URL, else the Gatekeeper-EC2 instance on port 8080
+GK_URL = None
+GK_BATCH_URL = None
+
+def resolve_target(url: str | None = None) -> str:
+    """Point the benchmark at the gatekeeper; returns where it was found."""
+    global GK_URL, GK_BATCH_URL
+    if url:
+        found = "given"
+    else:
+        url = f"http://{get_gatekeeper_ip()}:8080"
+        found = "discovered on AWS"
+    base = url.rstrip("/")
+    if base.endswith("/query"):
+        base = base[:-len("/query")]
+    GK_URL = f"{base}/query"
+    GK_BATCH_URL = f"{GK_URL}/batch"
+    return found
+
+# -----------------------------
+# Latency histogram
+# -----------------------------
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in microseconds.
+
+    Exact below 256 us, then 128 linear sub-buckets per power of two (< 1% error),
+    so recording is a few integer ops and workers' histograms merge by adding counts.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.total = 0
+        self.sum_us = 0
+        self.max_us = 0
+
+    @staticmethod
+    def _index(us: int) -> int:
+        e = us.bit_length() - 8
+        if e <= 0:
+            return us
+        return 256 + (e - 1) * 128 + (us >> e) - 128
+
+    @staticmethod
+    def _highest(index: int) -> int:
+        """Largest value recorded into bucket `index`."""
+        if index < 256:
+            return index
+        e, m = divmod(index - 256, 128)
+        return ((m + 129) << (e + 1)) - 1
+
+    def record(self, seconds: float):
+        us = max(int(seconds * 1e6), 0)
+        self.counts[self._index(us)] += 1
+        self.total += 1
+        self.sum_us += us
+        self.max_us = max(self.max_us, us)
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.sum_us += other.sum_us
+        self.max_us = max(self.max_us, other.max_us)
+
+    def percentile(self, p: float) -> float:
+        """Latency in ms under which p% of the requests completed."""
+        if not self.total:
+            return 0.0
+        rank, seen = max(math.ceil(p / 100.0 * self.total), 1), 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest(index), self.max_us) / 1000.0
+        return self.max_us / 1000.0
+
+    def mean(self) -> float:
+        return self.sum_us / self.total / 1000.0 if self.total else 0.0
+
+    def to_dict(self) -> dict:
+        """{highest us of bucket: count}, the result file's histogram_us."""
+        return {str(self._highest(i)): n for i, n in sorted(self.counts.items())}
 
 # -----------------------------
 # Call GATEKEEPER
 # -----------------------------
 
-def call_gatekeeper(sql: str, strategy: str | None = None) -> dict:
+_local = threading.local()
+
+def session() -> requests.Session:
+    """This thread's keep-alive session to the gatekeeper."""
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = _local.session = requests.Session()
+    return s
+
+def decode_body(body: bytes, content_type: str, coding: str | None) -> dict:
+    if coding == "gzip":
+        body = gzip.decompress(body)
+    elif coding == "zstd":
+        body = zstandard.ZstdDecompressor().decompress(body)
+    if MSGPACK in content_type:
+        return msgpack.unpackb(body)
+    return json.loads(body)
+
+def post_gatekeeper(sql: str, strategy: str | None = None, params: list | None = None,
+                    fmt: str | None = None, encoding: str | None = None):
+    """Returns (response, body exactly as it came over the wire)."""
     payload = {"query": sql}
+    if params is not None:
+        payload["params"] = params
+    if strategy:
+        payload["strategy"] = strategy
+    headers = {}
+    if fmt:
+        headers["Accept"] = fmt
+    if encoding:
+        headers["Accept-Encoding"] = encoding
+
+    r = session().post(GK_URL, json=payload, headers=headers, timeout=TIMEOUT, stream=True)
+    try:
+        body = r.raw.read(decode_content=False)
+    finally:
+        # Body fully read: the connection goes back to the session's pool
+        r.close()
+    r.raise_for_status()
+    return r, body
+
+def call_gatekeeper(sql: str, strategy: str | None = None, params: list | None = None,
+                    fmt: str | None = None, encoding: str | None = None) -> dict:
+    """fmt: Accept media type (JSON row objects by default, COLUMNAR_JSON or MSGPACK);
+    encoding: Accept-Encoding ("gzip", "zstd"; none by default)."""
+    r, body = post_gatekeeper(sql, strategy, params, fmt, encoding)
+    return decode_body(body, r.headers.get("Content-Type", ""), r.headers.get("Content-Encoding"))
+
+def call_gatekeeper_batch(sqls: list, strategy: str | None = None, transaction: bool = False) -> dict:
+    payload = {"queries": sqls, "transaction": transaction}
     if strategy:
         payload["strategy"] = strategy
 
-    r = requests.post(GK_URL, json=payload, timeout=TIMEOUT)
+    r = session().post(GK_BATCH_URL, json=payload, timeout=TIMEOUT * 6)
     r.raise_for_status()
     return r.json()
 
@@ -82,32 +265,139 @@ def call_gatekeeper(sql: str, strategy: str | None = None) -> dict:
 # run read and write benchmarks 
 # -----------------------------
 
+class Series:
+    """What happened to the requests of one operation type in a load run."""
+
+    def __init__(self):
+        self.targets = Counter()
+        self.hist = LatencyHistogram()
+        self.errors = 0
+
+    def merge(self, other: "Series"):
+        self.targets.update(other.targets)
+        self.hist.merge(other.hist)
+        self.errors += other.errors
+
+
+def run_load(n: int, op):
+    """Send requests op(0) .. op(n - 1) from CONCURRENCY workers, open loop if TARGET_RATE is set.
+
+    op(i) returns (operation, send): send() makes the request and returns its target
+    hosts. Returns (elapsed s, {operation: Series}).
+    """
+    due = itertools.count()  # next() on it is atomic: workers share it without a lock
+    start = time.perf_counter()
+
+    def worker():
+        out = {}
+        while (i := next(due)) < n:
+            operation, send = op(i)
+            s = out.get(operation) or out.setdefault(operation, Series())
+            t0 = time.perf_counter()
+            if TARGET_RATE > 0:
+                scheduled = start + i / TARGET_RATE
+                if scheduled > t0:
+                    time.sleep(scheduled - t0)
+                t0 = scheduled
+            try:
+                hosts = send()
+            except Exception:
+                # Any failure (HTTP, a malformed reply, a bug in op) is one error sample:
+                # a worker that died here would silently drop the rest of its requests
+                s.errors += 1
+                continue
+            s.hist.record(time.perf_counter() - t0)
+            s.targets.update(hosts)
+        return out
+
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        parts = [f.result() for f in [pool.submit(worker) for _ in range(CONCURRENCY)]]
+    elapsed = time.perf_counter() - start
+
+    series = {}
+    for part in parts:
+        for operation, s in part.items():
+            series.setdefault(operation, Series()).merge(s)
+    return elapsed, series
+
+
 def run_writes(strategy: str):
-    targets = Counter()
-    t0 = time.time()
+    last_names = [f"BENCH_{strategy}_{i}" for i in range(1, N_WRITES + 1)]
+    if BATCH_SIZE > 0:
+        # Batches take plain statements; one request (and latency sample) per batch
+        sqls = [
+            f"INSERT INTO sakila.actor (first_name, last_name) VALUES ('Bench', '{last_name}')"
+            for last_name in last_names
+        ]
 
-    for i in range(1, N_WRITES + 1):
-        last_name = f"BENCH_{strategy}_{i}"
-        sql = f"INSERT INTO sakila.actor (first_name, last_name) VALUES ('Bench', '{last_name}')"
-        resp = call_gatekeeper(sql, strategy=strategy)
-        targets[resp.get("target_host", "unknown")] += 1
+        def send_batch(i):
+            resp = call_gatekeeper_batch(sqls[i * BATCH_SIZE:(i + 1) * BATCH_SIZE], strategy=strategy)
+            return [item.get("target_host", "unknown") for item in resp.get("results", [])]
 
-    elapsed = time.time() - t0
-    return elapsed, targets
+        return run_load(math.ceil(N_WRITES / BATCH_SIZE), lambda i: ("write", partial(send_batch, i)))
+
+    sql = "INSERT INTO sakila.actor (first_name, last_name) VALUES (%s, %s)"
+
+    def send(i):
+        return [call_gatekeeper(sql, strategy=strategy, params=["Bench", last_names[i]]).get("target_host", "unknown")]
+
+    return run_load(N_WRITES, lambda i: ("write", partial(send, i)))
 
 
 def run_reads(strategy: str):
-    targets = Counter()
-    t0 = time.time()
+    sql = "SELECT actor_id, first_name, last_name FROM sakila.actor WHERE last_name = %s"
+
+    def send(i):
+        resp = call_gatekeeper(sql, strategy=strategy, params=[f"BENCH_{strategy}_{i + 1}"])
+        return [resp.get("target_host", "unknown")]
+
+    return run_load(N_READS, lambda i: ("read", partial(send, i)))
+
+
+def run_workload(strategy: str, wl: workload.Workload):
+    """wl.requests requests drawn from the workload's templates; one Series per template."""
+
+    def send(sql, params):
+        return [call_gatekeeper(sql, strategy=strategy, params=params).get("target_host", "unknown")]
+
+    def op(i):
+        t = wl.pick()
+        return t.name, partial(send, *t.render())
 
-    for i in range(1, N_READS + 1):
-        last_name = f"BENCH_{strategy}_{i}"
-        sql = f"SELECT actor_id, first_name, last_name FROM sakila.actor WHERE last_name = '{last_name}'"
-        resp = call_gatekeeper(sql, strategy=strategy)
-        targets[resp.get("target_host", "unknown")] += 1
+    return run_load(wl.requests, op)
 
-    elapsed = time.time() - t0
-    return elapsed, targets
+
+def run_formats(strategy: str = "round_robin"):
+    """Per format and compression: bytes on the wire, round trip, proxy encode and client decode time."""
+    formats = [("rows/json", None), ("columnar/json", COLUMNAR_JSON)]
+    if msgpack is not None:
+        formats.append(("columnar/msgpack", MSGPACK))
+    encodings = [None, "gzip"] + (["zstd"] if zstandard is not None else [])
+
+    rows = []
+    for name, fmt in formats:
+        for encoding in encodings:
+            size = rtt = encode = decode = 0.0
+            for _ in range(FORMAT_ROUNDS):
+                t0 = time.perf_counter()
+                # Same read every round: served from the proxy's result cache, so MySQL drops out
+                r, body = post_gatekeeper(FORMAT_QUERY, strategy, fmt=fmt, encoding=encoding)
+                rtt += time.perf_counter() - t0
+                t0 = time.perf_counter()
+                decode_body(body, r.headers.get("Content-Type", ""), r.headers.get("Content-Encoding"))
+                decode += time.perf_counter() - t0
+                size += len(body)
+                timing = r.headers.get("Server-Timing", "")
+                encode += float(timing.partition("dur=")[2] or 0.0)
+            n = FORMAT_ROUNDS
+            rows.append((f"{name}+{encoding or 'identity'}", size / n, rtt / n * 1000.0, encode / n, decode / n * 1000.0))
+
+    base = rows[0][1] or 1.0
+    print(f"{'format':<28}{'bytes':>10}{'vs rows':>9}{'rtt ms':>9}{'encode ms':>11}{'decode ms':>11}")
+    for label, size, rtt, encode, decode in rows:
+        print(f"{label:<28}{size:>10.0f}{size / base:>8.0%} {rtt:>9.2f}{encode:>11.3f}{decode:>11.3f}")
+    return [{"format": label, "bytes": round(size), "rtt_ms": round(rtt, 3), "encode_ms": round(encode, 3),
+             "decode_ms": round(decode, 3)} for label, size, rtt, encode, decode in rows]
 
 
 def print_counter(title: str, c: Counter):
@@ -118,27 +408,152 @@ def print_counter(title: str, c: Counter):
         print(f"  - {k}: {v} ({pct:.1f}%)")
 
 
-def main():
-    print(f"Gatekeeper discovered: {GATEKEEPER_IP}")
-    print(f"Benchmark endpoint: {GK_URL}")
-
-    for strat in STRATEGIES:
+def result_entry(strategy: str, operation: str, ops: int, elapsed: float, s: Series) -> dict:
+    """One series in bench_results' schema; latencies are per request (per batch for batched writes)."""
+    hist, errors = s.hist, s.errors
+    latency = {f"p{p:g}": hist.percentile(p) for p in PERCENTILES}
+    latency.update(mean=round(hist.mean(), 3), max=hist.max_us / 1000.0)
+    return {
+        "name": f"{strategy}/{operation}",
+        "strategy": strategy,
+        "operation": operation,
+        "requests": hist.total + errors,
+        "ops": ops,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput": round(ops / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": latency,
+        "targets": dict(s.targets.most_common()),
+        "histogram_us": hist.to_dict(),
+    }
+
+
+def run_config(wl: workload.Workload | None, strategies: list, on_aws: bool) -> dict:
+    instance_types = {}
+    if on_aws:
+        try:
+            instance_types = get_instance_types()
+        except Exception as e:  # the run itself does not need it
+            print(f"Instance types unavailable: {e}")
+    return {
+        "url": GK_URL,
+        "strategies": strategies,
+        "n_writes": N_WRITES,
+        "n_reads": N_READS,
+        "batch_size": BATCH_SIZE,
+        "concurrency": CONCURRENCY,
+        "target_rate": TARGET_RATE,
+        "timeout_s": TIMEOUT,
+        "instance_types": instance_types,
+        "workload": wl.describe() if wl else None,
+        "topology": BENCH_TOPOLOGY,
+    }
+
+
+def print_latency(s: Series, label: str = "Latency"):
+    hist = s.hist
+    cols = "  ".join(f"p{p:g}={hist.percentile(p):.2f}" for p in PERCENTILES)
+    print(f"{label} ms: {cols}  mean={hist.mean():.2f}  max={hist.max_us / 1000.0:.2f}  errors={s.errors}")
+
+
+def workload_results(strategy: str, wl: workload.Workload, elapsed: float, series: dict) -> list:
+    """Print one workload run; result entries per template, then per kind (read/write)."""
+    kinds = {}
+    for t in wl.templates:
+        if t.name in series:
+            kinds.setdefault(t.kind, Series()).merge(series[t.name])
+    total = sum(s.hist.total + s.errors for s in series.values())
+    print(f"\n{wl.name}: {total} requests in {elapsed:.2f}s  -> {total / elapsed:.2f} ops/s")
+
+    entries = []
+    for name, s in sorted(kinds.items()) + sorted(series.items()):
+        n = s.hist.total + s.errors
+        entries.append(result_entry(strategy, name, n, elapsed, s))
+        print_latency(s, f"{name:<20} {n:>7} req")
+    for name, s in sorted(kinds.items()):
+        print_counter(f"{name.capitalize()} target distribution:", s.targets)
+    return entries
+
+
+def parse_strategies(text: str) -> list:
+    strategies = [s.strip() for s in text.split(",") if s.strip()]
+    unknown = [s for s in strategies if s not in KNOWN_STRATEGIES]
+    if unknown or not strategies:
+        raise argparse.ArgumentTypeError(f"expected strategies among {', '.join(KNOWN_STRATEGIES)}")
+    return strategies
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the gatekeeper -> proxy -> MySQL chain.")
+    parser.add_argument("--url", default=_cfg.get("GATEKEEPER_URL") or None,
+                        help="gatekeeper base URL, e.g. http://127.0.0.1:8080 (default: look up Gatekeeper-EC2)")
+    parser.add_argument("--workload", default=_cfg.get("WORKLOAD") or None,
+                        help="workload file (e.g. workloads/sakila_mix.json) instead of the actor INSERT/SELECT runs")
+    parser.add_argument("--requests", type=int, default=None, help="requests per strategy (overrides the file)")
+    parser.add_argument("--read-ratio", type=float, default=None, help="share of reads (overrides the file)")
+    parser.add_argument("--distribution", choices=workload.DISTRIBUTIONS, default=None,
+                        help="key distribution (overrides the file)")
+    parser.add_argument("--strategies", type=parse_strategies, default=STRATEGIES,
+                        help=f"comma-separated subset of {','.join(KNOWN_STRATEGIES)} (default: {','.join(STRATEGIES)})")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    wl = None
+    if args.workload:
+        try:
+            wl = workload.load(args.workload, requests=args.requests, read_ratio=args.read_ratio,
+                               distribution=args.distribution)
+        except ValueError as e:
+            raise SystemExit(f"{args.workload}: {e}")
+
+    found = resolve_target(args.url)
+    print(f"Benchmark endpoint: {GK_URL} ({found})")
+    if BATCH_SIZE > 0:
+        print(f"Writes batched by {BATCH_SIZE} via {GK_BATCH_URL}")
+    if TARGET_RATE > 0:
+        print(f"Open loop: {TARGET_RATE:g} requests/s, up to {CONCURRENCY} in flight")
+    else:
+        print(f"Closed loop: {CONCURRENCY} concurrent client(s)")
+    if wl:
+        print(f"Workload {wl.name}: {wl.requests} requests, read ratio {wl.read_ratio}, keys {wl.distribution}")
+    run = bench_results.new_run("benchmark", run_config(wl, args.strategies, on_aws=not args.url))
+
+    for strat in args.strategies:
         print("\n" + "=" * 60)
         print(f"STRATEGY = {strat}")
 
-        w_time, w_targets = run_writes(strat)
+        if wl:
+            run["results"].extend(workload_results(strat, wl, *run_workload(strat, wl)))
+            continue
+
+        w_time, w = run_writes(strat)
 
         # optional: small pause to reduce replication-lag impact on immediate reads
         time.sleep(2)
 
-        r_time, r_targets = run_reads(strat)
+        r_time, r = run_reads(strat)
+        w, r = w.get("write", Series()), r.get("read", Series())
 
         print(f"\nWrites: {N_WRITES} in {w_time:.2f}s  -> {N_WRITES / w_time:.2f} ops/s")
-        print_counter("Write target distribution:", w_targets)
+        print_latency(w)
+        print_counter("Write target distribution:", w.targets)
 
         print(f"\nReads : {N_READS} in {r_time:.2f}s  -> {N_READS / r_time:.2f} ops/s")
-        print_counter("Read target distribution:", r_targets)
+        print_latency(r)
+        print_counter("Read target distribution:", r.targets)
+
+        run["results"].append(result_entry(strat, "write", N_WRITES, w_time, w))
+        run["results"].append(result_entry(strat, "read", N_READS, r_time, r))
+
+    if FORMAT_ROUNDS > 0:
+        print("\n" + "=" * 60)
+        print(f"RESPONSE FORMATS ({FORMAT_QUERY!r}, {FORMAT_ROUNDS} rounds each)")
+        run["formats"] = run_formats()
 
+    if RESULTS_DIR:
+        print(f"\nResults written to {bench_results.write_run(run, RESULTS_DIR)}")
     print("\nDone.")
 
 
@@ -0,0 +1,453 @@
+"""Run the gatekeeper -> proxy -> MySQL chain on one Linux box, without AWS.
+
+    python local_topology.py --backends 127.0.0.1:3306,127.0.0.1:3307,127.0.0.1:3308
+    python local_topology.py --mysqld 3 --sakila ~/sakila-db -- --workload workloads/sakila_mix.json
+
+The proxy and the gatekeeper are the apps shipped in user_data/*.sh, extracted as they
+are deployed (shared modules inlined like load_user_data does) into --workdir and run
+with this Python, which needs their packages (flask, requests, mysql-connector-python,
+aiohttp, aiomysql).
+
+MySQL stand-ins are servers you already run (--backends, the first one is the master)
+or fresh mysqld instances started here (--mysqld N, optionally loaded with sakila). They
+are independent copies, not replicas, so reads on a worker do not see writes made on the
+master. A standalone server has no replica status either: the proxy reads its lag as
+unknown, and lag_aware treats every worker as stale and sends all reads to the master.
+Session reads (session tokens) never find the master's GTIDs on a worker, so they wait
+up to RYW_WAIT_TIMEOUT and then go to the master too. Results for lag_aware and for
+session reads from this harness are therefore not comparable with the AWS topology.
+
+Arguments after "--" are passed to benchmark.py, run against the local gatekeeper;
+without them the topology stays up until Ctrl-C. The run's result file records what
+was started (backends, engines, processes) under config.topology, so two runs that
+differ in one option compare directly, e.g. the proxy engines:
+
+    CONCURRENCY=32 python local_topology.py --mysqld 3 --proxy-engine flask -- --strategies direct
+    CONCURRENCY=32 python local_topology.py --mysqld 3 --proxy-engine asyncio -- --strategies direct
+    python bench_results.py compare results/<flask run>.json results/<asyncio run>.json
+
+--delay-ms puts a relay in front of the last worker that holds each of its replies
+back, so the strategies can be compared with one replica slower than the others:
+
+    CONCURRENCY=8 python local_topology.py --mysqld 3 --delay-ms 30 -- --strategies round_robin,p2c
+
+    python local_topology.py --smoke
+
+only runs the SQL classifier's self-checks and checks the gatekeeper: each engine in turn
+is started in front of a stub proxy and must answer a POST to /query and /query/batch
+(no MySQL or proxy packages needed).
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+USER_DATA = os.path.join(ROOT, "user_data")
+
+_INCLUDE_RE = re.compile(r"^#@include (\S+)$", re.M)
+_APP_RE = re.compile(r"""^cat > "\$\{\w+\}/(\w+\.py)" <<'PY'\n(.*?)^PY$""", re.M | re.S)
+
+# -----------------------------
+# Apps from the user-data scripts
+# -----------------------------
+
+def expand_includes(path: str) -> str:
+    """The user-data script with its `#@include <file>` lines replaced, as load_user_data() does."""
+    base = os.path.dirname(path)
+
+    def include(m):
+        with open(os.path.join(base, m.group(1)), "r", encoding="utf-8") as fh:
+            return fh.read().rstrip("\n")
+
+    with open(path, "r", encoding="utf-8") as fh:
+        return _INCLUDE_RE.sub(include, fh.read())
+
+
+def extract_apps(script: str, dest: str) -> list:
+    """Write every `cat > "${DIR}/x.py" <<'PY'` heredoc of `script` into dest; returns the file names."""
+    os.makedirs(dest, exist_ok=True)
+    names = []
+    for m in _APP_RE.finditer(expand_includes(os.path.join(USER_DATA, script))):
+        with open(os.path.join(dest, m.group(1)), "w", encoding="utf-8") as fh:
+            fh.write(m.group(2))
+        names.append(m.group(1))
+    if not names:
+        raise RuntimeError(f"No Python heredocs found in {script}")
+    return names
+
+# -----------------------------
+# Processes
+# -----------------------------
+
+_children = []
+
+
+def spawn(name: str, argv: list, log_dir: str, **kwargs) -> subprocess.Popen:
+    path = os.path.join(log_dir, f"{name}.log")
+    with open(path, "ab") as log:
+        p = subprocess.Popen(argv, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+    _children.append((name, p, path))
+    return p
+
+
+def stop(p: subprocess.Popen):
+    if p.poll() is None:
+        p.terminate()
+    try:
+        p.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        p.kill()
+
+
+def stop_all():
+    for name, p, _ in reversed(_children):
+        if p.poll() is None:
+            p.terminate()
+    for name, p, _ in reversed(_children):
+        stop(p)
+
+
+def check_alive():
+    for name, p, log in _children:
+        if p.poll() is not None:
+            raise RuntimeError(f"{name} exited with {p.returncode}, see {log}")
+
+
+def wait_for_port(host: str, port: int, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        check_alive()
+        try:
+            with socket.create_connection((host, port), timeout=1.0):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Nothing listening on {host}:{port} after {timeout:.0f}s")
+            time.sleep(0.2)
+
+
+def wait_for_http(url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        check_alive()
+        try:
+            with urllib.request.urlopen(url, timeout=2.0) as r:
+                if r.status == 200:
+                    return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} not healthy after {timeout:.0f}s")
+        time.sleep(0.5)
+
+
+def post_json(url: str, payload: dict) -> tuple:
+    """(status, decoded body) of a JSON POST; error statuses are returned, not raised."""
+    req = urllib.request.Request(url, data=json.dumps(payload).encode(), method="POST",
+                                 headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10.0) as r:
+            status, body = r.status, r.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    try:
+        return status, json.loads(body)
+    except ValueError:
+        return status, body.decode(errors="replace")
+
+
+def check_query(gatekeeper_url: str, payload: dict, path: str = "/query"):
+    """The health check only covers GET /: make sure queries get through as well."""
+    status, body = post_json(gatekeeper_url + path, payload)
+    if status != 200:
+        raise RuntimeError(f"POST {path} {payload} -> {status}: {body}")
+    return body
+
+# -----------------------------
+# MySQL stand-ins
+# -----------------------------
+
+def mysql_client(args, sock: str, sql: str = None, stdin=None):
+    argv = [args.mysql_bin, "--no-defaults", "-uroot", f"--socket={sock}"]
+    if sql is not None:
+        argv += ["-e", sql]
+    subprocess.run(argv, stdin=stdin, check=True)
+
+
+def start_mysqld(args, i: int) -> str:
+    """Start (initialising on first use) the i-th local mysqld; returns its "127.0.0.1:port"."""
+    port = args.mysql_port_base + i
+    datadir = os.path.join(args.workdir, f"mysql{i}")
+    sock = os.path.join(args.workdir, f"mysql{i}.sock")
+    fresh = not os.path.isdir(datadir)
+    if fresh:
+        subprocess.run([args.mysqld_bin, "--no-defaults", "--initialize-insecure", f"--datadir={datadir}"],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    spawn(f"mysql{i}", [
+        args.mysqld_bin, "--no-defaults", f"--datadir={datadir}", f"--socket={sock}",
+        f"--pid-file={datadir}.pid", "--bind-address=127.0.0.1", f"--port={port}",
+        "--mysqlx=OFF", f"--server-id={i + 1}",
+    ], args.workdir)
+    wait_for_port("127.0.0.1", port)
+    if fresh:
+        mysql_client(args, sock, (
+            f"CREATE USER '{args.db_user}'@'%' IDENTIFIED BY '{args.db_pass}'; "
+            f"GRANT ALL ON *.* TO '{args.db_user}'@'%'; "
+        ))
+        if args.sakila:
+            for name in ("sakila-schema.sql", "sakila-data.sql"):
+                with open(os.path.join(args.sakila, name), "rb") as fh:
+                    mysql_client(args, sock, stdin=fh)
+        else:
+            mysql_client(args, sock, "CREATE DATABASE IF NOT EXISTS sakila")
+    return f"127.0.0.1:{port}"
+
+
+class DelayRelay:
+    """TCP relay to a backend that holds the first chunk of each reply back by delay_ms."""
+
+    def __init__(self, backend: str, delay_ms: float):
+        host, port = backend.rsplit(":", 1)
+        self.upstream = (host, int(port))
+        self.delay_s = delay_ms / 1000.0
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.address = f"127.0.0.1:{self.server.getsockname()[1]}"
+        Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            client, _ = self.server.accept()
+            try:
+                upstream = socket.create_connection(self.upstream, timeout=5.0)
+                upstream.settimeout(None)
+            except OSError:
+                client.close()
+                continue
+            asked = Event()  # the client sent something the backend has not answered yet
+            asked.set()      # the server greeting counts as a reply
+            Thread(target=self._pump, args=(client, upstream, asked, False), daemon=True).start()
+            Thread(target=self._pump, args=(upstream, client, asked, True), daemon=True).start()
+
+    def _pump(self, src: socket.socket, dst: socket.socket, asked: Event, reply: bool):
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                if not reply:
+                    asked.set()
+                elif asked.is_set():
+                    asked.clear()
+                    time.sleep(self.delay_s)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for sock in (src, dst):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            src.close()
+
+# -----------------------------
+# Topology
+# -----------------------------
+
+def start_topology(args) -> tuple:
+    """Backends, proxy, gatekeeper; returns the gatekeeper's base URL and what was started."""
+    if args.backends:
+        backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    else:
+        if not shutil.which(args.mysqld_bin):
+            raise RuntimeError(f"{args.mysqld_bin} not found: install MySQL or pass --backends")
+        backends = [start_mysqld(args, i) for i in range(args.mysqld)]
+        print(f"MySQL stand-ins: {', '.join(backends)} (logs in {args.workdir})")
+    if args.delay_ms > 0:
+        if len(backends) < 2:
+            raise RuntimeError("--delay-ms needs a worker: give at least two backends")
+        relay = DelayRelay(backends[-1], args.delay_ms)
+        print(f"Worker {backends[-1]} reached through {relay.address}, {args.delay_ms:g} ms slower")
+        backends[-1] = relay.address
+
+    proxy_dir = os.path.join(args.workdir, "proxy")
+    gatekeeper_dir = os.path.join(args.workdir, "gatekeeper")
+    extract_apps("proxy_setup.sh", proxy_dir)
+    extract_apps("gatekeeper_setup.sh", gatekeeper_dir)
+
+    env = {**os.environ, "PYTHONUNBUFFERED": "1", "DB_USER": args.db_user, "DB_PASS": args.db_pass}
+    spawn("proxy", [sys.executable, "proxy.py"], args.workdir, cwd=proxy_dir, env={
+        **env,
+        "MASTER_HOST": backends[0],
+        "WORKER_HOSTS": ",".join(backends[1:]),
+        "PROXY_BIND": "127.0.0.1",
+        "PROXY_PORT": str(args.proxy_port),
+        "PROXY_ENGINE": args.proxy_engine,
+        "PROXY_PROCESSES": str(args.proxy_processes),
+        "PROXY_STATS_PORT": str(args.proxy_port + 1),
+    })
+    proxy_url = f"http://127.0.0.1:{args.proxy_port}"
+    wait_for_http(proxy_url + "/")
+    print(f"Proxy: {proxy_url} ({args.proxy_engine}, master {backends[0]})")
+
+    # One local client would hit the per-client-IP rate limits at once; keep them only if set
+    env.setdefault("READ_RATE_LIMIT", "0")
+    env.setdefault("WRITE_RATE_LIMIT", "0")
+    spawn("gatekeeper", [sys.executable, "gatekeeper.py"], args.workdir, cwd=gatekeeper_dir, env={
+        **env,
+        "PROXY_URL": proxy_url,
+        "GATEKEEPER_BIND": "127.0.0.1",
+        "GATEKEEPER_PORT": str(args.gatekeeper_port),
+        "GATEKEEPER_ENGINE": args.gatekeeper_engine,
+    })
+    gatekeeper_url = f"http://127.0.0.1:{args.gatekeeper_port}"
+    wait_for_http(gatekeeper_url + "/")
+    check_query(gatekeeper_url, {"query": "SELECT 1", "strategy": "direct"})
+    print(f"Gatekeeper: {gatekeeper_url} ({args.gatekeeper_engine})")
+    return gatekeeper_url, {
+        "harness": "local_topology",
+        "backends": backends,
+        "proxy_engine": args.proxy_engine,
+        "proxy_processes": args.proxy_processes,
+        "gatekeeper_engine": args.gatekeeper_engine,
+        "delay_ms": args.delay_ms,
+    }
+
+# -----------------------------
+# Gatekeeper smoke check
+# -----------------------------
+
+class StubProxy(BaseHTTPRequestHandler):
+    """Answers like the proxy does, without a database."""
+
+    def _reply(self, out: dict):
+        body = json.dumps(out).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply({"status": "stub proxy up"})
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        strategy = self.headers.get("X-Proxy-Strategy", "direct")
+        if self.path == "/query/batch":
+            self._reply({"strategy": strategy, "results": [
+                {"target_host": "stub", "result": [{"1": 1}]} for _ in payload.get("queries", [])]})
+        else:
+            self._reply({"strategy": strategy, "target_host": "stub", "query": payload.get("query"),
+                         "result": [{"1": 1}]})
+
+    def log_message(self, *args):
+        pass
+
+
+def smoke(args) -> int:
+    """sqlclass self-checks, then POST /query and /query/batch through each gatekeeper engine in front of StubProxy."""
+    failed = 0
+    if subprocess.call([sys.executable, os.path.join(USER_DATA, "sqlclass.py")]):
+        failed += 1
+        print("sqlclass: FAILED", file=sys.stderr)
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubProxy)
+    Thread(target=stub.serve_forever, daemon=True).start()
+    gatekeeper_dir = os.path.join(args.workdir, "gatekeeper")
+    extract_apps("gatekeeper_setup.sh", gatekeeper_dir)
+    url = f"http://127.0.0.1:{args.gatekeeper_port}"
+    try:
+        for engine in ("flask", "asyncio"):
+            p = spawn(f"gatekeeper-{engine}", [sys.executable, "gatekeeper.py"], args.workdir, cwd=gatekeeper_dir,
+                      env={**os.environ, "PYTHONUNBUFFERED": "1",
+                           "PROXY_URL": f"http://127.0.0.1:{stub.server_address[1]}",
+                           "GATEKEEPER_BIND": "127.0.0.1", "GATEKEEPER_PORT": str(args.gatekeeper_port),
+                           "GATEKEEPER_ENGINE": engine})
+            try:
+                wait_for_http(url + "/")
+                body = check_query(url, {"query": "SELECT 1"})
+                if body.get("target_host") != "stub":
+                    raise RuntimeError(f"POST /query relayed {body}")
+                body = check_query(url, {"queries": ["SELECT 1", "SELECT 2"]}, "/query/batch")
+                if len(body.get("results", [])) != 2:
+                    raise RuntimeError(f"POST /query/batch relayed {body}")
+                print(f"gatekeeper {engine}: ok")
+            except RuntimeError as e:
+                failed += 1
+                print(f"gatekeeper {engine}: FAILED: {e}", file=sys.stderr)
+            finally:
+                stop(p)
+                _children.pop()
+    finally:
+        stub.shutdown()
+    return 1 if failed else 0
+
+
+def parse_args(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    bench = []
+    if "--" in argv:
+        k = argv.index("--")
+        argv, bench = argv[:k], argv[k + 1:]
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--smoke", action="store_true",
+                        help="only check both gatekeeper engines against a stub proxy, then exit")
+    src = parser.add_mutually_exclusive_group()
+    src.add_argument("--backends", help="running MySQL servers host:port,... (first one is the master)")
+    src.add_argument("--mysqld", type=int, default=3, help="else start this many mysqld instances (default 3)")
+    parser.add_argument("--sakila", help="directory with sakila-schema.sql and sakila-data.sql, loaded into new instances")
+    parser.add_argument("--workdir", default=os.path.join(ROOT, ".local_topology"),
+                        help="extracted apps, logs and mysqld data directories")
+    parser.add_argument("--mysqld-bin", default="mysqld")
+    parser.add_argument("--mysql-bin", default="mysql")
+    parser.add_argument("--mysql-port-base", type=int, default=13306)
+    parser.add_argument("--db-user", default="admin")
+    parser.add_argument("--db-pass", default="Password123")
+    parser.add_argument("--proxy-port", type=int, default=15000)
+    parser.add_argument("--proxy-engine", choices=("flask", "asyncio"), default="flask")
+    parser.add_argument("--proxy-processes", type=int, default=1)
+    parser.add_argument("--gatekeeper-port", type=int, default=18080)
+    parser.add_argument("--gatekeeper-engine", choices=("flask", "asyncio"), default="asyncio")
+    parser.add_argument("--delay-ms", type=float, default=0.0,
+                        help="make the last worker this much slower to answer, through a relay")
+    args = parser.parse_args(argv)
+    args.workdir = os.path.abspath(args.workdir)
+    return args, bench
+
+
+def main(argv=None) -> int:
+    args, bench = parse_args(argv)
+    os.makedirs(args.workdir, exist_ok=True)
+    try:
+        if args.smoke:
+            return smoke(args)
+        url, topology = start_topology(args)
+        if bench:
+            env = {**os.environ, "BENCH_TOPOLOGY": json.dumps(topology)}
+            return subprocess.call([sys.executable, os.path.join(ROOT, "benchmark.py"), "--url", url, *bench], env=env)
+        print("Up; Ctrl-C to stop")
+        while True:
+            check_alive()
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        return 0
+    except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+        print(f"[ERROR] {e}", file=sys.stderr)
+        return 1
+    finally:
+        stop_all()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
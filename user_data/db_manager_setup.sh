@@ -25,6 +25,8 @@ server-id=1
 log_bin=/var/log/mysql/mysql-bin
 binlog_format=ROW
 binlog_do_db=${DB_NAME}
+gtid_mode=ON
+enforce_gtid_consistency=ON
 bind-address=0.0.0.0
 EOF
 
@@ -33,6 +33,8 @@ relay-log=/var/log/mysql/mysql-relay-bin
 log_bin=/var/log/mysql/mysql-bin
 binlog_format=ROW
 binlog_do_db=${DB_NAME}
+gtid_mode=ON
+enforce_gtid_consistency=ON
 read_only=1
 bind-address=0.0.0.0
 EOF
@@ -63,35 +65,33 @@ for i in {1..120}; do
 done
 
 # -----------------------------------
-# 1) Pull a consistent dump from master that includes correct binlog file/pos
+# 1) Pull a consistent dump from master that carries the master's GTID set
 # -----------------------------------
-echo "[STEP] Dumping ${DB_NAME} from master with --master-data=2..."
+echo "[STEP] Dumping ${DB_NAME} from master with --set-gtid-purged=ON..."
 mysqldump \
   -h "${MASTER_HOST}" -u "${ADMIN_USER}" -p"${ADMIN_PASS}" \
   --databases "${DB_NAME}" \
-  --single-transaction --master-data=2 --set-gtid-purged=OFF \
+  --single-transaction --master-data=2 --set-gtid-purged=ON \
   > /tmp/sakila_dump.sql
 
-# Extract binlog coordinates from dump
-MASTER_LOG_FILE=$(grep -m1 "MASTER_LOG_FILE" /tmp/sakila_dump.sql | sed -n "s/.*MASTER_LOG_FILE='\([^']*\)'.*/\1/p")
-MASTER_LOG_POS=$(grep -m1 "MASTER_LOG_POS"  /tmp/sakila_dump.sql | sed -n "s/.*MASTER_LOG_POS=\([0-9]*\).*/\1/p")
-
-if [ -z "${MASTER_LOG_FILE}" ] || [ -z "${MASTER_LOG_POS}" ]; then
-  echo "[ERROR] Could not extract MASTER_LOG_FILE / MASTER_LOG_POS from dump."
+if ! grep -q "GTID_PURGED" /tmp/sakila_dump.sql; then
+  echo "[ERROR] Dump has no GTID_PURGED statement (is gtid_mode=ON on the master?)."
   exit 1
 fi
 
-echo "[OK] Extracted coordinates: ${MASTER_LOG_FILE}:${MASTER_LOG_POS}"
-
 # -----------------------------------
 # 2) Load the dump locally (brings replica to same starting point)
 # -----------------------------------
+# Clear the local GTID history first so the dump's GTID_PURGED can be applied
 echo "[STEP] Importing dump locally..."
+mysql -uroot -e "RESET MASTER;"
 mysql -uroot < /tmp/sakila_dump.sql
 
 # -----------------------------------
-# 3) Configure replication using real file/pos (no hardcoding)
+# 3) Configure replication with GTID auto-positioning
 # -----------------------------------
+# The proxy compares session tokens (master GTID sets) against each
+# replica's Executed_Gtid_Set, so replicas must track GTIDs, not file/pos.
 echo "[STEP] Configuring replication..."
 mysql -uroot <<EOF
 STOP SLAVE;
@@ -101,8 +101,7 @@ CHANGE MASTER TO
   MASTER_HOST='${MASTER_HOST}',
   MASTER_USER='${REPL_USER}',
   MASTER_PASSWORD='${REPL_PASS}',
-  MASTER_LOG_FILE='${MASTER_LOG_FILE}',
-  MASTER_LOG_POS=${MASTER_LOG_POS};
+  MASTER_AUTO_POSITION=1;
 
 START SLAVE;
 EOF
@@ -8,6 +8,19 @@ VENV_DIR="${APP_DIR}/venv"
 PORT="8080"
 PROXY_URL="http://10.0.2.15:5000"
 
+# HTTP engine: "asyncio" (aiohttp, pooled keep-alive forwarding) or "flask" (threaded dev server)
+GATEKEEPER_ENGINE="asyncio"
+# Keep-alive connections to the proxy
+PROXY_POOL_SIZE="64"
+
+# Admission control: per client IP rate limits (req/s) and concurrency limits, writes kept smaller
+READ_RATE_LIMIT="200"
+WRITE_RATE_LIMIT="50"
+MAX_CONCURRENT_READS="64"
+MAX_QUEUED_READS="256"
+MAX_CONCURRENT_WRITES="16"
+MAX_QUEUED_WRITES="64"
+
 export DEBIAN_FRONTEND=noninteractive
 apt-get update -y
 apt-get install -y python3-venv python3-full
@@ -18,71 +31,795 @@ chown -R ubuntu:ubuntu "${APP_DIR}"
 # venv 
 sudo -u ubuntu python3 -m venv "${VENV_DIR}"
 "${VENV_DIR}/bin/pip" install --upgrade pip
-"${VENV_DIR}/bin/pip" install flask requests
+"${VENV_DIR}/bin/pip" install flask requests aiohttp
+
+# SQL classifier shared with the proxy (user_data/sqlclass.py, inlined at launch)
+cat > "${APP_DIR}/sqlclass.py" <<'PY'
+#@include sqlclass.py
+PY
+
+# Prometheus metrics shared with the proxy (user_data/metrics.py)
+cat > "${APP_DIR}/metrics.py" <<'PY'
+#@include metrics.py
+PY
 
 # Gatekeeper app: forwards requests to Proxy + blocks dangerous SQL
-cat > "${APP_DIR}/gatekeeper.py" <<PY
-from flask import Flask, request, jsonify
+cat > "${APP_DIR}/gatekeeper.py" <<'PY'
+from flask import Flask, Response, request, jsonify
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from threading import Condition, Event, Lock
+import json
+import math
+import os
 import requests
+import sys
+import time
+from urllib3.exceptions import HTTPError as RelayError
+
+import metrics
+import sqlclass
 
 app = Flask(__name__)
 
+# HTTP engine: "flask" (threaded dev server) or "asyncio" (aiohttp)
+GATEKEEPER_ENGINE = os.getenv("GATEKEEPER_ENGINE", "flask").strip().lower()
+
 # Proxy private IP
-PROXY_URL = "http://10.0.2.15:5000"
+PROXY_URL = os.getenv("PROXY_URL", "http://10.0.2.15:5000")
+# HTTP listen address
+GATEKEEPER_BIND = os.getenv("GATEKEEPER_BIND", "0.0.0.0")
+GATEKEEPER_PORT = int(os.getenv("GATEKEEPER_PORT", "8080"))
+
+# Keep-alive connections to the proxy: at most this many kept open...
+PROXY_POOL_SIZE = int(os.getenv("PROXY_POOL_SIZE", "64"))
+# ... (asyncio: also in use at once; a request waits this long for one before a 502)
+PROXY_POOL_TIMEOUT = float(os.getenv("PROXY_POOL_TIMEOUT", "5.0"))
+PROXY_KEEPALIVE = float(os.getenv("PROXY_KEEPALIVE", "30.0"))
+PROXY_TIMEOUT = 15
+PROXY_BATCH_TIMEOUT = 60
 
 # Allowed strategies (for safety)
-ALLOWED_STRATEGIES = {"direct", "random", "latency", "round_robin"}
+ALLOWED_STRATEGIES = {"direct", "random", "latency", "round_robin", "lag_aware", "p2c", "hedged"}
 
+MAX_BATCH_SIZE = 1000
 
-def is_dangerous(sql: str) -> bool:
-    s = (sql or "").strip().lower()
-    return s.startswith(("drop", "truncate", "alter"))
+# Admission control. Per client IP token buckets (requests/s, burst; rate 0 = no limit),
+# writes on their own smaller budget...
+READ_RATE_LIMIT = float(os.getenv("READ_RATE_LIMIT", "200"))
+READ_RATE_BURST = float(os.getenv("READ_RATE_BURST", "400"))
+WRITE_RATE_LIMIT = float(os.getenv("WRITE_RATE_LIMIT", "50"))
+WRITE_RATE_BURST = float(os.getenv("WRITE_RATE_BURST", "100"))
+# ... buckets kept for this many clients (least recently seen dropped first)
+RATE_LIMIT_CLIENTS = int(os.getenv("RATE_LIMIT_CLIENTS", "10000"))
+# ... and at most this many requests forwarded at once, with this many more queued for up to
+# ADMISSION_QUEUE_TIMEOUT s; anything beyond is answered 503 at once
+MAX_CONCURRENT_READS = int(os.getenv("MAX_CONCURRENT_READS", "64"))
+MAX_QUEUED_READS = int(os.getenv("MAX_QUEUED_READS", "256"))
+MAX_CONCURRENT_WRITES = int(os.getenv("MAX_CONCURRENT_WRITES", "16"))
+MAX_QUEUED_WRITES = int(os.getenv("MAX_QUEUED_WRITES", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2.0"))
+# Retry-After (s) sent with 503s
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "1"))
 
+# Singleflight: identical reads in flight at the same time share one proxy call. A flight takes
+# at most SINGLEFLIGHT_MAX_FANIN waiting followers (0 = off); bigger answers are not shared
+SINGLEFLIGHT_MAX_FANIN = int(os.getenv("SINGLEFLIGHT_MAX_FANIN", "100"))
+SINGLEFLIGHT_MAX_BYTES = int(os.getenv("SINGLEFLIGHT_MAX_BYTES", str(1024 * 1024)))
 
-@app.route("/", methods=["GET"])
-def health():
-    return jsonify({"status": "gatekeeper up", "proxy": PROXY_URL}), 200
+METRICS = metrics.Registry()
+REQUESTS = METRICS.counter("gatekeeper_requests_total", "Requests forwarded to the proxy, by strategy and kind.",
+                           ("strategy", "kind"))
+RESPONSES = METRICS.counter("gatekeeper_responses_total", "HTTP responses sent, by endpoint and status code.",
+                            ("endpoint", "code"))
+PROXY_SECONDS = METRICS.histogram("gatekeeper_proxy_seconds",
+                                  "Gatekeeper -> proxy time until the response headers arrive.", ("endpoint",))
+PROXY_ERRORS = METRICS.counter("gatekeeper_proxy_errors_total", "Proxy calls that failed (502).", ("endpoint",))
+COALESCED = METRICS.counter("gatekeeper_singleflight_total",
+                            "Identical concurrent reads: led a flight, shared its answer, overflowed the fan-in "
+                            "cap, or missed it because it was too big or failed.", ("result",))
+SHED = METRICS.counter("gatekeeper_shed_total",
+                       "Requests turned away: rate_limit (429), queue_full or queue_timeout (503).",
+                       ("reason", "kind"))
 
+# Response headers of the proxy passed on to the client as they are
+RELAYED_HEADERS = ("Content-Type", "Content-Encoding", "Vary", "Server-Timing")
 
-@app.route("/query", methods=["POST"])
-def query():
-    payload = request.get_json(silent=True) or {}
-    sql = payload.get("query", "")
 
-    if not sql:
-        return jsonify({"error": "Missing field: query"}), 400
+def is_dangerous(sql: str) -> bool:
+    # Every statement of the input counts, comments are skipped and /*! ... */ bodies are code
+    return sqlclass.classify(sql).dangerous
 
+
+# Validation is shared by both engines: errors are (body, status) pairs each engine renders
+
+def check_query(payload: dict):
+    sql = payload.get("query", "")
+    if not sql:
+        return {"error": "Missing field: query"}, 400
     # Security: block destructive commands
     if is_dangerous(sql):
-        return jsonify({"error": "Dangerous SQL command not allowed"}), 403
+        return {"error": "Dangerous SQL command not allowed"}, 403
+    return None
 
-    # Optional strategy forwarded to proxy
+
+def check_batch(payload: dict):
+    queries = payload.get("queries")
+    if not isinstance(queries, list) or not queries:
+        return {"error": "Missing field: queries (non-empty list)"}, 400
+    if len(queries) > MAX_BATCH_SIZE:
+        return {"error": f"Too many statements: {len(queries)} > {MAX_BATCH_SIZE}"}, 400
+
+    # Security: every statement of the batch goes through the same check as /query
+    for i, sql in enumerate(queries):
+        if not isinstance(sql, str) or not sql:
+            return {"error": f"queries[{i}] must be a non-empty string"}, 400
+        if is_dangerous(sql):
+            return {"error": "Dangerous SQL command not allowed", "index": i}, 403
+    return None
+
+
+def strategy_headers(payload: dict):
+    """Returns (headers for the proxy, error or None)."""
     strategy = (payload.get("strategy") or "").strip().lower()
     headers = {}
     if strategy:
         if strategy not in ALLOWED_STRATEGIES:
-            return jsonify({"error": f"Invalid strategy: {strategy}. Allowed: {sorted(ALLOWED_STRATEGIES)}"}), 400
+            return None, ({"error": f"Invalid strategy: {strategy}. Allowed: {sorted(ALLOWED_STRATEGIES)}"}, 400)
         headers["X-Proxy-Strategy"] = strategy
+    return headers, None
+
+
+def negotiation_headers(headers: dict, incoming) -> dict:
+    """Let the client and the proxy agree on the response format and compression directly."""
+    headers["Accept"] = incoming.get("Accept", "application/json")
+    # Not the HTTP client's default "gzip, deflate": the body is relayed still encoded
+    headers["Accept-Encoding"] = incoming.get("Accept-Encoding", "identity")
+    return headers
+
+
+def count_request(headers: dict, kind: str):
+    REQUESTS.inc(headers.get("X-Proxy-Strategy", "default"), kind)
+
+
+def query_kind(sql: str) -> str:
+    return "write" if sqlclass.classify(sql).write else "read"
+
+
+def batch_kind(queries: list) -> str:
+    return "write" if any(query_kind(q) == "write" for q in queries) else "read"
+
+
+class RateLimiter:
+    """Token bucket per client, for one kind of request."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self._lock = Lock()
+        self._buckets = OrderedDict()  # client -> [tokens, updated_at], least recently seen first
+        self.limited = 0
+
+    def take(self, client: str) -> float:
+        """0 if `client` may go ahead, else the seconds until it earns a token."""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            b = self._buckets.get(client)
+            if b is None:
+                b = self._buckets[client] = [self.burst, now]
+                if len(self._buckets) > RATE_LIMIT_CLIENTS:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+                b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+                b[1] = now
+            if b[0] >= 1.0:
+                b[0] -= 1.0
+                return 0.0
+            self.limited += 1
+            return (1.0 - b[0]) / self.rate
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst, "clients": len(self._buckets), "limited": self.limited}
+
+
+class Gate:
+    """At most `limit` requests in flight and `queue` more waiting; the engines implement the waiting."""
+
+    def __init__(self, limit: int, queue: int):
+        self.limit = limit
+        self.queue = queue
+        self.in_flight = self.waiting = 0
+        self.admitted = self.queued = self.queue_full = self.queue_timeouts = 0
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "queue": self.queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "queue_full": self.queue_full,
+            "queue_timeouts": self.queue_timeouts,
+        }
+
+
+class ThreadGate(Gate):
+    def __init__(self, limit: int, queue: int):
+        super().__init__(limit, queue)
+        self._cond = Condition(Lock())
+
+    def enter(self):
+        """None once a slot is held (leave() it), else why the request is shed."""
+        with self._cond:
+            if self.in_flight >= self.limit:
+                if self.waiting >= self.queue:
+                    self.queue_full += 1
+                    return "queue_full"
+                self.queued += 1
+                self.waiting += 1
+                try:
+                    if not self._cond.wait_for(lambda: self.in_flight < self.limit, ADMISSION_QUEUE_TIMEOUT):
+                        self.queue_timeouts += 1
+                        return "queue_timeout"
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            return None
 
-    # Forward to proxy
+    def leave(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+_limiters = {"read": RateLimiter(READ_RATE_LIMIT, READ_RATE_BURST),
+             "write": RateLimiter(WRITE_RATE_LIMIT, WRITE_RATE_BURST)}
+
+
+def rate_limited(client: str, kind: str):
+    """None, or the 429 for a client over its budget for `kind`."""
+    wait = _limiters[kind].take(client)
+    if not wait:
+        return None
+    SHED.inc("rate_limit", kind)
+    return {"error": f"Rate limit exceeded ({kind}s)"}, 429, {"Retry-After": str(max(1, math.ceil(wait)))}
+
+
+def shed(kind: str, reason: str):
+    SHED.inc(reason, kind)
+    return {"error": f"Gatekeeper overloaded ({reason})"}, 503, {"Retry-After": str(SHED_RETRY_AFTER)}
+
+
+def admission_stats(gates: dict) -> dict:
+    return {
+        "rate_limits": {k: lim.stats() for k, lim in _limiters.items()},
+        "concurrency": {k: g.stats() for k, g in gates.items()},
+        "queue_timeout": ADMISSION_QUEUE_TIMEOUT,
+    }
+
+
+def flight_key(payload: dict, headers: dict):
+    """What makes two reads interchangeable, or None if this one must go on its own."""
+    if SINGLEFLIGHT_MAX_FANIN <= 0 or "session_token" in payload:
+        return None  # read-your-writes answers belong to one session
+    # Only the edges are trimmed: collapsing inner whitespace could change a string literal
+    sql = payload["query"].strip().rstrip(";").strip()
+    return (sql, json.dumps(payload.get("params")), payload.get("cache", True) is not False,
+            headers.get("X-Proxy-Strategy"), headers.get("Accept"), headers.get("Accept-Encoding"))
+
+
+class Flight:
+    def __init__(self, done):
+        self.done = done       # threading.Event or asyncio.Event
+        self.followers = 0
+        self.result = None     # (body, status, headers) from the proxy, if it can be shared
+
+
+class SingleFlight:
+    """Lets identical reads in flight at the same time share the first one's proxy answer.
+
+    The engines do the waiting: followers wait on flight.done, and fall back to
+    forwarding on their own if the leader had nothing to share.
+    """
+
+    def __init__(self, event=Event):
+        self._event = event
+        self._lock = Lock()
+        self._flights = {}
+        self.leaders = self.shared = self.overflow = self.missed = 0
+
+    def join(self, key):
+        """(flight, leader). (None, True): the fan-in cap is reached, forward alone."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(self._event())
+                self.leaders += 1
+                COALESCED.inc("leader")
+                return flight, True
+            if flight.followers >= SINGLEFLIGHT_MAX_FANIN:
+                self.overflow += 1
+                COALESCED.inc("overflow")
+                return None, True
+            flight.followers += 1
+            return flight, False
+
+    def land(self, key, flight: Flight, result):
+        """Leader: hand `result` (None if the proxy call failed) to the followers.
+
+        Only a 2xx answer is shared: after a proxy error each follower tries on its own.
+        """
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        if result is not None and 200 <= result[1] < 300 and len(result[0]) <= SINGLEFLIGHT_MAX_BYTES:
+            flight.result = result
+        flight.done.set()
+
+    def result(self, flight: Flight):
+        with self._lock:
+            if flight.result is None:
+                self.missed += 1
+                COALESCED.inc("missed")
+            else:
+                self.shared += 1
+                COALESCED.inc("shared")
+        return flight.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_fanin": SINGLEFLIGHT_MAX_FANIN,
+                "max_bytes": SINGLEFLIGHT_MAX_BYTES,
+                "in_flight": len(self._flights),
+                "leaders": self.leaders,
+                "shared": self.shared,
+                "overflow": self.overflow,
+                "missed": self.missed,
+            }
+
+
+def relayed_headers(r) -> dict:
+    return {k: r.headers[k] for k in RELAYED_HEADERS if k in r.headers}
+
+
+def proxy_unreachable(e: BaseException):
+    return {"error": f"Proxy unreachable: {str(e) or type(e).__name__}"}, 502
+
+
+# One keep-alive pool to the proxy for every serving thread
+_proxy = requests.Session()
+_proxy.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=PROXY_POOL_SIZE))
+
+_gates = {"read": ThreadGate(MAX_CONCURRENT_READS, MAX_QUEUED_READS),
+          "write": ThreadGate(MAX_CONCURRENT_WRITES, MAX_QUEUED_WRITES)}
+
+
+_flights = SingleFlight()
+
+# Followers give up on a flight after this long and forward on their own
+FLIGHT_WAIT = PROXY_TIMEOUT + ADMISSION_QUEUE_TIMEOUT
+
+
+def error(err):
+    """Flask response for a (body, status[, headers]) error."""
+    return (jsonify(err[0]), *err[1:])
+
+
+def relay(r):
+    """Pass a streamed proxy response through chunk by chunk, without buffering it."""
     try:
-        r = requests.post(
-            f"{PROXY_URL}/query",
-            json=payload,          # includes {"query": "...", "strategy": "..."} but proxy only cares about query + header
-            headers=headers,
-            timeout=15,
-        )
-        return (r.text, r.status_code, {"Content-Type": "application/json"})
-    except requests.RequestException as e:
-        return jsonify({"error": f"Proxy unreachable: {str(e)}"}), 502
+        yield from r.iter_content(chunk_size=None)
+    finally:
+        r.close()
+
+
+def post_to_proxy(path: str, **kwargs):
+    t0 = time.perf_counter()
+    try:
+        return _proxy.post(f"{PROXY_URL}{path}", **kwargs)
+    except requests.RequestException:
+        PROXY_ERRORS.inc(path)
+        raise
+    finally:
+        PROXY_SECONDS.observe(time.perf_counter() - t0, path)
+
+
+def relay_query(path: str, payload: dict, headers: dict, timeout: float) -> tuple:
+    """Forward a non-streamed request: (body, status, headers) as the proxy sent them, body still encoded."""
+    r = post_to_proxy(path, json=payload, headers=headers, timeout=timeout, stream=True)
+    try:
+        body = r.raw.read(decode_content=False)
+    except BaseException:
+        r.close()
+        raise
+    # Fully read: the connection goes back to the pool (r.close() would drop it)
+    r.raw.release_conn()
+    return body, r.status_code, {"Content-Type": "application/json", **relayed_headers(r)}
+
+
+def gated(kind: str, call):
+    """call() once the concurrency gate for `kind` lets the request through."""
+    gate = _gates[kind]
+    reason = gate.enter()
+    if reason:
+        return error(shed(kind, reason))
+    try:
+        return call()
+    except (requests.RequestException, RelayError) as e:
+        return error(proxy_unreachable(e))
+    finally:
+        gate.leave()
+
+
+def forward_stream(payload: dict, headers: dict, kind: str):
+    gate = _gates[kind]
+    reason = gate.enter()
+    if reason:
+        return error(shed(kind, reason))
+    try:
+        r = post_to_proxy("/query", json=payload, headers=headers, timeout=PROXY_TIMEOUT, stream=True)
+    except (requests.RequestException, RelayError) as e:
+        gate.leave()
+        return error(proxy_unreachable(e))
+    resp = Response(relay(r), r.status_code, content_type=r.headers.get("Content-Type", "application/json"))
+    # The slot is held until the stream is over
+    resp.call_on_close(gate.leave)
+    return resp
+
+
+@app.after_request
+def count_response(resp):
+    RESPONSES.inc(request.url_rule.rule if request.url_rule else "other", str(resp.status_code))
+    return resp
+
+
+@app.route("/", methods=["GET"])
+def health():
+    return jsonify({"status": "gatekeeper up", "engine": GATEKEEPER_ENGINE, "proxy": PROXY_URL,
+                    "admission": admission_stats(_gates), "singleflight": _flights.stats()}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(METRICS.render(), 200, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/query", methods=["POST"])
+def query():
+    payload = request.get_json(silent=True) or {}
+    err = check_query(payload)
+    if err:
+        return error(err)
+
+    # Optional strategy forwarded to proxy
+    headers, err = strategy_headers(payload)
+    if err:
+        return error(err)
+
+    kind = query_kind(payload["query"])
+    err = rate_limited(request.remote_addr, kind)
+    if err:
+        return error(err)
+
+    # Forward to proxy: the payload includes {"query": "...", "strategy": "..."} but the proxy
+    # only cares about the query (+ params, session_token, ...) and the strategy header
+    negotiation_headers(headers, request.headers)
+    count_request(headers, kind)
+    if payload.get("stream"):
+        return forward_stream(payload, headers, kind)
+
+    # Writes are never coalesced
+    key = flight_key(payload, headers) if kind == "read" else None
+    flight, leader = _flights.join(key) if key else (None, True)
+    if not leader:
+        flight.done.wait(FLIGHT_WAIT)
+        shared = _flights.result(flight)
+        if shared is not None:
+            return shared
+    result = None
+
+    def call():
+        nonlocal result
+        result = relay_query("/query", payload, headers, PROXY_TIMEOUT)
+        return result
+
+    try:
+        return gated(kind, call)
+    finally:
+        if flight is not None and leader:
+            _flights.land(key, flight, result)
+
+
+@app.route("/query/batch", methods=["POST"])
+def query_batch():
+    payload = request.get_json(silent=True) or {}
+    err = check_batch(payload)
+    if err:
+        return error(err)
+
+    headers, err = strategy_headers(payload)
+    if err:
+        return error(err)
+
+    kind = batch_kind(payload["queries"])
+    err = rate_limited(request.remote_addr, kind)
+    if err:
+        return error(err)
+
+    count_request(headers, "batch")
+    return gated(kind, lambda: relay_query("/query/batch", payload, headers, PROXY_BATCH_TIMEOUT))
+
+
+if __name__ == "__main__":
+    if GATEKEEPER_ENGINE == "asyncio":
+        # gatekeeper_async imports this module by name; hand it this instance, not a second copy
+        sys.modules["gatekeeper"] = sys.modules[__name__]
+        import gatekeeper_async
+        gatekeeper_async.main()
+    else:
+        app.run(host=GATEKEEPER_BIND, port=GATEKEEPER_PORT)
+PY
+
+# ---------
+# asyncio engine (GATEKEEPER_ENGINE=asyncio): same checks, one event loop, pooled forwarding
+# ---------
+cat > "${APP_DIR}/gatekeeper_async.py" <<'PY'
+"""aiohttp engine serving the same /, /metrics, /query and /query/batch as gatekeeper.py.
+
+Validation, the strategy whitelist and metrics come from gatekeeper.py. A
+request waiting on the proxy costs a coroutine, not a thread, and every
+forward reuses a bounded pool of keep-alive connections.
+"""
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+import gatekeeper as core
+
+_session = None
+
+
+def error_response(err) -> web.Response:
+    return web.json_response(err[0], status=err[1], headers=err[2] if len(err) > 2 else None)
+
+
+class AsyncGate(core.Gate):
+    """core.ThreadGate for coroutines."""
+
+    def __init__(self, limit: int, queue: int):
+        super().__init__(limit, queue)
+        self._cond = asyncio.Condition()
+
+    async def enter(self):
+        async with self._cond:
+            if self.in_flight >= self.limit:
+                if self.waiting >= self.queue:
+                    self.queue_full += 1
+                    return "queue_full"
+                self.queued += 1
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self._cond.wait_for(lambda: self.in_flight < self.limit),
+                                           core.ADMISSION_QUEUE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.queue_timeouts += 1
+                    return "queue_timeout"
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            return None
+
+    async def leave(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+
+_gates = {"read": AsyncGate(core.MAX_CONCURRENT_READS, core.MAX_QUEUED_READS),
+          "write": AsyncGate(core.MAX_CONCURRENT_WRITES, core.MAX_QUEUED_WRITES)}
+_flights = core.SingleFlight(asyncio.Event)
+
+
+async def gated(kind: str, call):
+    """await call() once the concurrency gate for `kind` lets the request through."""
+    gate = _gates[kind]
+    reason = await gate.enter()
+    if reason:
+        return error_response(core.shed(kind, reason))
+    try:
+        return await call()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return error_response(core.proxy_unreachable(e))
+    finally:
+        await gate.leave()
+
+
+async def read_payload(request) -> dict:
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    return payload if isinstance(payload, dict) else {}
+
+
+async def _on_startup(app):
+    global _session
+    _session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=core.PROXY_POOL_SIZE, keepalive_timeout=core.PROXY_KEEPALIVE),
+        auto_decompress=False,  # the body is relayed still encoded
+    )
+
+
+async def _on_cleanup(app):
+    await _session.close()
+
+
+def proxy_timeout(read_s: float) -> aiohttp.ClientTimeout:
+    # connect covers the wait for a pooled connection; reads are bounded per chunk, not per response
+    return aiohttp.ClientTimeout(total=None, connect=core.PROXY_POOL_TIMEOUT, sock_read=read_s)
+
+
+@web.middleware
+async def count_response(request, handler):
+    endpoint = getattr(request.match_info.route.resource, "canonical", "other")
+    try:
+        resp = await handler(request)
+    except web.HTTPException as e:
+        core.RESPONSES.inc(endpoint, str(e.status))
+        raise
+    core.RESPONSES.inc(endpoint, str(resp.status))
+    return resp
+
+
+async def health(request):
+    return web.json_response({"status": "gatekeeper up", "engine": core.GATEKEEPER_ENGINE, "proxy": core.PROXY_URL,
+                              "proxy_pool_size": core.PROXY_POOL_SIZE,
+                              "admission": core.admission_stats(_gates), "singleflight": _flights.stats()})
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=core.METRICS.render().encode(), headers={"Content-Type": core.metrics.CONTENT_TYPE})
+
+
+async def open_proxy(path: str, payload: dict, headers: dict, read_s: float):
+    t0 = time.perf_counter()
+    try:
+        return await _session.post(f"{core.PROXY_URL}{path}", json=payload, headers=headers,
+                                   timeout=proxy_timeout(read_s))
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        core.PROXY_ERRORS.inc(path)
+        raise
+    finally:
+        core.PROXY_SECONDS.observe(time.perf_counter() - t0, path)
+
+
+async def relay_query(path: str, payload: dict, headers: dict, read_s: float) -> tuple:
+    """Forward a non-streamed request: (body, status, headers) as the proxy sent them, body still encoded."""
+    r = await open_proxy(path, payload, headers, read_s)
+    try:
+        body = await r.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        core.PROXY_ERRORS.inc(path)
+        raise
+    finally:
+        r.release()
+    return body, r.status, {"Content-Type": "application/json", **core.relayed_headers(r)}
+
+
+def relayed(result: tuple) -> web.Response:
+    body, status, headers = result
+    return web.Response(body=body, status=status, headers=headers)
+
+
+async def relay_stream(request, payload: dict, headers: dict) -> web.StreamResponse:
+    r = await open_proxy("/query", payload, headers, core.PROXY_TIMEOUT)
+    try:
+        resp = web.StreamResponse(status=r.status, headers={
+            "Content-Type": r.headers.get("Content-Type", "application/json")})
+        await resp.prepare(request)
+        try:
+            async for chunk in r.content.iter_any():
+                await resp.write(chunk)
+            await resp.write_eof()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass  # headers are out: the client sees a truncated stream, like with the Flask engine
+        return resp
+    finally:
+        r.release()
+
+
+async def query(request):
+    payload = await read_payload(request)
+    err = core.check_query(payload)
+    if err:
+        return error_response(err)
+    headers, err = core.strategy_headers(payload)
+    if err:
+        return error_response(err)
+
+    kind = core.query_kind(payload["query"])
+    err = core.rate_limited(request.remote, kind)
+    if err:
+        return error_response(err)
+
+    core.negotiation_headers(headers, request.headers)
+    core.count_request(headers, kind)
+    if payload.get("stream"):
+        return await gated(kind, lambda: relay_stream(request, payload, headers))
+
+    key = core.flight_key(payload, headers) if kind == "read" else None
+    flight, leader = _flights.join(key) if key else (None, True)
+    if not leader:
+        try:
+            await asyncio.wait_for(flight.done.wait(), core.FLIGHT_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        shared = _flights.result(flight)
+        if shared is not None:
+            return relayed(shared)
+    result = None
+
+    async def call():
+        nonlocal result
+        result = await relay_query("/query", payload, headers, core.PROXY_TIMEOUT)
+        return relayed(result)
+
+    try:
+        return await gated(kind, call)
+    finally:
+        if flight is not None and leader:
+            _flights.land(key, flight, result)
+
+
+async def query_batch(request):
+    payload = await read_payload(request)
+    err = core.check_batch(payload)
+    if err:
+        return error_response(err)
+    headers, err = core.strategy_headers(payload)
+    if err:
+        return error_response(err)
+
+    kind = core.batch_kind(payload["queries"])
+    err = core.rate_limited(request.remote, kind)
+    if err:
+        return error_response(err)
+
+    core.count_request(headers, "batch")
+
+    async def call():
+        return relayed(await relay_query("/query/batch", payload, headers, core.PROXY_BATCH_TIMEOUT))
+
+    return await gated(kind, call)
+
+
+def main():
+    app = web.Application(middlewares=[count_response])
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_post("/query", query)
+    app.router.add_post("/query/batch", query_batch)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    web.run_app(app, host=core.GATEKEEPER_BIND, port=core.GATEKEEPER_PORT, access_log=None)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080)
+    main()
 PY
 
 chown -R ubuntu:ubuntu "${APP_DIR}"
-chmod +x "${APP_DIR}/gatekeeper.py"
+chmod +x "${APP_DIR}/gatekeeper.py" "${APP_DIR}/gatekeeper_async.py"
 
 # systemd service
 cat > /etc/systemd/system/gatekeeper.service <<EOF
@@ -93,6 +830,16 @@ After=network.target
 [Service]
 User=ubuntu
 WorkingDirectory=${APP_DIR}
+Environment=GATEKEEPER_ENGINE=${GATEKEEPER_ENGINE}
+Environment=PROXY_URL=${PROXY_URL}
+Environment=GATEKEEPER_PORT=${PORT}
+Environment=PROXY_POOL_SIZE=${PROXY_POOL_SIZE}
+Environment=READ_RATE_LIMIT=${READ_RATE_LIMIT}
+Environment=WRITE_RATE_LIMIT=${WRITE_RATE_LIMIT}
+Environment=MAX_CONCURRENT_READS=${MAX_CONCURRENT_READS}
+Environment=MAX_QUEUED_READS=${MAX_QUEUED_READS}
+Environment=MAX_CONCURRENT_WRITES=${MAX_CONCURRENT_WRITES}
+Environment=MAX_QUEUED_WRITES=${MAX_QUEUED_WRITES}
 ExecStart=${VENV_DIR}/bin/python ${APP_DIR}/gatekeeper.py
 Restart=always
 
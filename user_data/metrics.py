@@ -0,0 +1,144 @@
+"""Prometheus text-format metrics shared by the gatekeeper and the proxy.
+
+Counters, gauges and fixed-bucket histograms, nothing else. A labelled series
+is created the first time its label values are seen and then updated in place
+under its own lock, so recording costs a dict lookup, a bisect and a couple of
+adds: cheap enough to leave on in production.
+"""
+from bisect import bisect_left
+from threading import Lock
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, 0.5 ms .. 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(v) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return str(v) if isinstance(v, int) else repr(float(v))
+
+
+class _Series:
+    __slots__ = ("lock", "value", "counts", "sum")
+
+    def __init__(self, buckets: int = 0):
+        self.lock = Lock()
+        self.value = 0
+        self.counts = [0] * buckets
+        self.sum = 0.0
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        self._series = {}  # label values -> _Series
+
+    def _new(self) -> _Series:
+        return _Series()
+
+    def series(self, values: tuple) -> _Series:
+        s = self._series.get(values)
+        if s is None:
+            with self._lock:
+                s = self._series.setdefault(values, self._new())
+        return s
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _samples(self, values: tuple, s: _Series) -> list:
+        return [f"{self.name}{self._labels(values)} {_number(s.value)}"]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self._series.items(), key=lambda kv: tuple(map(str, kv[0])))
+        for values, s in series:
+            lines.extend(self._samples(values, s))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n=1):
+        s = self.series(labels)
+        with s.lock:
+            s.value += n
+
+    def set(self, value, *labels):
+        """Mirror a running total kept elsewhere (pool stats, breakers), at scrape time."""
+        self.series(labels).value = value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        self.series(labels).value = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new(self) -> _Series:
+        # Last slot counts observations above the largest bound
+        return _Series(len(self.buckets) + 1)
+
+    def observe(self, value: float, *labels):
+        s = self.series(labels)
+        i = bisect_left(self.buckets, value)
+        with s.lock:
+            s.counts[i] += 1
+            s.sum += value
+
+    def _samples(self, values: tuple, s: _Series) -> list:
+        with s.lock:
+            counts, total = list(s.counts), s.sum
+        out, cum = [], 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cum += n
+            le = 'le="%s"' % _number(bound)
+            out.append(f"{self.name}_bucket{self._labels(values, le)} {cum}")
+        out.append(f"{self.name}_sum{self._labels(values)} {_number(total)}")
+        out.append(f"{self.name}_count{self._labels(values)} {cum}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames=()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        return "\n".join(line for m in self._metrics for line in m.render()) + "\n"
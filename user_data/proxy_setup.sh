@@ -19,6 +19,32 @@ DB_PASS="Password123"
 
 PROXY_PORT="5000"
 
+# Per-backend MySQL connection pool
+POOL_MIN_SIZE="2"
+POOL_MAX_SIZE="16"
+POOL_IDLE_TIMEOUT="60"
+POOL_BORROW_TIMEOUT="5"
+
+# HTTP engine: "flask" (threaded dev server) or "asyncio" (aiohttp + aiomysql)
+PROXY_ENGINE="flask"
+# HTTP worker processes; > 1 pre-forks them (e.g. "$(nproc)"), probes still run once
+PROXY_PROCESSES="1"
+# Pre-fork mode: worker i also listens on PROXY_STATS_PORT + i; scrape /metrics and
+# /stats/queries there, once per worker (on PROXY_PORT they come from whichever worker accepts)
+PROXY_STATS_PORT="5001"
+
+# Merge concurrent literal single-row INSERTs into multi-row INSERTs on the master (0 = off)
+WRITE_COALESCE_MS="0"
+WRITE_COALESCE_MAX_ROWS="100"
+
+# Backend timeouts (s) and per-backend circuit breaker
+DB_CONNECT_TIMEOUT="1.0"
+DB_READ_TIMEOUT="10"
+READ_RETRIES="2"
+BREAKER_FAILURES="3"
+BREAKER_OPEN_S="2.0"
+BREAKER_MAX_OPEN_S="30.0"
+
 # ---------
 # Packages
 # ---------
@@ -37,25 +63,79 @@ chown -R ubuntu:ubuntu "${PROXY_DIR}"
 # ---------
 sudo -u ubuntu python3 -m venv "${VENV_DIR}"
 "${VENV_DIR}/bin/pip" install --upgrade pip
-"${VENV_DIR}/bin/pip" install flask mysql-connector-python
+"${VENV_DIR}/bin/pip" install flask mysql-connector-python aiohttp aiomysql msgpack zstandard
 
 # ---------
 # Write proxy app
 # ---------
+# SQL classifier shared with the gatekeeper (user_data/sqlclass.py, inlined at launch)
+cat > "${PROXY_DIR}/sqlclass.py" <<'PY'
+#@include sqlclass.py
+PY
+
+# Prometheus metrics shared with the gatekeeper (user_data/metrics.py)
+cat > "${PROXY_DIR}/metrics.py" <<'PY'
+#@include metrics.py
+PY
+
 cat > "${PROXY_DIR}/proxy.py" <<'PY'
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import mysql.connector
-from threading import Lock
+from mysql.connector import errors as mysql_errors
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import date
+from functools import lru_cache
+from itertools import chain
+from threading import Condition, Event, Lock, Thread
+import json
+import math
+import multiprocessing
+import multiprocessing.connection
 import os
 import random
+import re
+import sys
 import time
 import socket
+import zlib
+from werkzeug.http import http_date
+from werkzeug.serving import make_server
+import gzip
+
+import metrics
+import sqlclass
+
+try:
+    import msgpack
+except ImportError:  # optional: the format is then not offered
+    msgpack = None
+try:
+    import zstandard
+except ImportError:  # optional: responses fall back to gzip
+    zstandard = None
 
 app = Flask(__name__)
 
+PROXY_ENGINE = os.getenv("PROXY_ENGINE", "flask").strip().lower()
+# > 1: pre-fork mode, this many HTTP worker processes plus one process running the probers
+PROXY_PROCESSES = int(os.getenv("PROXY_PROCESSES", "1"))
+# Pre-fork mode: worker i also listens on PROXY_STATS_PORT + i. Metrics and query stats
+# are per process, so they are scraped there, one target per worker
+PROXY_STATS_PORT = int(os.getenv("PROXY_STATS_PORT", "5001"))
+# How often pre-forked workers pick up the probers' latest routing table (s)
+ROUTING_FOLLOW_INTERVAL = float(os.getenv("ROUTING_FOLLOW_INTERVAL", "0.05"))
+
+# HTTP listen address
+PROXY_BIND = os.getenv("PROXY_BIND", "0.0.0.0")
+PROXY_PORT = int(os.getenv("PROXY_PORT", "5000"))
+
 # Defaults (can be overridden by systemd Environment=...)
+# Backends are "host" or "host:port" (several MySQL servers on one box); DB_PORT otherwise
 MASTER_HOST = os.getenv("MASTER_HOST", "10.0.3.10")
 WORKER_HOSTS = [h.strip() for h in os.getenv("WORKER_HOSTS", "10.0.3.11,10.0.3.12").split(",") if h.strip()]
+DB_PORT = int(os.getenv("DB_PORT", "3306"))
 
 DB_NAME = os.getenv("DB_NAME", "sakila")
 DB_USER = os.getenv("DB_USER", "admin")
@@ -63,23 +143,744 @@ DB_PASS = os.getenv("DB_PASS", "Password123")
 
 # Default strategy if no header override
 DEFAULT_STRATEGY = os.getenv("PROXY_STRATEGY", "round_robin").strip().lower()
+# Known to choose_target(); anything else is routed round robin
+STRATEGIES = frozenset({"direct", "random", "latency", "round_robin", "lag_aware", "p2c", "hedged"})
+
+# Background prober (routing never probes inside a request)
+PROBE_INTERVAL = float(os.getenv("PROBE_INTERVAL", "1.0"))
+PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", "0.5"))
+PROBE_EWMA_ALPHA = float(os.getenv("PROBE_EWMA_ALPHA", "0.3"))
+# Consecutive failed probes before a host is marked down
+PROBE_DOWN_AFTER = int(os.getenv("PROBE_DOWN_AFTER", "2"))
+
+# p2c strategy: smoothing of the per-host query service time it balances on
+SERVICE_EWMA_ALPHA = float(os.getenv("SERVICE_EWMA_ALPHA", "0.2"))
+# ... and how fast an idle host's estimate fades (half-life, s), so a host that was slow gets retried
+SERVICE_HALF_LIFE = float(os.getenv("SERVICE_HALF_LIFE", "5.0"))
+
+# lag_aware strategy: replicas further behind than this are skipped (0 bytes = no byte bound)
+MAX_REPLICA_LAG = float(os.getenv("MAX_REPLICA_LAG", "1.0"))
+MAX_REPLICA_LAG_BYTES = int(os.getenv("MAX_REPLICA_LAG_BYTES", "0"))
+
+# hedged strategy: a read still running after HEDGE_PERCENTILE of its host's last HEDGE_WINDOW
+# read times is duplicated on another replica (or the master); the first answer wins
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MIN_MS = float(os.getenv("HEDGE_MIN_MS", "2.0"))
+# ... until a host has HEDGE_MIN_SAMPLES read times, hedge after HEDGE_DEFAULT_MS
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_DEFAULT_MS = float(os.getenv("HEDGE_DEFAULT_MS", "50.0"))
+# Budget: each hedged-strategy read earns HEDGE_BUDGET_RATIO of a duplicate, banked up to
+# HEDGE_BUDGET_BURST, so hedging adds at most ~HEDGE_BUDGET_RATIO extra reads
+HEDGE_BUDGET_RATIO = float(os.getenv("HEDGE_BUDGET_RATIO", "0.05"))
+HEDGE_BUDGET_BURST = float(os.getenv("HEDGE_BUDGET_BURST", "10"))
+
+# Read-your-writes: how long a replica may be given to catch up with a session token
+RYW_WAIT_TIMEOUT = float(os.getenv("RYW_WAIT_TIMEOUT", "0.1"))
+
+# SELECT result cache (RESULT_CACHE_MAX_BYTES=0 disables it)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "5.0"))
+# Replica results for a table written less than this long ago are not cached (replication lag)
+RESULT_CACHE_WRITE_FENCE = float(os.getenv("RESULT_CACHE_WRITE_FENCE", "1.0"))
+
+# /query/batch. Statements run in order on one connection: all-read batches on the replica
+# the strategy picks, batches with any write (or transaction: true) on the master
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+
+# Write coalescing: literal (unparameterized) single-row INSERTs into the same table and
+# columns arriving within this window are sent to the master as one multi-row INSERT (0 disables it)
+WRITE_COALESCE_MS = float(os.getenv("WRITE_COALESCE_MS", "0"))
+WRITE_COALESCE_MAX_ROWS = int(os.getenv("WRITE_COALESCE_MAX_ROWS", "100"))
+
+# "stream": true reads are sent as NDJSON, this many rows per chunk
+STREAM_CHUNK_ROWS = int(os.getenv("STREAM_CHUNK_ROWS", "500"))
+
+# "params" queries run as server-side prepared statements, this many kept per pooled connection (LRU)
+PREPARED_CACHE_SIZE = int(os.getenv("PREPARED_CACHE_SIZE", "64"))
+
+# /stats/queries: per-fingerprint statement stats, kept for at most this many fingerprints
+# (the least recently seen one is evicted to make room)
+QUERY_STATS_MAX = int(os.getenv("QUERY_STATS_MAX", "1000"))
+
+# /query response formats, picked from the Accept header (JSON row objects stay the default):
+# column names once, then one array per row, as JSON or MessagePack
+COLUMNAR_JSON = "application/vnd.proxy.columnar+json"
+MSGPACK = "application/x-msgpack"
+# Responses are compressed (Accept-Encoding: zstd or gzip) from this size up
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))
+
+# Backend timeouts (s). DB_READ_TIMEOUT bounds each wait for a statement's result.
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "1.0"))
+DB_READ_TIMEOUT = int(os.getenv("DB_READ_TIMEOUT", "10"))
+# Failed reads are retried on another replica, then the master, this many times
+READ_RETRIES = int(os.getenv("READ_RETRIES", "2"))
+
+# Circuit breaker per backend: opens after BREAKER_FAILURES consecutive connection/timeout
+# failures, for BREAKER_OPEN_S doubling up to BREAKER_MAX_OPEN_S while trials keep failing
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+BREAKER_OPEN_S = float(os.getenv("BREAKER_OPEN_S", "2.0"))
+BREAKER_MAX_OPEN_S = float(os.getenv("BREAKER_MAX_OPEN_S", "30.0"))
+BREAKER_TRIAL_INTERVAL = float(os.getenv("BREAKER_TRIAL_INTERVAL", "1.0"))
+
+# Connection pool (one per backend host)
+POOL_MIN_SIZE = int(os.getenv("POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.getenv("POOL_MAX_SIZE", "16"))
+POOL_IDLE_TIMEOUT = float(os.getenv("POOL_IDLE_TIMEOUT", "60.0"))
+POOL_BORROW_TIMEOUT = float(os.getenv("POOL_BORROW_TIMEOUT", "5.0"))
+# Connections idle for longer than this are pinged before being handed out
+POOL_PING_AFTER = float(os.getenv("POOL_PING_AFTER", "1.0"))
+
+
+class RoundRobinIndex:
+    """Cursor of the round-robin strategies; share() moves it to shared memory so workers take turns."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._value = 0
+        self._shared = None
+
+    def share(self, ctx):
+        self._shared = ctx.Value("Q", self._value)
+
+    def next(self, n: int) -> int:
+        if self._shared is not None:
+            with self._shared.get_lock():
+                i = self._shared.value % n
+                self._shared.value = (i + 1) % n
+            return i
+        with self._lock:
+            i = self._value % n
+            self._value = (i + 1) % n
+        return i
+
+
+_rr_index = RoundRobinIndex()
+
+# Per-host probe results, written only by the prober threads
+_health = {
+    h: {"up": True, "connect_ms": None, "rtt_ms": None, "failures": 0, "checked_at": 0.0,
+        "lag_s": None, "lag_bytes": None, "replication": None}
+    for h in dict.fromkeys([MASTER_HOST, *WORKER_HOSTS])
+}
+# Precomputed from _health after every probe; replaced wholesale so readers never lock
+_routing = {
+    "up_workers": list(WORKER_HOSTS),
+    "best_worker": WORKER_HOSTS[0] if WORKER_HOSTS else None,
+    "fresh_workers": [],
+}
+_routing_lock = Lock()
+# Per-host in-flight queries and decayed service time, fed by the queries themselves
+_load = {h: {"in_flight": 0, "service_ms": None, "completed": 0, "updated_at": 0.0} for h in _health}
+_load_lock = Lock()
+# Parsed Executed_Gtid_Set per replica (kept out of _health so it stays JSON-friendly)
+_gtid_executed = {}
+
+# /metrics. Request labels are bounded: unknown strategies are reported as "other".
+METRICS = metrics.Registry()
+REQUESTS = METRICS.counter("proxy_requests_total", "Queries received, by strategy and kind (read/write/batch).",
+                           ("strategy", "kind"))
+RESPONSES = METRICS.counter("proxy_responses_total", "HTTP responses sent, by endpoint and status code.",
+                            ("endpoint", "code"))
+BACKEND_SECONDS = METRICS.histogram("proxy_backend_seconds",
+                                    "Proxy -> MySQL time per call (a batch or merged INSERT counts once).", ("host",))
+BACKEND_ERRORS = METRICS.counter("proxy_backend_errors_total",
+                                 "Failed backend calls: rejected by the server or lost/timed out connection.",
+                                 ("host", "type"))
+PROBE_SECONDS = METRICS.histogram("proxy_probe_rtt_seconds", "Background SELECT 1 round trip.", ("host",))
+PROBES = METRICS.counter("proxy_probes_total", "Background probes, by result.", ("host", "result"))
+ROUTING_REFRESHES = METRICS.counter("proxy_routing_refreshes_total",
+                                    "Recomputations of the latency/health routing table.")
+POOL_CONNECTIONS = METRICS.gauge("proxy_pool_connections", "Pooled connections, by state.", ("host", "state"))
+POOL_WAITING = METRICS.gauge("proxy_pool_waiting", "Requests waiting for a pooled connection.", ("host",))
+POOL_TIMEOUTS = METRICS.counter("proxy_pool_timeouts_total", "Borrows that gave up after POOL_BORROW_TIMEOUT.",
+                                ("host",))
+BREAKER_OPEN = METRICS.gauge("proxy_breaker_open", "1 while the backend's circuit breaker is not closed.", ("host",))
+BREAKER_TRIPS = METRICS.counter("proxy_breaker_trips_total", "Times the circuit breaker opened.", ("host",))
+CACHE_LOOKUPS = METRICS.counter("proxy_result_cache_lookups_total", "Result cache lookups, by result.", ("result",))
+HEDGE_EVENTS = METRICS.counter("proxy_hedge_events_total",
+                               "hedged strategy: copies sent, copies that won, copies denied by the budget, kills.",
+                               ("event",))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+def json_default(o):
+    # Same conventions as Flask's jsonify so every response format agrees
+    if isinstance(o, date):
+        return http_date(o)
+    return str(o)
+
+
+def ndjson(obj) -> str:
+    return json.dumps(obj, default=json_default) + "\n"
+
+
+def negotiate(accept: str, accept_encoding: str) -> tuple:
+    """(media type, content coding or None) for a /query response."""
+    accept = (accept or "").lower()
+    if msgpack is not None and MSGPACK in accept:
+        fmt = MSGPACK
+    elif COLUMNAR_JSON in accept:
+        fmt = COLUMNAR_JSON
+    else:
+        fmt = "application/json"
+    accepted = set()
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, q = part.partition(";")
+        q = q.replace(" ", "")
+        try:
+            weight = float(q[2:]) if q.startswith("q=") else 1.0
+        except ValueError:
+            weight = 1.0
+        if weight > 0:
+            accepted.add(name.strip())
+    if zstandard is not None and "zstd" in accepted:
+        return fmt, "zstd"
+    return fmt, "gzip" if "gzip" in accepted else None
+
+
+def columnar(out: dict) -> dict:
+    """`out` with a list-of-rows result turned into {"columns": [...], "rows": [[...], ...]}."""
+    res = out.get("result")
+    if not isinstance(res, list):
+        return out
+    return {**out, "result": {"columns": list(res[0]) if res else [], "rows": [list(r.values()) for r in res]}}
+
+
+def server_timing(t0: float) -> str:
+    return f"encode;dur={(time.perf_counter() - t0) * 1000.0:.3f}"
+
+
+def encode_response(out: dict, fmt: str, coding) -> tuple:
+    """(body, headers) of a successful /query response in a negotiated format."""
+    t0 = time.perf_counter()
+    if fmt == MSGPACK:
+        body = msgpack.packb(columnar(out), default=json_default)
+    else:
+        body = json.dumps(columnar(out) if fmt == COLUMNAR_JSON else out,
+                          default=json_default, separators=(",", ":")).encode()
+    headers = {"Content-Type": fmt, "Vary": "Accept, Accept-Encoding"}
+    if coding and len(body) >= COMPRESS_MIN_BYTES:
+        if coding == "zstd":
+            body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+        else:
+            body = gzip.compress(body, GZIP_LEVEL)
+        headers["Content-Encoding"] = coding
+    headers["Server-Timing"] = server_timing(t0)
+    return body, headers
+
+
+def is_server_error(e: BaseException) -> bool:
+    """True for an error the MySQL server returned for a statement: the session is still usable.
+
+    Client-side errors (CR_* codes 2000-2999, timeouts, broken sockets) mean it may not be.
+    Works for both mysql-connector (errno) and PyMySQL (args[0]) exceptions.
+    """
+    code = _error_code(e)
+    return code is not None and code > 0 and not 2000 <= code < 3000
+
+
+def _error_code(e: BaseException):
+    if isinstance(e, BatchAborted):
+        # The statement's own error: the transaction was rolled back and the session is fine
+        e = e.cause
+    code = getattr(e, "errno", None)
+    if code is None and getattr(e, "args", None) and isinstance(e.args[0], int):
+        code = e.args[0]
+    return code if isinstance(code, int) else None
+
+
+def is_backend_failure(e: BaseException) -> bool:
+    """Could not talk to the backend (connect/read failure, timeout): counts against its breaker.
+
+    Any driver error that did not come from the server counts, e.g. "Connection not available".
+    """
+    code = _error_code(e)
+    return (code is not None and not is_server_error(e)) or isinstance(e, (OSError, TimeoutError, PoolTimeout))
+
+
+class _Cell:
+    """Attribute kept in slot `index` of the owner's _cells (a list, or an Array in shared memory)."""
+
+    def __init__(self, index: int, kind=float):
+        self.index = index
+        self.kind = kind
+
+    def __get__(self, obj, owner=None):
+        return self.kind(obj._cells[self.index])
+
+    def __set__(self, obj, value):
+        obj._cells[self.index] = value
+
+
+_BREAKER_STATES = ("closed", "open", "half_open")
+
+
+class CircuitBreaker:
+    """closed -> open after BREAKER_FAILURES consecutive backend failures.
+
+    Once the backoff has passed it is half_open: one trial request per
+    BREAKER_TRIAL_INTERVAL is let through. A success closes it; a failure
+    reopens it with the backoff doubled.
+    """
+
+    _state = _Cell(0, int)
+    failures = _Cell(1, int)
+    trips = _Cell(2, int)
+    backoff = _Cell(3)
+    retry_at = _Cell(4)  # time.monotonic(), which is system-wide
+
+    def __init__(self):
+        self._lock = Lock()
+        self._cells = [0, 0, 0, BREAKER_OPEN_S, 0.0]
+
+    def share(self, ctx):
+        """Move the state to shared memory (before forking) so all worker processes trip together."""
+        self._cells = ctx.Array("d", self._cells, lock=False)
+        self._lock = ctx.Lock()
+
+    @property
+    def state(self) -> str:
+        return _BREAKER_STATES[self._state]
+
+    @state.setter
+    def state(self, value: str):
+        self._state = _BREAKER_STATES.index(value)
+
+    def allows(self) -> bool:
+        """Whether available() would let a request through, without taking the half-open trial."""
+        return self.state == "closed" or time.monotonic() >= self.retry_at
+
+    def available(self) -> bool:
+        """allows(), and when half open, take the trial: call it only for the host the request goes to."""
+        if self.state == "closed":
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open" and now >= self.retry_at:
+                self.state = "half_open"
+            if self.state == "half_open" and now >= self.retry_at:
+                self.retry_at = now + BREAKER_TRIAL_INTERVAL
+                return True
+            return self.state == "closed"
+
+    def success(self):
+        if self.state == "closed" and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state != "closed":
+                self.state = "closed"
+                self.backoff = BREAKER_OPEN_S
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "open" or (self.state == "closed" and self.failures < BREAKER_FAILURES):
+                return
+            if self.state == "half_open":
+                self.backoff = min(self.backoff * 2, BREAKER_MAX_OPEN_S)
+            self.state = "open"
+            self.trips += 1
+            self.retry_at = time.monotonic() + self.backoff
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "state": "half_open" if self.state == "open" and now >= self.retry_at else self.state,
+                "failures": self.failures,
+                "trips": self.trips,
+                "backoff_s": self.backoff,
+                "retry_in_s": round(max(self.retry_at - now, 0.0), 3) if self.state != "closed" else 0.0,
+            }
+
+
+_breakers = {h: CircuitBreaker() for h in _health}
+
+
+def parse_session_token(payload: dict):
+    """Returns (session token or None, error message or None); an empty token starts a session."""
+    token = payload.get("session_token") or None
+    if token is None:
+        return None, None
+    if not isinstance(token, str):
+        return None, "session_token must be a string"
+    try:
+        parse_gtid_set(token)
+    except ValueError:
+        return None, "session_token is not a GTID set returned by this proxy"
+    return token, None
+
+
+def parse_params(payload: dict):
+    """Returns (params tuple or None, error message or None). Placeholders in the query are %s."""
+    params = payload.get("params")
+    if params is None:
+        return None, None
+    if not isinstance(params, list) or not all(p is None or isinstance(p, (str, int, float)) for p in params):
+        return None, "params must be a list of strings, numbers or nulls"
+    return tuple(params), None
+
+
+class BatchAborted(Exception):
+    """A statement failed inside a transactional batch; the transaction was rolled back."""
+
+    def __init__(self, index: int, cause: Exception):
+        super().__init__(f"statement {index}: {cause}")
+        self.index = index
+        self.cause = cause
+
+
+class ConnectionPool:
+    """Bounded pool of autocommit connections to a single MySQL host."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self._cond = Condition(Lock())
+        self._idle = deque()  # (conn, last_used), most recently used on the right
+        self._size = 0        # idle + borrowed
+        self._waiting = 0
+        self._borrows = 0
+        self._timeouts = 0
+        self._wait_total_ms = 0.0
+        self._wait_max_ms = 0.0
+        self._prepares = 0
+        self._stmt_reuses = 0
+
+    def _connect(self):
+        host, port = backend_address(self.host)
+        return mysql.connector.connect(
+            host=host,
+            port=port,
+            user=DB_USER,
+            password=DB_PASS,
+            database=DB_NAME,
+            autocommit=True,
+            connection_timeout=DB_CONNECT_TIMEOUT,
+            read_timeout=DB_READ_TIMEOUT,
+        )
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self, now: float) -> list:
+        # Lock held. Oldest idle connections sit on the left.
+        stale = []
+        while (self._idle and self._size > POOL_MIN_SIZE
+               and now - self._idle[0][1] > POOL_IDLE_TIMEOUT):
+            stale.append(self._idle.popleft()[0])
+            self._size -= 1
+        return stale
+
+    def acquire(self):
+        t0 = time.perf_counter()
+        deadline = t0 + POOL_BORROW_TIMEOUT
+        while True:
+            conn, last_used = None, 0.0
+            with self._cond:
+                stale = self._evict_idle(time.time())
+                while not self._idle and self._size >= POOL_MAX_SIZE:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f"no connection to {self.host} available within {POOL_BORROW_TIMEOUT}s")
+                    self._waiting += 1
+                    self._cond.wait(remaining)
+                    self._waiting -= 1
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+            for c in stale:
+                self._close(c)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+            elif time.time() - last_used > POOL_PING_AFTER and not conn.is_connected():
+                # Liveness check failed: drop it and try the next one
+                self._close(conn)
+                self._forget()
+                continue
+
+            waited_ms = (time.perf_counter() - t0) * 1000.0
+            with self._cond:
+                self._borrows += 1
+                self._wait_total_ms += waited_ms
+                self._wait_max_ms = max(self._wait_max_ms, waited_ms)
+            return conn
+
+    def _forget(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def release(self, conn, discard: bool = False):
+        if discard:
+            self._close(conn)
+            self._forget()
+            return
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        breaker = _breakers[self.host]
+        try:
+            conn = self.acquire()
+        except Exception as e:
+            if is_backend_failure(e):
+                breaker.failure()
+            raise
+        try:
+            yield conn
+        except BaseException as e:
+            # A statement rejected by the server leaves the session usable; anything else may not
+            self.release(conn, discard=not is_server_error(e))
+            if is_backend_failure(e):
+                breaker.failure()
+            elif is_server_error(e):
+                breaker.success()
+            raise
+        else:
+            self.release(conn)
+            breaker.success()
+
+    def prepared(self, conn, sql: str):
+        """(sql, cursor) with `sql` prepared on the server, kept on `conn` across borrows.
+
+        Execute the returned sql, not the caller's copy: the cursor only skips
+        re-preparing when it is handed the very same string object.
+        """
+        stmts = getattr(conn, "_proxy_statements", None)
+        if stmts is None:
+            stmts = conn._proxy_statements = OrderedDict()
+        entry = stmts.get(sql)
+        if entry is not None:
+            stmts.move_to_end(sql)
+        else:
+            entry = stmts[sql] = (sql, conn.cursor(prepared=True, dictionary=True))
+            while len(stmts) > PREPARED_CACHE_SIZE:
+                # Closing the cursor deallocates the statement on the server
+                self._close(stmts.popitem(last=False)[1][1])
+        with self._cond:
+            if entry[1]._executed is entry[0]:
+                self._stmt_reuses += 1
+            else:
+                self._prepares += 1
+        return entry
+
+    def unprepare(self, conn, sql: str):
+        entry = getattr(conn, "_proxy_statements", {}).pop(sql, None)
+        if entry is not None:
+            self._close(entry[1])
+
+    def fill(self):
+        """Open connections up to POOL_MIN_SIZE (best effort)."""
+        while True:
+            with self._cond:
+                if self._size >= POOL_MIN_SIZE:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                self._forget()
+                return
+            self.release(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "waiting": self._waiting,
+                "borrows": self._borrows,
+                "timeouts": self._timeouts,
+                "avg_wait_ms": round(self._wait_total_ms / self._borrows, 3) if self._borrows else 0.0,
+                "max_wait_ms": round(self._wait_max_ms, 3),
+                "prepares": self._prepares,
+                "stmt_reuses": self._stmt_reuses,
+            }
+
+
+_pools = {h: ConnectionPool(h) for h in dict.fromkeys([MASTER_HOST, *WORKER_HOSTS])}
+
+
+def warm_pools():
+    for p in _pools.values():
+        p.fill()
+
+
+def normalize_sql(sql: str) -> str:
+    """Result cache key: only the edges are trimmed, inner whitespace may be inside a string literal."""
+    return (sql or "").strip().rstrip(";").rstrip()
+
 
-# Latency picker cache (avoid probing each request)
-LATENCY_CACHE_TTL = float(os.getenv("LATENCY_CACHE_TTL", "2.0"))
+@lru_cache(maxsize=sqlclass.CLASSIFY_CACHE_SIZE)
+def touched_tables(sql: str) -> frozenset:
+    """'db.table' names a statement reads or writes; empty when the classifier cannot vouch for them.
 
-_rr_lock = Lock()
-_worker_index = 0
+    Empty makes ResultCache.invalidate() drop everything, so a write whose tables
+    were misread costs the whole cache instead of leaving stale entries behind.
+    """
+    info = sqlclass.classify(sql)
+    if not info.tables_known:
+        return frozenset()
+    return frozenset(t if "." in t else f"{DB_NAME.lower()}.{t}" for t in info.tables)
 
-_latency_cache = {"ts": 0.0, "host": None}
+
+class ResultCache:
+    """Byte-bounded LRU of SELECT results with a TTL and per-table invalidation.
+
+    A write bumps the generation of the tables it touches, and an entry is only
+    served while the generations it was cached under are current. share() moves
+    the generations to shared memory, so in pre-fork mode a write handled by one
+    worker also invalidates the results the other workers hold.
+    """
+
+    # Tables hash into this many generation slots; a collision only costs extra misses
+    SLOTS = 4096
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, size, tables, host, result, generation)
+        self._by_table = {}            # table -> set of keys
+        self._generation = [0] * self.SLOTS      # slot -> bumped on every write to its tables
+        self._written_at = [-1e9] * self.SLOTS   # slot -> time.monotonic() of the last write
+        self._generation_lock = Lock()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def share(self, ctx):
+        """Move the generations to shared memory (before forking)."""
+        self._generation = ctx.Array("Q", self._generation, lock=False)
+        self._written_at = ctx.Array("d", self._written_at, lock=False)
+        self._generation_lock = ctx.Lock()
+
+    @staticmethod
+    @lru_cache(maxsize=sqlclass.CLASSIFY_CACHE_SIZE)
+    def _slot(table: str) -> int:
+        return zlib.crc32(table.encode()) % ResultCache.SLOTS
+
+    def generation(self, tables: frozenset) -> tuple:
+        return tuple(self._generation[self._slot(t)] for t in sorted(tables)) + (self._generation[self._slot("*")],)
+
+    def get(self, key):
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None or e[0] < time.monotonic() or self.generation(e[2]) != e[5]:
+                if e is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return e[3], e[4]
+
+    def put(self, key, tables: frozenset, generation: tuple, host: str, result):
+        size = len(json.dumps(result, default=str))
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            # A write raced with this read: its result may already be stale
+            if self.generation(tables) != generation:
+                return
+            if host != MASTER_HOST and any(now - self._written_at[self._slot(t)] < RESULT_CACHE_WRITE_FENCE
+                                           for t in tables | {"*"}):
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (now + self.ttl, size, tables, host, result, generation)
+            self._bytes += size
+            for t in tables:
+                self._by_table.setdefault(t, set()).add(key)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, size, tables, _, _, _ = self._entries.pop(key)
+        self._bytes -= size
+        for t in tables:
+            keys = self._by_table.get(t)
+            if keys:
+                keys.discard(key)
+
+    def invalidate(self, tables: frozenset):
+        now = time.monotonic()
+        with self._lock:
+            if not tables:
+                # Write on tables we could not identify: drop everything
+                tables = frozenset(self._by_table)
+                self._bump("*", now)
+            for t in tables:
+                self._bump(t, now)
+                for key in list(self._by_table.pop(t, ())):
+                    if key in self._entries:
+                        self._drop(key)
+                        self.invalidations += 1
+
+    def _bump(self, table: str, now: float):
+        i = self._slot(table)
+        with self._generation_lock:
+            self._generation[i] += 1
+            self._written_at[i] = now
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+
+def is_cacheable(sql: str) -> bool:
+    info = sqlclass.classify(sql)
+    return (RESULT_CACHE_MAX_BYTES > 0 and info.verbs == ("select",) and not info.write
+            and info.deterministic and info.tables_known)
 
 
 def is_write_query(sql: str) -> bool:
-    s = (sql or "").strip().lower()
-    # Consider these as reads:
-    if s.startswith(("select", "show", "describe", "explain")):
-        return False
-    # Everything else treated as write:
-    return True
+    # CTEs and parenthesised SELECTs are reads; locking reads and SELECT ... INTO are not
+    return sqlclass.classify(sql).write
+
+
+def backend_address(host: str) -> tuple:
+    """("host", port) of a MASTER_HOST / WORKER_HOSTS entry."""
+    name, sep, port = host.rpartition(":")
+    return (name, int(port)) if sep and port.isdigit() else (host, DB_PORT)
 
 
 def tcp_latency_ms(host: str, port: int = 3306, timeout: float = 0.5) -> float:
@@ -93,37 +894,607 @@ def tcp_latency_ms(host: str, port: int = 3306, timeout: float = 0.5) -> float:
         return float("inf")
 
 
+_GTID_UUID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.I)
+
+
+@lru_cache(maxsize=1024)
+def parse_gtid_set(gtids: str) -> dict:
+    """'uuid:1-5:7,uuid2:1-3' -> {uuid: ((1, 5), (7, 7)), uuid2: ((1, 3),)}; ValueError if malformed."""
+    out = {}
+    for part in (gtids or "").replace("\n", "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        uuid, *ranges = part.split(":")
+        if not _GTID_UUID_RE.match(uuid.strip()) or not ranges:
+            raise ValueError(f"bad GTID set {part!r}")
+        ivs = list(out.get(uuid.strip().lower(), ()))
+        for r in ranges:
+            a, _, b = r.partition("-")
+            a, b = int(a), int(b or a)
+            if not 0 < a <= b:
+                raise ValueError(f"bad GTID interval {r!r}")
+            ivs.append((a, b))
+        out[uuid.strip().lower()] = tuple(ivs)
+    return out
+
+
+def gtid_subset(want: dict, have: dict) -> bool:
+    # gtid_executed intervals are merged, so each wanted interval must fit inside a single one
+    for uuid, ivs in want.items():
+        got = have.get(uuid, ())
+        for a, b in ivs:
+            if not any(x <= a and b <= y for x, y in got):
+                return False
+    return True
+
+
+def _ewma(prev, sample: float, alpha: float = PROBE_EWMA_ALPHA) -> float:
+    if prev is None:
+        return sample
+    return alpha * sample + (1.0 - alpha) * prev
+
+
+def _score(h: str) -> float:
+    st = _health[h]
+    ms = st["rtt_ms"] if st["rtt_ms"] is not None else st["connect_ms"]
+    return ms if ms is not None else float("inf")
+
+
+def _lag_bytes(h: str):
+    """Bytes of master binlog the replica has not executed yet (same binlog file only)."""
+    master = _health[MASTER_HOST]["replication"]
+    repl = _health[h]["replication"]
+    if not master or not repl or repl.get("relay_master_log_file") != master.get("file"):
+        return None
+    return max(0, master["pos"] - repl["exec_master_log_pos"])
+
+
+def _is_fresh(h: str) -> bool:
+    if h == MASTER_HOST:
+        return True
+    st = _health[h]
+    if st["lag_s"] is None or st["lag_s"] > MAX_REPLICA_LAG:
+        return False
+    if MAX_REPLICA_LAG_BYTES and (st["lag_bytes"] is None or st["lag_bytes"] > MAX_REPLICA_LAG_BYTES):
+        return False
+    return True
+
+
+def _refresh_routing():
+    ROUTING_REFRESHES.inc()
+    with _routing_lock:
+        for h in WORKER_HOSTS:
+            if h != MASTER_HOST:
+                _health[h]["lag_bytes"] = _lag_bytes(h)
+        up = [h for h in WORKER_HOSTS if _health[h]["up"]]
+        best = min(up, key=_score) if up else None
+        fresh = [h for h in up if _is_fresh(h)]
+        _routing.update(up_workers=up, best_worker=best, fresh_workers=fresh)
+    if _snapshot is not None:
+        _snapshot.publish()
+
+
+class RoutingSnapshot:
+    """Pre-fork mode: the probers' process publishes _health/_routing, HTTP workers follow it."""
+
+    SIZE = 256 * 1024
+
+    def __init__(self, ctx):
+        self._buf = ctx.Array("c", self.SIZE, lock=False)
+        self._version = ctx.Value("Q", 0)  # its lock also guards _buf
+
+    def publish(self):
+        with _routing_lock:
+            data = json.dumps({"health": _health, "routing": _routing}, default=str).encode()
+        if len(data) >= self.SIZE:
+            return
+        with self._version.get_lock():
+            self._buf.value = data
+            self._version.value += 1
+
+    def follow(self):
+        seen = 0
+        while True:
+            with self._version.get_lock():
+                version = self._version.value
+                data = self._buf.value if version != seen else None
+            if data:
+                seen = version
+                snap = json.loads(data)
+                for h, st in snap["health"].items():
+                    _health[h].update(st)
+                    repl = st.get("replication") or {}
+                    if "executed_gtid_set" in repl:
+                        _gtid_executed[h] = parse_gtid_set(repl["executed_gtid_set"])
+                with _routing_lock:
+                    _routing.update(snap["routing"])
+            time.sleep(ROUTING_FOLLOW_INTERVAL)
+
+
+_snapshot = None
+
+
+class HostProber(Thread):
+    """Measures one backend forever: TCP connect time plus SELECT 1 round trip."""
+
+    def __init__(self, host: str):
+        super().__init__(name=f"probe-{host}", daemon=True)
+        self.host = host
+        self._conn = None
+
+    def _select_one_ms(self) -> float:
+        if self._conn is None:
+            # Pure-Python driver so PROBE_TIMEOUT also bounds reads, not just the connect
+            host, port = backend_address(self.host)
+            self._conn = mysql.connector.connect(
+                host=host,
+                port=port,
+                user=DB_USER,
+                password=DB_PASS,
+                connection_timeout=PROBE_TIMEOUT,
+                use_pure=True,
+            )
+        t0 = time.perf_counter()
+        cur = self._conn.cursor()
+        try:
+            cur.execute("SELECT 1")
+            cur.fetchall()
+        finally:
+            cur.close()
+        return (time.perf_counter() - t0) * 1000.0
+
+    def _replication_status(self) -> dict:
+        cur = self._conn.cursor(dictionary=True)
+        try:
+            if self.host == MASTER_HOST:
+                cur.execute("SHOW MASTER STATUS")
+                rows = cur.fetchall()
+                return {"file": rows[0]["File"], "pos": rows[0]["Position"]} if rows else None
+            cur.execute("SHOW SLAVE STATUS")
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+        if not rows:
+            return None
+        r = rows[0]
+        return {
+            "seconds_behind_master": r["Seconds_Behind_Master"],
+            "master_log_file": r["Master_Log_File"],
+            "read_master_log_pos": r["Read_Master_Log_Pos"],
+            "relay_master_log_file": r["Relay_Master_Log_File"],
+            "exec_master_log_pos": r["Exec_Master_Log_Pos"],
+            "relay_log_file": r["Relay_Log_File"],
+            "relay_log_pos": r["Relay_Log_Pos"],
+            "executed_gtid_set": r.get("Executed_Gtid_Set") or "",
+        }
+
+    def probe(self):
+        st = _health[self.host]
+        connect_ms = tcp_latency_ms(*backend_address(self.host), timeout=PROBE_TIMEOUT)
+        rtt_ms = None
+        if connect_ms != float("inf"):
+            try:
+                rtt_ms = self._select_one_ms()
+                repl = self._replication_status()
+                st["replication"] = repl
+                # NULL Seconds_Behind_Master (replication stopped) or no replica status -> unknown lag
+                st["lag_s"] = repl.get("seconds_behind_master") if repl and self.host != MASTER_HOST else None
+                if repl and "executed_gtid_set" in repl:
+                    _gtid_executed[self.host] = parse_gtid_set(repl["executed_gtid_set"])
+            except Exception:
+                if self._conn is not None:
+                    ConnectionPool._close(self._conn)
+                self._conn = None
+
+        PROBES.inc(self.host, "fail" if rtt_ms is None else "ok")
+        if rtt_ms is None:
+            st["failures"] += 1
+            if st["failures"] >= PROBE_DOWN_AFTER:
+                st["up"] = False
+        else:
+            PROBE_SECONDS.observe(rtt_ms / 1000.0, self.host)
+            st["connect_ms"] = _ewma(st["connect_ms"], connect_ms)
+            st["rtt_ms"] = _ewma(st["rtt_ms"], rtt_ms)
+            st["failures"] = 0
+            st["up"] = True
+        st["checked_at"] = time.time()
+        _refresh_routing()
+
+    def run(self):
+        while True:
+            t0 = time.monotonic()
+            self.probe()
+            time.sleep(max(0.0, PROBE_INTERVAL - (time.monotonic() - t0)))
+
+
+def start_probers():
+    for h in _health:
+        HostProber(h).start()
+
+
+def start_routing():
+    """Probe the backends, or in a pre-forked worker follow the probers' process."""
+    if _snapshot is not None:
+        Thread(target=_snapshot.follow, name="routing-follower", daemon=True).start()
+    else:
+        start_probers()
+
+
+def _run_probers():
+    start_probers()
+    Event().wait()
+
+
+def serve_prefork(n: int, serve):
+    """Run `serve(sock, stats_sock)` in n worker processes sharing one listening socket, and the probers in one more.
+
+    Routing stays process-wide: the round-robin cursor and the circuit breakers
+    live in shared memory, and the workers follow the probers' routing table.
+    Each worker keeps its own result cache, but the table generations that
+    invalidate it are shared, so a write through any worker is seen by all.
+    Metrics and query stats stay per process: worker i also listens on its own
+    stats_sock (PROXY_STATS_PORT + i), which is what monitoring should scrape.
+    This process only forks and restarts children, so it never forks with threads running.
+    """
+    global _snapshot
+    ctx = multiprocessing.get_context("fork")
+    _rr_index.share(ctx)
+    for b in _breakers.values():
+        b.share(ctx)
+    _cache.share(ctx)
+    _snapshot = RoutingSnapshot(ctx)
+    sock = socket.create_server((PROXY_BIND, PROXY_PORT), backlog=1024)
+    sock.set_inheritable(True)
+    # Bound here so a restarted worker gets its port back
+    stats_socks = [socket.create_server((PROXY_BIND, PROXY_STATS_PORT + i)) for i in range(n)]
+
+    children = {}
+
+    def spawn(name: str, target, *args):
+        p = ctx.Process(target=target, args=args, name=name)
+        p.start()
+        children[p.sentinel] = (p, target, args)
+
+    spawn("probers", _run_probers)
+    for i in range(n):
+        spawn(f"worker-{i}", serve, sock, stats_socks[i])
+    while True:
+        for sentinel in multiprocessing.connection.wait(list(children)):
+            p, target, args = children.pop(sentinel)
+            p.join()
+            print(f"[PROXY] {p.name} exited with {p.exitcode}, restarting", file=sys.stderr, flush=True)
+            time.sleep(1.0)
+            spawn(p.name, target, *args)
+
+
+@contextmanager
+def track_load(host: str, statements: int = 1, sql: str = None, read: bool = False):
+    """Count a query as in flight on `host`, then fold its time (per statement) into service_ms.
+
+    With `sql`, the time and the row count the caller stores in the yielded dict
+    also go to that statement's fingerprint in /stats/queries. Only a plain `read`
+    feeds the hedge delay: writes are never hedged and would skew it.
+    """
+    with _load_lock:
+        _load[host]["in_flight"] += 1
+    sample = {"rows": 0}
+    failed = True
+    t0 = time.perf_counter()
+    try:
+        yield sample
+        failed = False
+    except Exception as e:
+        # Not the backend's doing (e.g. a streaming client that went away): no backend error
+        if is_server_error(e) or is_backend_failure(e):
+            BACKEND_ERRORS.inc(host, "server" if is_server_error(e) else "connection")
+        raise
+    else:
+        if read:
+            _hedging.observe(host, (time.perf_counter() - t0) * 1000.0)
+    finally:
+        elapsed = time.perf_counter() - t0
+        BACKEND_SECONDS.observe(elapsed, host)
+        if sql is not None:
+            _query_stats.record(sql, host, elapsed * 1000.0, sample["rows"], failed)
+        ms = elapsed * 1000.0 / max(statements, 1)
+        with _load_lock:
+            st = _load[host]
+            st["in_flight"] -= 1
+            st["completed"] += 1
+            st["service_ms"] = _ewma(st["service_ms"], ms, SERVICE_EWMA_ALPHA)
+            st["updated_at"] = time.monotonic()
+
+
+def result_rows(out) -> int:
+    """Rows a statement returned, or for a write the rows it affected."""
+    return len(out) if isinstance(out, list) else out.get("affected_rows", 0)
+
+
+# Latency sketch: bucket k > 0 holds times in [SKETCH_MIN_MS * SKETCH_GROWTH^(k-1), ... ^k),
+# so a percentile read back from it is within ~5% of the true value
+SKETCH_MIN_MS = 0.01
+SKETCH_GROWTH = 1.1
+SKETCH_BUCKETS = 200  # up to ~30 min; the last bucket takes anything slower
+_SKETCH_LOG = math.log(SKETCH_GROWTH)
+
+
+def sketch_bucket(ms: float) -> int:
+    if ms <= SKETCH_MIN_MS:
+        return 0
+    return min(int(math.log(ms / SKETCH_MIN_MS) / _SKETCH_LOG) + 1, SKETCH_BUCKETS - 1)
+
+
+def sketch_value(k: int) -> float:
+    """Geometric middle of bucket k."""
+    return SKETCH_MIN_MS * SKETCH_GROWTH ** (k - 0.5) if k else SKETCH_MIN_MS
+
+
+class FingerprintStats:
+    __slots__ = ("text", "count", "errors", "total_ms", "min_ms", "max_ms", "rows", "hosts", "sketch")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.count = self.errors = self.rows = 0
+        self.total_ms = self.max_ms = 0.0
+        self.min_ms = None
+        self.hosts = {}    # host -> statements run there
+        self.sketch = {}   # sketch bucket -> count (sparse: at most SKETCH_BUCKETS keys)
+
+    def percentile(self, p: float) -> float:
+        rank, seen = p / 100.0 * self.count, 0
+        for k in sorted(self.sketch):
+            seen += self.sketch[k]
+            if seen >= rank:
+                return min(max(sketch_value(k), self.min_ms), self.max_ms)
+        return self.max_ms
+
+    def summary(self) -> dict:
+        ok = self.count - self.errors
+        return {
+            "fingerprint": self.text,
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3),
+            "min_ms": round(self.min_ms, 3),
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": round(self.percentile(50), 3),
+            "p95_ms": round(self.percentile(95), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "rows": self.rows,
+            "avg_rows": round(self.rows / ok, 2) if ok else 0.0,
+            "hosts": dict(self.hosts),
+        }
+
+
+class QueryStats:
+    """Aggregates per statement fingerprint (sqlclass.fingerprint) for /stats/queries.
+
+    Recording is a memoized fingerprint lookup plus a few adds under one lock.
+    Memory is bounded: at most `max_entries` fingerprints, each with a sparse
+    sketch of at most SKETCH_BUCKETS counts; past that the least recently seen
+    fingerprint is dropped.
+    """
+
+    ORDERS = ("total_ms", "count", "avg_ms", "max_ms", "p99_ms", "rows", "errors")
+
+    def __init__(self, max_entries: int = QUERY_STATS_MAX):
+        self.max_entries = max(1, max_entries)
+        self._lock = Lock()
+        self._entries = OrderedDict()  # fingerprint -> FingerprintStats, least recently seen first
+        self.evicted = 0
+        self.since = time.time()
+
+    def record(self, sql: str, host: str, ms: float, rows: int = 0, error: bool = False):
+        fp = sqlclass.fingerprint(sql)
+        k = sketch_bucket(ms)
+        with self._lock:
+            st = self._entries.get(fp)
+            if st is None:
+                st = self._entries[fp] = FingerprintStats(fp)
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._entries.move_to_end(fp)
+            st.count += 1
+            st.total_ms += ms
+            st.max_ms = max(st.max_ms, ms)
+            st.min_ms = ms if st.min_ms is None else min(st.min_ms, ms)
+            st.hosts[host] = st.hosts.get(host, 0) + 1
+            st.sketch[k] = st.sketch.get(k, 0) + 1
+            if error:
+                st.errors += 1
+            else:
+                st.rows += rows
+
+    def top(self, n: int = 20, order: str = "total_ms") -> dict:
+        with self._lock:
+            summaries = [st.summary() for st in self._entries.values()]
+        total_ms = sum(s["total_ms"] for s in summaries)
+        for s in summaries:
+            s["time_pct"] = round(100.0 * s["total_ms"] / total_ms, 2) if total_ms else 0.0
+        summaries.sort(key=lambda s: s[order], reverse=True)
+        return {**self.stats(), "order": order, "total_ms": round(total_ms, 3), "queries": summaries[:n]}
+
+    def stats(self) -> dict:
+        return {"fingerprints": len(self._entries), "max_fingerprints": self.max_entries,
+                "evicted": self.evicted, "since": self.since}
+
+
+_query_stats = QueryStats()
+
+
+def parse_top(args) -> tuple:
+    """(n, order, error message or None) from /stats/queries?n=&order= query arguments."""
+    order = args.get("order", "total_ms")
+    if order not in QueryStats.ORDERS:
+        return None, None, f"order must be one of: {', '.join(QueryStats.ORDERS)}"
+    try:
+        n = int(args.get("n", "20"))
+    except ValueError:
+        return None, None, "n must be an integer"
+    if n < 1:
+        return None, None, "n must be positive"
+    return n, order, None
+
+
+class HedgePolicy:
+    """When to hedge a read (rolling per-host percentile) and whether the budget allows it."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._samples = {h: deque(maxlen=HEDGE_WINDOW) for h in _health}
+        self._threshold = dict.fromkeys(_health)
+        self._new = dict.fromkeys(_health, 0)  # samples since _threshold was computed
+        self._tokens = HEDGE_BUDGET_BURST
+        self.reads = self.hedges = self.wins = self.denied = self.kills = 0
+
+    def observe(self, host: str, ms: float):
+        with self._lock:
+            self._samples[host].append(ms)
+            self._new[host] += 1
+
+    def threshold_s(self, host: str) -> float:
+        with self._lock:
+            window = self._samples[host]
+            if len(window) < HEDGE_MIN_SAMPLES:
+                return HEDGE_DEFAULT_MS / 1000.0
+            # Re-sorted every HEDGE_MIN_SAMPLES reads, not on every call
+            if self._threshold[host] is None or self._new[host] >= HEDGE_MIN_SAMPLES:
+                ordered = sorted(window)
+                k = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100.0))
+                self._threshold[host] = max(ordered[k], HEDGE_MIN_MS)
+                self._new[host] = 0
+            return self._threshold[host] / 1000.0
+
+    def admit(self):
+        with self._lock:
+            self.reads += 1
+            self._tokens = min(self._tokens + HEDGE_BUDGET_RATIO, HEDGE_BUDGET_BURST)
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1.0:
+                self.denied += 1
+                return False
+            self._tokens -= 1.0
+            self.hedges += 1
+            return True
+
+    def record(self, hedge_won: bool = False, killed: bool = False):
+        with self._lock:
+            self.wins += hedge_won
+            self.kills += killed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "percentile": HEDGE_PERCENTILE,
+                "budget_ratio": HEDGE_BUDGET_RATIO,
+                "tokens": round(self._tokens, 2),
+                "reads": self.reads,
+                "hedges": self.hedges,
+                "hedge_wins": self.wins,
+                "denied": self.denied,
+                "kills": self.kills,
+                "threshold_ms": {h: round(t, 3) if t is not None else None for h, t in self._threshold.items()},
+            }
+
+
+_hedging = HedgePolicy()
+
+
+class ReadAttempt:
+    """One copy of a hedged read. conn_id is set while its statement may be running on host."""
+
+    def __init__(self, host: str, lock=None):
+        self.host = host
+        self.conn_id = None
+        self.lock = lock or Lock()  # held by whoever kills the statement, and before the connection is reused
+
+
+@contextmanager
+def killable(attempt, conn_id: int):
+    """Expose the connection id to kill_query() while the statement runs."""
+    if attempt is None:
+        yield
+        return
+    attempt.conn_id = conn_id
+    try:
+        yield
+    finally:
+        # Waits for a KILL QUERY in flight, so it can never hit the connection's next user
+        with attempt.lock:
+            attempt.conn_id = None
+
+
+def hedge_host(host: str, error, session: bool = False):
+    """Where to send the copy of a read on `host`, or None.
+
+    `error` is the first attempt's exception, None while it is still running.
+    A copy of a slow read needs budget; a retry after a connection failure does not.
+    """
+    if error is not None and not is_backend_failure(error):
+        return None
+    alt = failover_host([host], session)
+    if alt is None or (error is None and not _hedging.spend()):
+        return None
+    return alt
+
+
+def _expected_ms(h: str) -> tuple:
+    # Time a new query would take if it queued behind the ones in flight; unmeasured hosts go first
+    st = _load[h]
+    decay = 0.5 ** ((time.monotonic() - st["updated_at"]) / SERVICE_HALF_LIFE)
+    return (st["in_flight"] + 1) * (st["service_ms"] or 0.0) * decay, st["in_flight"]
+
+
+def _available(hosts: list) -> list:
+    # Drop replicas whose circuit breaker is open; a half-open one stays a candidate, unclaimed
+    return [h for h in hosts if _breakers[h].allows()]
+
+
+def _claim(hosts: list, choose) -> str:
+    """choose(candidates) among the available `hosts`, taking the breaker trial for the chosen one only.
+
+    A candidate whose trial a concurrent request took first is dropped and the
+    choice made again; the master when none is left.
+    """
+    up = _available(hosts)
+    while up:
+        h = choose(up)
+        if _breakers[h].available():
+            return h
+        up.remove(h)
+    return MASTER_HOST
+
+
 def pick_worker_round_robin() -> str:
-    global _worker_index
-    with _rr_lock:
-        h = WORKER_HOSTS[_worker_index]
-        _worker_index = (_worker_index + 1) % len(WORKER_HOSTS)
-    return h
+    return _claim(_routing["up_workers"], lambda up: up[_rr_index.next(len(up))])
 
 
 def pick_worker_random() -> str:
-    return random.choice(WORKER_HOSTS)
+    return _claim(_routing["up_workers"], random.choice)
 
 
 def pick_worker_latency() -> str:
-    now = time.time()
-    if _latency_cache["host"] and (now - _latency_cache["ts"] < LATENCY_CACHE_TTL):
-        return _latency_cache["host"]
+    best = _routing["best_worker"]
+    if best and _breakers[best].available():
+        return best
+    return _claim(_routing["up_workers"], lambda up: min(up, key=_score))
 
-    best_host = None
-    best_ms = float("inf")
-    for h in WORKER_HOSTS:
-        ms = tcp_latency_ms(h)
-        if ms < best_ms:
-            best_ms = ms
-            best_host = h
 
-    if not best_host:
-        best_host = WORKER_HOSTS[0]
+def pick_worker_p2c() -> str:
+    """Power of two choices: the less loaded of two random up replicas."""
+    return _claim(_routing["up_workers"],
+                  lambda up: min(random.sample(up, 2) if len(up) > 2 else up, key=_expected_ms))
 
-    _latency_cache["ts"] = now
-    _latency_cache["host"] = best_host
-    return best_host
+
+def pick_worker_lag_aware() -> str:
+    """Round robin over replicas within the lag bound; master only when all are too stale."""
+    return _claim(_routing["fresh_workers"], lambda fresh: fresh[_rr_index.next(len(fresh))])
 
 
 def choose_target(sql: str, strategy: str) -> str:
@@ -140,41 +1511,569 @@ def choose_target(sql: str, strategy: str) -> str:
         return pick_worker_latency()
     if strategy == "round_robin":
         return pick_worker_round_robin()
+    if strategy == "lag_aware":
+        return pick_worker_lag_aware()
+    if strategy == "p2c":
+        return pick_worker_p2c()
+    if strategy == "hedged":
+        # Tail latency is handled by the copy hedged_read() may send
+        return pick_worker_round_robin()
 
     # fallback
     return pick_worker_round_robin()
 
 
-def execute_query(host: str, sql: str):
-    conn = mysql.connector.connect(
-        host=host,
-        user=DB_USER,
-        password=DB_PASS,
-        database=DB_NAME,
-        autocommit=True,
-    )
-    cur = conn.cursor(dictionary=True)
-    cur.execute(sql)
+def master_gtid_executed() -> str:
+    """Session token handed out after a write: every GTID the master has committed so far."""
+    with _pools[MASTER_HOST].connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT @@GLOBAL.gtid_executed")
+            return (cur.fetchone()[0] or "").replace("\n", "")
+        finally:
+            cur.close()
+
+
+def wait_for_gtid(host: str, token: str) -> bool:
+    try:
+        with _pools[host].connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT WAIT_FOR_EXECUTED_GTID_SET(%s, %s)", (token, RYW_WAIT_TIMEOUT))
+                return cur.fetchone()[0] == 0
+            finally:
+                cur.close()
+    except Exception:
+        return False
+
+
+def replica_with_gtid(target: str, token: str):
+    """`target` if it is known to have applied `token`, else any up replica that has, else None.
+
+    `target` came from choose_target(), which already checked its breaker; another
+    replica must pass its own, taking the half-open trial only if it is picked.
+    """
+    want = parse_gtid_set(token)
+    if gtid_subset(want, _gtid_executed.get(target, {})):
+        return target
+    for h in _available(_routing["up_workers"]):
+        if h != target and gtid_subset(want, _gtid_executed.get(h, {})) and _breakers[h].available():
+            return h
+    return None
+
+
+def route_for_session(target: str, token: str) -> str:
+    """Keep a read on a replica that has applied `token`, else briefly wait, else use the master."""
+    if target == MASTER_HOST:
+        return target
+    h = replica_with_gtid(target, token)
+    if h:
+        return h
+    if RYW_WAIT_TIMEOUT > 0 and wait_for_gtid(target, token):
+        return target
+    return MASTER_HOST
+
+
+def failover_host(tried: list, session: bool = False):
+    """Next host for a read that failed on every host in `tried`: another replica, then the master.
+
+    Session reads go straight to the master, the only host certain to have their writes.
+    """
+    if not session:
+        for h in _available(_routing["up_workers"]):
+            if h not in tried and _breakers[h].available():
+                return h
+    return MASTER_HOST if MASTER_HOST not in tried else None
 
-    if cur.with_rows:
-        out = cur.fetchall()
-    else:
-        out = {"affected_rows": cur.rowcount}
 
-    cur.close()
-    conn.close()
+def check_available(host: str):
+    if not _breakers[host].available():
+        raise BackendUnavailable(f"{host} is unavailable (circuit open)")
+
+
+def read_query(host: str, sql: str, params=None, session: bool = False):
+    """execute_query() for reads, retried elsewhere on connection failures. Returns (host, result)."""
+    tried = [host]
+    while True:
+        try:
+            return host, execute_query(host, sql, params)
+        except Exception as e:
+            nxt = failover_host(tried, session) if len(tried) <= READ_RETRIES and is_backend_failure(e) else None
+            if nxt is None:
+                raise
+            host = nxt
+            tried.append(host)
+
+
+_hedge_pool = ThreadPoolExecutor(POOL_MAX_SIZE * len(_health), thread_name_prefix="hedge")
+
+
+def kill_query(attempt: ReadAttempt):
+    with attempt.lock:
+        if attempt.conn_id is None:
+            return
+        try:
+            with _pools[attempt.host].connection() as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute("KILL QUERY %s", (attempt.conn_id,))
+                finally:
+                    cur.close()
+        except Exception:
+            return
+    _hedging.record(killed=True)
+
+
+def hedged_read(host: str, sql: str, params=None, session: bool = False):
+    """read_query() that sends a copy elsewhere if `host` is slower than usual. Returns (host, result).
+
+    The first successful answer wins and the other statement is killed.
+    """
+    _hedging.admit()
+    attempts = {}
+
+    def launch(h: str):
+        a = ReadAttempt(h)
+        attempts[_hedge_pool.submit(execute_query, h, sql, params, a)] = a
+
+    launch(host)
+    first = next(iter(attempts))
+    done, _ = wait(attempts, timeout=_hedging.threshold_s(host))
+    if not done or first.exception() is not None:
+        alt = hedge_host(host, first.exception() if done else None, session)
+        if alt:
+            launch(alt)
+    pending, error = set(attempts), None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            if f.exception() is None:
+                for p in pending:
+                    _hedge_pool.submit(kill_query, attempts[p])
+                _hedging.record(hedge_won=f is not first)
+                return attempts[f].host, f.result()
+            error = error or f.exception()
+    raise error
+
+
+def cached_read(host: str, sql: str, params=None, hedge: bool = False):
+    """Serve a SELECT from the result cache, filling it on a miss. Returns (host, result, hit)."""
+    key = (DB_NAME, normalize_sql(sql), params)
+    hit = _cache.get(key)
+    if hit is not None:
+        return hit[0], hit[1], True
+    tables = touched_tables(sql)
+    gen = _cache.generation(tables)
+    host, res = (hedged_read if hedge else read_query)(host, sql, params)
+    _cache.put(key, tables, gen, host, res)
+    return host, res, False
+
+
+def execute_prepared(pool: ConnectionPool, conn, sql: str, params: tuple):
+    stmt, cur = pool.prepared(conn, sql)
+    try:
+        cur.execute(stmt, params)
+        return cur.fetchall() if cur.with_rows else {"affected_rows": cur.rowcount}
+    except BaseException:
+        pool.unprepare(conn, sql)
+        raise
+
+
+def execute_query(host: str, sql: str, params=None, attempt=None):
+    pool = _pools[host]
+    with track_load(host, sql=sql, read=not is_write_query(sql)) as sample, pool.connection() as conn, killable(attempt, conn.connection_id):
+        if params is not None:
+            out = execute_prepared(pool, conn, sql, params)
+        else:
+            cur = conn.cursor(dictionary=True)
+            try:
+                cur.execute(sql)
+                if cur.with_rows:
+                    out = cur.fetchall()
+                else:
+                    out = {"affected_rows": cur.rowcount}
+            finally:
+                cur.close()
+        sample["rows"] = result_rows(out)
     return out
 
 
-@app.route("/", methods=["GET"])
-def health():
-    return jsonify({
+_INSERT_ROW_RE = re.compile(
+    r"^\s*insert\s+into\s+(`?[\w$]+`?(?:\s*\.\s*`?[\w$]+`?)?)\s*(\([^()]*\))\s*values?\s*(\(.*\))\s*;?\s*$",
+    re.I | re.S,
+)
+
+
+def coalesce_parts(sql: str, params):
+    """(group key, "INSERT INTO t (cols) VALUES ", row) for a plain single-row INSERT, else None.
+
+    Parameterized INSERTs are never merged: their placeholders (%s, %(name)s, %%, or one
+    inside a string literal) cannot be counted reliably, and they run as prepared
+    statements, which a merged INSERT of varying size is not.
+    """
+    if params is not None:
+        return None
+    m = _INSERT_ROW_RE.match(sql)
+    if not m or sqlclass.classify(sql).verbs != ("insert",):
+        return None
+    row = m.group(3).strip()
+    if re.search(r"--|#|/\*", row):
+        return None  # a trailing comment would swallow the rows merged after it
+    # Exactly one tuple: the paren it opens closes at the very end (ON DUPLICATE KEY ..., a second row: no)
+    d, depth = sqlclass.digest(row), 0
+    for k, ch in enumerate(d):
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth == 0 and k != len(d) - 1:
+                return None
+    if depth:
+        return None
+    table, cols = (re.sub(r"[\s`]", "", g).lower() for g in m.group(1, 2))
+    return (table, cols), f"INSERT INTO {m.group(1)} {m.group(2)} VALUES ", row
+
+
+class CoalesceGroup:
+    def __init__(self, prefix: str, full, done):
+        self.prefix = prefix
+        self.entries = []      # (sql, params, row) per caller
+        self.results = None    # result or exception per caller, set by the leader
+        self.full = full
+        self.done = done
+
+    def merged(self) -> str:
+        return self.prefix + ", ".join(row for _, _, row in self.entries)
+
+    def shares(self, affected: int) -> list:
+        # The server reports one count for the whole INSERT: each caller's affected_rows
+        # of 1 is derived from its single row, "coalesced" carries the server's real total
+        coalesced = {"rows": len(self.entries), "affected_rows": affected}
+        return [{"affected_rows": 1, "coalesced": coalesced} for _ in self.entries]
+
+    def result(self, slot: int):
+        res = self.results[slot] if self.results is not None else RuntimeError("coalesced write was not run")
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+class WriteCoalescer:
+    """Groups compatible single-row INSERTs; the engines run the groups.
+
+    The first caller of a group is its leader: it waits out WRITE_COALESCE_MS (or
+    until WRITE_COALESCE_MAX_ROWS callers joined) and runs one multi-row INSERT
+    for everyone, through the same plain cursor a lone literal INSERT uses. If the
+    server rejects it, each row is retried on its own so every caller still gets
+    its own result or error.
+    """
+
+    def __init__(self, event=Event):
+        self._event = event    # threading.Event or asyncio.Event
+        self._lock = Lock()
+        self._open = {}        # key -> group still accepting rows
+        self.batches = self.rows = self.fallbacks = 0
+
+    def join(self, sql: str, params, parts):
+        """Returns (group, slot, leader)."""
+        key, prefix, row = parts
+        with self._lock:
+            group = self._open.get(key)
+            leader = group is None
+            if leader:
+                group = self._open[key] = CoalesceGroup(prefix, self._event(), self._event())
+            group.entries.append((sql, params, row))
+            if len(group.entries) >= WRITE_COALESCE_MAX_ROWS:
+                del self._open[key]
+                group.full.set()
+        return group, len(group.entries) - 1, leader
+
+    def close(self, key, group: CoalesceGroup):
+        # Stop accepting rows, unless the group already filled up and a new one took the key
+        with self._lock:
+            if self._open.get(key) is group:
+                del self._open[key]
+
+    def record(self, rows: int, fallback: bool):
+        with self._lock:
+            self.batches += 1
+            self.rows += rows
+            self.fallbacks += fallback
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "window_ms": WRITE_COALESCE_MS,
+                "max_rows": WRITE_COALESCE_MAX_ROWS,
+                "batches": self.batches,
+                "rows": self.rows,
+                "avg_rows": round(self.rows / self.batches, 2) if self.batches else 0.0,
+                "fallbacks": self.fallbacks,
+            }
+
+
+_coalescer = WriteCoalescer()
+
+
+def run_coalesced(group: CoalesceGroup) -> list:
+    n = len(group.entries)
+    if n > 1:
+        sql = group.merged()
+        try:
+            with track_load(MASTER_HOST, n, sql) as sample, _pools[MASTER_HOST].connection() as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute(sql)
+                    sample["rows"] = affected = cur.rowcount
+                finally:
+                    cur.close()
+            _coalescer.record(n, False)
+            return group.shares(affected)
+        except Exception as e:
+            # Lost connection: the INSERT may or may not have committed, so it is not retried
+            if not is_server_error(e):
+                return [e] * n
+    out = []
+    for sql, params, _ in group.entries:
+        try:
+            out.append(execute_query(MASTER_HOST, sql, params))
+        except Exception as e:
+            out.append(e)
+    _coalescer.record(n, n > 1)
+    return out
+
+
+def coalesced_write(sql: str, params, parts):
+    group, slot, leader = _coalescer.join(sql, params, parts)
+    if leader:
+        try:
+            group.full.wait(WRITE_COALESCE_MS / 1000.0)
+            _coalescer.close(parts[0], group)
+            group.results = run_coalesced(group)
+        finally:
+            group.done.set()
+    else:
+        group.done.wait()
+    return group.result(slot)
+
+
+def status() -> dict:
+    return {
         "status": "proxy up",
+        "engine": PROXY_ENGINE,
+        "processes": PROXY_PROCESSES,
+        "pid": os.getpid(),
         "default_strategy": DEFAULT_STRATEGY,
         "master": MASTER_HOST,
         "workers": WORKER_HOSTS,
-        "latency_cache_ttl": LATENCY_CACHE_TTL,
-    }), 200
+        "probe_interval": PROBE_INTERVAL,
+        "pool": {
+            "min_size": POOL_MIN_SIZE,
+            "max_size": POOL_MAX_SIZE,
+            "idle_timeout": POOL_IDLE_TIMEOUT,
+            "borrow_timeout": POOL_BORROW_TIMEOUT,
+        },
+        "pools": {h: p.stats() for h, p in _pools.items()},
+        "backends": _health,
+        "up_workers": _routing["up_workers"],
+        "best_worker": _routing["best_worker"],
+        "max_replica_lag": MAX_REPLICA_LAG,
+        "replica_lag": {h: {"seconds": _health[h]["lag_s"], "bytes": _health[h]["lag_bytes"]}
+                        for h in WORKER_HOSTS},
+        "fresh_workers": _routing["fresh_workers"],
+        "ryw_wait_timeout": RYW_WAIT_TIMEOUT,
+        "load": {h: {"in_flight": st["in_flight"], "completed": st["completed"],
+                     "service_ms": round(st["service_ms"], 3) if st["service_ms"] is not None else None}
+                 for h, st in _load.items()},
+        "result_cache": _cache.stats(),
+        "prepared_cache_size": PREPARED_CACHE_SIZE,
+        "timeouts": {"connect_s": DB_CONNECT_TIMEOUT, "read_s": DB_READ_TIMEOUT, "read_retries": READ_RETRIES},
+        "breakers": {h: b.stats() for h, b in _breakers.items()},
+        "classifier": sqlclass.cache_stats(),
+        "write_coalescing": _coalescer.stats(),
+        "hedging": _hedging.stats(),
+        "query_stats": _query_stats.stats(),
+    }
+
+
+def strategy_label(strategy: str) -> str:
+    return strategy if strategy in STRATEGIES else "other"
+
+
+def render_metrics(pools: dict) -> str:
+    """Prometheus text for /metrics; `pools` is {host: stats()} of the serving engine's pools."""
+    for h, st in pools.items():
+        POOL_CONNECTIONS.set(st["idle"], h, "idle")
+        POOL_CONNECTIONS.set(st["in_use"], h, "in_use")
+        POOL_WAITING.set(st["waiting"], h)
+        POOL_TIMEOUTS.set(st["timeouts"], h)
+    for h, b in _breakers.items():
+        st = b.stats()
+        BREAKER_OPEN.set(int(st["state"] != "closed"), h)
+        BREAKER_TRIPS.set(st["trips"], h)
+    cache = _cache.stats()
+    CACHE_LOOKUPS.set(cache["hits"], "hit")
+    CACHE_LOOKUPS.set(cache["misses"], "miss")
+    hedging = _hedging.stats()
+    for event, key in (("sent", "hedges"), ("won", "hedge_wins"), ("denied", "denied"), ("killed", "kills")):
+        HEDGE_EVENTS.set(hedging[key], event)
+    return METRICS.render()
+
+
+def parse_batch(payload: dict):
+    """Returns (queries, transaction, error message or None)."""
+    queries = payload.get("queries")
+    if not isinstance(queries, list) or not queries:
+        return None, False, "Missing field: queries (non-empty list)"
+    if len(queries) > MAX_BATCH_SIZE:
+        return None, False, f"Too many statements: {len(queries)} > {MAX_BATCH_SIZE}"
+    for i, sql in enumerate(queries):
+        if not isinstance(sql, str) or not sql.strip():
+            return None, False, f"queries[{i}] must be a non-empty string"
+    return queries, bool(payload.get("transaction")), None
+
+
+def plan_batch(queries: list, strategy: str, transaction: bool) -> list:
+    """[(host, [index, ...])]: one group, run in the order given.
+
+    Only an all-read batch goes to a replica. A batch with any write runs on the
+    master, reads included: a replica could miss the batch's own writes.
+    """
+    everything = list(range(len(queries)))
+    if transaction or any(is_write_query(q) for q in queries):
+        return [(MASTER_HOST, everything)]
+    return [(choose_target(queries[0], strategy), everything)]
+
+
+def invalidate_writes(statements: list):
+    for sql in statements:
+        if is_write_query(sql):
+            _cache.invalidate(touched_tables(sql))
+
+
+def batch_item(host: str, res) -> dict:
+    if isinstance(res, Exception):
+        return {"target_host": host, "error": str(res)}
+    return {"target_host": host, "result": res}
+
+
+def execute_batch(host: str, statements: list, transaction: bool = False) -> list:
+    """Run statements in order on one pooled connection.
+
+    Outside a transaction a rejected statement is reported in its slot and the
+    rest still run; inside one it rolls everything back (BatchAborted).
+    """
+    out = []
+    with track_load(host, len(statements)), _pools[host].connection() as conn:
+        if transaction:
+            conn.start_transaction()
+        cur = conn.cursor(dictionary=True)
+        try:
+            for sql in statements:
+                t0 = time.perf_counter()
+                try:
+                    cur.execute(sql)
+                    out.append(cur.fetchall() if cur.with_rows else {"affected_rows": cur.rowcount})
+                    _query_stats.record(sql, host, (time.perf_counter() - t0) * 1000.0, result_rows(out[-1]))
+                except mysql_errors.Error as e:
+                    _query_stats.record(sql, host, (time.perf_counter() - t0) * 1000.0, error=True)
+                    if not is_server_error(e):
+                        raise
+                    if transaction:
+                        conn.rollback()
+                        raise BatchAborted(len(out), e)
+                    out.append(e)
+            if transaction:
+                conn.commit()
+        finally:
+            cur.close()
+    return out
+
+
+def stream_rows(host: str, sql: str, params=None):
+    """Generator of a streamed read: the column names first, then NDJSON rows in chunks and a {"done": ...} trailer.
+
+    The statement runs on an unbuffered cursor inside track_load() and the pool's
+    connection(), like execute_query(), so the breaker, the load and /stats/queries
+    see it. Getting the column names raises if the statement fails; later errors
+    are reported in-band. Only STREAM_CHUNK_ROWS rows are held at a time. If the
+    client goes away the generator is closed mid-result and the connection is
+    dropped, not drained.
+    """
+    pool = _pools[host]
+    opened = False
+    try:
+        with track_load(host, sql=sql) as sample, pool.connection() as conn:
+            if params is not None:
+                stmt, cur = pool.prepared(conn, sql)
+                try:
+                    cur.execute(stmt, params)
+                except BaseException:
+                    pool.unprepare(conn, sql)
+                    raise
+            else:
+                cur = conn.cursor(dictionary=True, buffered=False)
+                cur.execute(sql)
+            opened = True
+            yield list(cur.column_names)
+            n = 0
+            while True:
+                rows = cur.fetchmany(STREAM_CHUNK_ROWS)
+                if not rows:
+                    break
+                n += len(rows)
+                sample["rows"] = n
+                yield "".join(ndjson(r) for r in rows)
+            if params is None:
+                cur.close()
+        yield ndjson({"done": True, "rows": n})
+    except Exception as e:
+        if not opened:
+            raise
+        yield ndjson({"error": str(e)})
+
+
+def open_stream(host: str, sql: str, params=None, session: bool = False):
+    """Start stream_rows(), failing over like read_query() until one host runs the statement.
+
+    Returns (host, columns, generator of the rest).
+    """
+    tried = [host]
+    while True:
+        rows = stream_rows(host, sql, params)
+        try:
+            return host, next(rows), rows
+        except Exception as e:
+            nxt = failover_host(tried, session) if len(tried) <= READ_RETRIES and is_backend_failure(e) else None
+            if nxt is None:
+                raise
+            host = nxt
+            tried.append(host)
+
+
+@app.after_request
+def count_response(resp):
+    RESPONSES.inc(request.url_rule.rule if request.url_rule else "other", str(resp.status_code))
+    return resp
+
+
+@app.route("/", methods=["GET"])
+def health():
+    return jsonify(status()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    body = render_metrics({h: p.stats() for h, p in _pools.items()})
+    return Response(body, 200, content_type=metrics.CONTENT_TYPE)
+
+
+@app.route("/stats/queries", methods=["GET"])
+def query_stats():
+    n, order, err = parse_top(request.args)
+    if err:
+        return jsonify({"error": err}), 400
+    return jsonify(_query_stats.top(n, order)), 200
 
 
 @app.route("/query", methods=["POST"])
@@ -183,24 +2082,676 @@ def query():
     sql = payload.get("query", "")
     if not sql:
         return jsonify({"error": "Missing field: query"}), 400
+    params, err = parse_params(payload)
+    if err:
+        return jsonify({"error": err}), 400
+    # Read-your-writes is opt-in: clients send "session_token" (empty on the first call)
+    token, err = parse_session_token(payload)
+    if err:
+        return jsonify({"error": err}), 400
+    session = "session_token" in payload
 
     # Allow Gatekeeper to override strategy per-request via header
     strategy = request.headers.get("X-Proxy-Strategy", DEFAULT_STRATEGY).strip().lower()
 
+    write = is_write_query(sql)
+    REQUESTS.inc(strategy_label(strategy), "write" if write else "read")
+    # Session and streamed reads skip the cache
+    use_cache = (not write and not token and not payload.get("stream")
+                 and payload.get("cache", True) is not False and is_cacheable(sql))
+
     target = choose_target(sql, strategy)
     try:
-        res = execute_query(target, sql)
-        return jsonify({"strategy": strategy, "target_host": target, "result": res}), 200
+        if token:
+            target = route_for_session(target, token)
+        if payload.get("stream") and not write:
+            target, columns, rows = open_stream(target, sql, params, session=bool(token))
+            head = {"strategy": strategy, "target_host": target, "columns": columns}
+            if session:
+                head["session_token"] = token
+            return Response(chain([ndjson(head)], rows), 200, mimetype="application/x-ndjson")
+        hedge = strategy == "hedged"
+        if use_cache:
+            target, res, hit = cached_read(target, sql, params, hedge)
+        elif not write:
+            target, res = (hedged_read if hedge else read_query)(target, sql, params, session=bool(token))
+        else:
+            check_available(target)
+            parts = coalesce_parts(sql, params) if WRITE_COALESCE_MS > 0 else None
+            try:
+                res = coalesced_write(sql, params, parts) if parts else execute_query(target, sql, params)
+            finally:
+                _cache.invalidate(touched_tables(sql))
+        out = {"strategy": strategy, "target_host": target, "result": res}
+        if use_cache:
+            out["cache"] = "hit" if hit else "miss"
+        if session:
+            out["session_token"] = master_gtid_executed() if write else token
+        fmt, coding = negotiate(request.headers.get("Accept"), request.headers.get("Accept-Encoding"))
+        if fmt == "application/json" and not coding:
+            t0 = time.perf_counter()
+            resp = jsonify(out)
+            resp.headers["Server-Timing"] = server_timing(t0)
+            return resp, 200
+        body, headers = encode_response(out, fmt, coding)
+        return Response(body, 200, headers=headers)
+    except BackendUnavailable as e:
+        return jsonify({"strategy": strategy, "target_host": target, "error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"strategy": strategy, "target_host": target, "error": str(e)}), 500
+
+
+@app.route("/query/batch", methods=["POST"])
+def query_batch():
+    payload = request.get_json(silent=True) or {}
+    queries, transaction, err = parse_batch(payload)
+    if err:
+        return jsonify({"error": err}), 400
+
+    strategy = request.headers.get("X-Proxy-Strategy", DEFAULT_STRATEGY).strip().lower()
+    REQUESTS.inc(strategy_label(strategy), "batch")
+
+    results = [None] * len(queries)
+    target = MASTER_HOST
+    try:
+        for target, idx in plan_batch(queries, strategy, transaction):
+            statements = [queries[i] for i in idx]
+            try:
+                res = execute_batch(target, statements, transaction)
+            finally:
+                invalidate_writes(statements)
+            for i, r in zip(idx, res):
+                results[i] = batch_item(target, r)
+    except BatchAborted as e:
+        return jsonify({"strategy": strategy, "target_host": target, "error": str(e), "index": e.index}), 500
     except Exception as e:
         return jsonify({"strategy": strategy, "target_host": target, "error": str(e)}), 500
+    return jsonify({"strategy": strategy, "transaction": transaction, "results": results}), 200
+
+
+def serve_flask(sock=None, stats_sock=None):
+    Thread(target=warm_pools, daemon=True).start()
+    start_routing()
+    if sock is None:
+        app.run(host=PROXY_BIND, port=PROXY_PORT)
+        return
+    if stats_sock is not None:
+        stats = make_server(PROXY_BIND, stats_sock.getsockname()[1], app, threaded=True, fd=stats_sock.fileno())
+        Thread(target=stats.serve_forever, daemon=True).start()
+    make_server(PROXY_BIND, PROXY_PORT, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+
+if __name__ == "__main__":
+    if PROXY_ENGINE == "asyncio":
+        # proxy_async imports this module by name; hand it this instance, not a second copy
+        sys.modules["proxy"] = sys.modules[__name__]
+        import proxy_async
+        serve = proxy_async.main
+    else:
+        serve = serve_flask
+    if PROXY_PROCESSES > 1:
+        serve_prefork(PROXY_PROCESSES, serve)
+    else:
+        serve()
+PY
+
+# ---------
+# asyncio engine (PROXY_ENGINE=asyncio): same routing, non-blocking I/O
+# ---------
+cat > "${PROXY_DIR}/proxy_async.py" <<'PY'
+"""aiohttp + aiomysql engine serving the same / and /query contract as proxy.py.
+
+Routing, probing, the result cache and session tokens all come from proxy.py;
+only the HTTP server and the MySQL I/O are replaced.
+"""
+import asyncio
+import json
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+
+import aiomysql
+import pymysql
+from aiohttp import web
+
+import proxy as core
+
+dumps = partial(json.dumps, default=core.json_default)
+
+
+class AsyncPool:
+    """aiomysql pool for one host, with the borrow timeout and stats of proxy.ConnectionPool."""
+
+    def __init__(self, host: str):
+        self.host = host
+        self._pool = None
+        self._create_lock = asyncio.Lock()
+        self._waiting = 0
+        self._borrows = 0
+        self._timeouts = 0
+        self._wait_total_ms = 0.0
+        self._wait_max_ms = 0.0
+
+    async def _get(self):
+        if self._pool is None:
+            async with self._create_lock:
+                if self._pool is None:
+                    host, port = core.backend_address(self.host)
+                    self._pool = await aiomysql.create_pool(
+                        host=host,
+                        port=port,
+                        user=core.DB_USER,
+                        password=core.DB_PASS,
+                        db=core.DB_NAME,
+                        autocommit=True,
+                        minsize=core.POOL_MIN_SIZE,
+                        maxsize=core.POOL_MAX_SIZE,
+                        pool_recycle=core.POOL_IDLE_TIMEOUT,
+                        connect_timeout=core.DB_CONNECT_TIMEOUT,
+                    )
+        return self._pool
+
+    @asynccontextmanager
+    async def connection(self):
+        breaker = core._breakers[self.host]
+        t0 = time.perf_counter()
+        self._waiting += 1
+        try:
+            pool = await self._get()
+            conn = await asyncio.wait_for(pool.acquire(), core.POOL_BORROW_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            breaker.failure()
+            raise core.PoolTimeout(f"no connection to {self.host} available within {core.POOL_BORROW_TIMEOUT}s")
+        except Exception as e:
+            if core.is_backend_failure(e):
+                breaker.failure()
+            raise
+        finally:
+            self._waiting -= 1
+        waited_ms = (time.perf_counter() - t0) * 1000.0
+        self._borrows += 1
+        self._wait_total_ms += waited_ms
+        self._wait_max_ms = max(self._wait_max_ms, waited_ms)
+
+        try:
+            if asyncio.get_running_loop().time() - conn.last_usage > core.POOL_PING_AFTER:
+                await conn.ping(reconnect=True)
+            yield conn
+        except BaseException as e:
+            if not core.is_server_error(e):
+                conn.close()
+            pool.release(conn)
+            if core.is_backend_failure(e):
+                breaker.failure()
+            elif core.is_server_error(e):
+                breaker.success()
+            raise
+        else:
+            pool.release(conn)
+            breaker.success()
+
+    async def fill(self):
+        try:
+            await self._get()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        size = self._pool.size if self._pool else 0
+        idle = self._pool.freesize if self._pool else 0
+        return {
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "waiting": self._waiting,
+            "borrows": self._borrows,
+            "timeouts": self._timeouts,
+            "avg_wait_ms": round(self._wait_total_ms / self._borrows, 3) if self._borrows else 0.0,
+            "max_wait_ms": round(self._wait_max_ms, 3),
+        }
+
+
+_pools = {}
+
+
+async def _fetch_one(host: str, sql: str, args=None):
+    async with _pools[host].connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(sql, args)
+            return (await cur.fetchone())[0]
+
+
+@asynccontextmanager
+async def killable(attempt, conn_id: int):
+    """Async core.killable(): attempt.lock is an asyncio.Lock here."""
+    if attempt is None:
+        yield
+        return
+    attempt.conn_id = conn_id
+    try:
+        yield
+    finally:
+        async with attempt.lock:
+            attempt.conn_id = None
+
+
+async def execute_query(host: str, sql: str, params=None, attempt=None):
+    # PyMySQL has no server-side prepared statements: params are escaped client-side
+    with core.track_load(host, sql=sql, read=not core.is_write_query(sql)) as sample:
+        async with _pools[host].connection() as conn, killable(attempt, conn.thread_id()):
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                # Buffered cursor: the whole result is read inside execute()
+                await asyncio.wait_for(cur.execute(sql, params), core.DB_READ_TIMEOUT)
+                if cur.description:
+                    out = list(await cur.fetchall())
+                else:
+                    out = {"affected_rows": cur.rowcount}
+        sample["rows"] = core.result_rows(out)
+    return out
+
+
+async def execute_batch(host: str, statements: list, transaction: bool = False) -> list:
+    out = []
+    with core.track_load(host, len(statements)):
+        async with _pools[host].connection() as conn:
+            if transaction:
+                await conn.begin()
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                for sql in statements:
+                    t0 = time.perf_counter()
+                    try:
+                        await asyncio.wait_for(cur.execute(sql), core.DB_READ_TIMEOUT)
+                        out.append(list(await cur.fetchall()) if cur.description else {"affected_rows": cur.rowcount})
+                        core._query_stats.record(sql, host, (time.perf_counter() - t0) * 1000.0,
+                                                 core.result_rows(out[-1]))
+                    except pymysql.err.MySQLError as e:
+                        core._query_stats.record(sql, host, (time.perf_counter() - t0) * 1000.0, error=True)
+                        if not core.is_server_error(e):
+                            raise
+                        if transaction:
+                            await conn.rollback()
+                            raise core.BatchAborted(len(out), e)
+                        out.append(e)
+            if transaction:
+                await conn.commit()
+    return out
+
+
+class ClientGone(Exception):
+    """The client of a streamed read went away: the backend connection is dropped, its breaker untouched."""
+
+
+async def send(resp, text: str):
+    try:
+        await resp.write(text.encode())
+    except ConnectionError as e:
+        raise ClientGone(str(e)) from None
+
+
+async def stream_once(request, host: str, sql: str, head: dict, params=None):
+    """NDJSON counterpart of proxy.stream_rows() on an unbuffered (SS) cursor.
+
+    Raises if the statement fails before the response has started; later errors
+    are reported in-band and drop the connection instead of draining it.
+    """
+    resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    resp.enable_chunked_encoding()
+    try:
+        with core.track_load(host, sql=sql) as sample:
+            async with _pools[host].connection() as conn:
+                cur = await conn.cursor(aiomysql.SSDictCursor)
+                await cur.execute(sql, params)
+                await resp.prepare(request)
+                await send(resp, core.ndjson({**head, "target_host": host,
+                                              "columns": [d[0] for d in cur.description or ()]}))
+                n = 0
+                while True:
+                    rows = await cur.fetchmany(core.STREAM_CHUNK_ROWS)
+                    if not rows:
+                        break
+                    n += len(rows)
+                    sample["rows"] = n
+                    await send(resp, "".join(core.ndjson(r) for r in rows))
+                await cur.close()
+        await send(resp, core.ndjson({"done": True, "rows": n}))
+        await resp.write_eof()
+    except Exception as e:
+        if not resp.prepared:
+            raise
+        try:
+            await send(resp, core.ndjson({"error": str(e)}))
+            await resp.write_eof()
+        except Exception:
+            pass
+    return resp
+
+
+async def stream_query(request, host: str, sql: str, head: dict, params=None, session: bool = False):
+    """stream_once(), failing over like read_query() while nothing has been sent."""
+    tried = [host]
+    while True:
+        try:
+            return await stream_once(request, host, sql, head, params)
+        except Exception as e:
+            nxt = core.failover_host(tried, session) if len(tried) <= core.READ_RETRIES and core.is_backend_failure(e) else None
+            if nxt is None:
+                raise
+            host = nxt
+            tried.append(host)
+
+
+_coalescer = core.WriteCoalescer(asyncio.Event)
+
+
+async def run_coalesced(group: core.CoalesceGroup) -> list:
+    n = len(group.entries)
+    if n > 1:
+        sql = group.merged()
+        try:
+            with core.track_load(core.MASTER_HOST, n, sql) as sample:
+                async with _pools[core.MASTER_HOST].connection() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(sql)
+                        sample["rows"] = affected = cur.rowcount
+            _coalescer.record(n, False)
+            return group.shares(affected)
+        except Exception as e:
+            if not core.is_server_error(e):
+                return [e] * n
+    out = []
+    for sql, params, _ in group.entries:
+        try:
+            out.append(await execute_query(core.MASTER_HOST, sql, params))
+        except Exception as e:
+            out.append(e)
+    _coalescer.record(n, n > 1)
+    return out
+
+
+async def coalesced_write(sql: str, params, parts):
+    group, slot, leader = _coalescer.join(sql, params, parts)
+    if leader:
+        try:
+            try:
+                await asyncio.wait_for(group.full.wait(), core.WRITE_COALESCE_MS / 1000.0)
+            except asyncio.TimeoutError:
+                pass
+            _coalescer.close(parts[0], group)
+            group.results = await run_coalesced(group)
+        finally:
+            group.done.set()
+    else:
+        await group.done.wait()
+    return group.result(slot)
+
+
+async def master_gtid_executed() -> str:
+    return (await _fetch_one(core.MASTER_HOST, "SELECT @@GLOBAL.gtid_executed") or "").replace("\n", "")
+
+
+async def wait_for_gtid(host: str, token: str) -> bool:
+    try:
+        return await _fetch_one(host, "SELECT WAIT_FOR_EXECUTED_GTID_SET(%s, %s)", (token, core.RYW_WAIT_TIMEOUT)) == 0
+    except Exception:
+        return False
+
+
+async def route_for_session(target: str, token: str) -> str:
+    if target == core.MASTER_HOST:
+        return target
+    h = core.replica_with_gtid(target, token)
+    if h:
+        return h
+    if core.RYW_WAIT_TIMEOUT > 0 and await wait_for_gtid(target, token):
+        return target
+    return core.MASTER_HOST
+
+
+async def read_query(host: str, sql: str, params=None, session: bool = False):
+    tried = [host]
+    while True:
+        try:
+            return host, await execute_query(host, sql, params)
+        except Exception as e:
+            nxt = core.failover_host(tried, session) if len(tried) <= core.READ_RETRIES and core.is_backend_failure(e) else None
+            if nxt is None:
+                raise
+            host = nxt
+            tried.append(host)
+
+
+# Killers and losing copies still running after hedged_read() returned
+_background = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_settle)
+    return task
+
+
+def _settle(task: asyncio.Task):
+    _background.discard(task)
+    if not task.cancelled():
+        task.exception()  # retrieved: a killed copy's error is expected
+
+
+async def kill_query(attempt: core.ReadAttempt):
+    async with attempt.lock:
+        if attempt.conn_id is None:
+            return
+        try:
+            async with _pools[attempt.host].connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("KILL QUERY %s", (attempt.conn_id,))
+        except Exception:
+            return
+    core._hedging.record(killed=True)
+
+
+async def hedged_read(host: str, sql: str, params=None, session: bool = False):
+    core._hedging.admit()
+    attempts = {}
+
+    def launch(h: str):
+        a = core.ReadAttempt(h, asyncio.Lock())
+        attempts[_spawn(execute_query(h, sql, params, a))] = a
+
+    launch(host)
+    first = next(iter(attempts))
+    done, _ = await asyncio.wait(attempts, timeout=core._hedging.threshold_s(host))
+    if not done or first.exception() is not None:
+        alt = core.hedge_host(host, first.exception() if done else None, session)
+        if alt:
+            launch(alt)
+    pending, error = set(attempts), None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            if t.exception() is None:
+                for p in pending:
+                    _spawn(kill_query(attempts[p]))
+                core._hedging.record(hedge_won=t is not first)
+                return attempts[t].host, t.result()
+            error = error or t.exception()
+    raise error
+
+
+async def cached_read(host: str, sql: str, params=None, hedge: bool = False):
+    key = (core.DB_NAME, core.normalize_sql(sql), params)
+    hit = core._cache.get(key)
+    if hit is not None:
+        return hit[0], hit[1], True
+    tables = core.touched_tables(sql)
+    gen = core._cache.generation(tables)
+    host, res = await (hedged_read if hedge else read_query)(host, sql, params)
+    core._cache.put(key, tables, gen, host, res)
+    return host, res, False
+
+
+@web.middleware
+async def count_response(request, handler):
+    endpoint = getattr(request.match_info.route.resource, "canonical", "other")
+    try:
+        resp = await handler(request)
+    except web.HTTPException as e:
+        core.RESPONSES.inc(endpoint, str(e.status))
+        raise
+    core.RESPONSES.inc(endpoint, str(resp.status))
+    return resp
+
+
+async def health(request):
+    body = core.status()
+    body["pools"] = {h: p.stats() for h, p in _pools.items()}
+    body["write_coalescing"] = _coalescer.stats()
+    return web.json_response(body, dumps=dumps)
+
+
+async def metrics_endpoint(request):
+    body = core.render_metrics({h: p.stats() for h, p in _pools.items()})
+    return web.Response(body=body.encode(), headers={"Content-Type": core.metrics.CONTENT_TYPE})
+
+
+async def query_stats(request):
+    n, order, err = core.parse_top(request.query)
+    if err:
+        return web.json_response({"error": err}, status=400)
+    return web.json_response(core._query_stats.top(n, order))
+
+
+async def query(request):
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    sql = payload.get("query", "")
+    if not sql:
+        return web.json_response({"error": "Missing field: query"}, status=400)
+    params, err = core.parse_params(payload)
+    if err:
+        return web.json_response({"error": err}, status=400)
+    token, err = core.parse_session_token(payload)
+    if err:
+        return web.json_response({"error": err}, status=400)
+    session = "session_token" in payload
+
+    strategy = request.headers.get("X-Proxy-Strategy", core.DEFAULT_STRATEGY).strip().lower()
+    write = core.is_write_query(sql)
+    core.REQUESTS.inc(core.strategy_label(strategy), "write" if write else "read")
+    stream = bool(payload.get("stream")) and not write
+    use_cache = (not write and not token and not stream
+                 and payload.get("cache", True) is not False and core.is_cacheable(sql))
+
+    target = core.choose_target(sql, strategy)
+    try:
+        if token:
+            target = await route_for_session(target, token)
+        if stream:
+            head = {"strategy": strategy, "target_host": target}
+            if session:
+                head["session_token"] = token
+            return await stream_query(request, target, sql, head, params, session=bool(token))
+        hedge = strategy == "hedged"
+        if use_cache:
+            target, res, hit = await cached_read(target, sql, params, hedge)
+        elif not write:
+            target, res = await (hedged_read if hedge else read_query)(target, sql, params, session=bool(token))
+        else:
+            core.check_available(target)
+            parts = core.coalesce_parts(sql, params) if core.WRITE_COALESCE_MS > 0 else None
+            try:
+                if parts:
+                    res = await coalesced_write(sql, params, parts)
+                else:
+                    res = await execute_query(target, sql, params)
+            finally:
+                core._cache.invalidate(core.touched_tables(sql))
+        out = {"strategy": strategy, "target_host": target, "result": res}
+        if use_cache:
+            out["cache"] = "hit" if hit else "miss"
+        if session:
+            out["session_token"] = await master_gtid_executed() if write else token
+        fmt, coding = core.negotiate(request.headers.get("Accept"), request.headers.get("Accept-Encoding"))
+        if fmt == "application/json" and not coding:
+            t0 = time.perf_counter()
+            resp = web.json_response(out, dumps=dumps)
+            resp.headers["Server-Timing"] = core.server_timing(t0)
+            return resp
+        body, headers = core.encode_response(out, fmt, coding)
+        return web.Response(body=body, headers=headers)
+    except core.BackendUnavailable as e:
+        return web.json_response({"strategy": strategy, "target_host": target, "error": str(e)}, status=503)
+    except Exception as e:
+        return web.json_response({"strategy": strategy, "target_host": target, "error": str(e)}, status=500)
+
+
+async def query_batch(request):
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    queries, transaction, err = core.parse_batch(payload)
+    if err:
+        return web.json_response({"error": err}, status=400)
+
+    strategy = request.headers.get("X-Proxy-Strategy", core.DEFAULT_STRATEGY).strip().lower()
+    core.REQUESTS.inc(core.strategy_label(strategy), "batch")
+
+    results = [None] * len(queries)
+    target = core.MASTER_HOST
+    try:
+        for target, idx in core.plan_batch(queries, strategy, transaction):
+            statements = [queries[i] for i in idx]
+            try:
+                res = await execute_batch(target, statements, transaction)
+            finally:
+                core.invalidate_writes(statements)
+            for i, r in zip(idx, res):
+                results[i] = core.batch_item(target, r)
+    except core.BatchAborted as e:
+        return web.json_response(
+            {"strategy": strategy, "target_host": target, "error": str(e), "index": e.index}, status=500)
+    except Exception as e:
+        return web.json_response({"strategy": strategy, "target_host": target, "error": str(e)}, status=500)
+    return web.json_response({"strategy": strategy, "transaction": transaction, "results": results}, dumps=dumps)
+
+
+async def _on_startup(app):
+    for h in core._pools:
+        _pools[h] = AsyncPool(h)
+    # Best effort, like warm_pools(): a backend that is still booting must not block startup
+    for p in _pools.values():
+        asyncio.get_running_loop().create_task(p.fill())
+
+
+def main(sock=None, stats_sock=None):
+    app = web.Application(middlewares=[count_response])
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/stats/queries", query_stats)
+    app.router.add_post("/query", query)
+    app.router.add_post("/query/batch", query_batch)
+    app.on_startup.append(_on_startup)
+    core.start_routing()
+    if sock is None:
+        web.run_app(app, host=core.PROXY_BIND, port=core.PROXY_PORT, access_log=None)
+    else:
+        web.run_app(app, sock=[s for s in (sock, stats_sock) if s is not None], access_log=None)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    main()
 PY
 
 chown -R ubuntu:ubuntu "${PROXY_DIR}"
-chmod +x "${PROXY_DIR}/proxy.py"
+chmod +x "${PROXY_DIR}/proxy.py" "${PROXY_DIR}/proxy_async.py"
 
 # ---------
 # systemd service
@@ -213,6 +2764,22 @@ After=network.target
 [Service]
 User=ubuntu
 WorkingDirectory=${PROXY_DIR}
+Environment=PROXY_PORT=${PROXY_PORT}
+Environment=POOL_MIN_SIZE=${POOL_MIN_SIZE}
+Environment=POOL_MAX_SIZE=${POOL_MAX_SIZE}
+Environment=POOL_IDLE_TIMEOUT=${POOL_IDLE_TIMEOUT}
+Environment=POOL_BORROW_TIMEOUT=${POOL_BORROW_TIMEOUT}
+Environment=PROXY_ENGINE=${PROXY_ENGINE}
+Environment=PROXY_PROCESSES=${PROXY_PROCESSES}
+Environment=PROXY_STATS_PORT=${PROXY_STATS_PORT}
+Environment=WRITE_COALESCE_MS=${WRITE_COALESCE_MS}
+Environment=WRITE_COALESCE_MAX_ROWS=${WRITE_COALESCE_MAX_ROWS}
+Environment=DB_CONNECT_TIMEOUT=${DB_CONNECT_TIMEOUT}
+Environment=DB_READ_TIMEOUT=${DB_READ_TIMEOUT}
+Environment=READ_RETRIES=${READ_RETRIES}
+Environment=BREAKER_FAILURES=${BREAKER_FAILURES}
+Environment=BREAKER_OPEN_S=${BREAKER_OPEN_S}
+Environment=BREAKER_MAX_OPEN_S=${BREAKER_MAX_OPEN_S}
 ExecStart=${VENV_DIR}/bin/python ${PROXY_DIR}/proxy.py
 Restart=always
 
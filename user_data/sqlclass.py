@@ -0,0 +1,267 @@
+"""Lightweight SQL classifier shared by the gatekeeper and the proxy.
+
+Not a parser: a tokenizer that understands comments, quoting and parentheses,
+which is enough to route a statement, spot destructive ones and list the
+tables it touches. Results are memoized on a digest of the statement (comments
+dropped, literals replaced by ?), so `... WHERE id = 1` and `... id = 2` share
+one entry.
+
+    python sqlclass.py
+
+runs the self-checks in CHECKS.
+"""
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+CLASSIFY_CACHE_SIZE = 4096
+
+# Order matters: a quote or backtick opens before any comment marker inside it
+_DIGEST_RE = re.compile(
+    r"""(?P<ident>`(?:[^`]|``)*`)
+      | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+      | /\*!\d*(?P<exec>.*?)\*/                      # MySQL executable comment: its body runs
+      | (?P<comment>/\*.*?\*/|--(?=\s|$)[^\n]*|\#[^\n]*)
+      | (?P<number>(?<![\w$@])(?:0x[0-9a-f]+|\d+(?:\.\d*)?(?:e[+-]?\d+)?|\.\d+))""",
+    re.I | re.S | re.X,
+)
+_TOKEN_RE = re.compile(r"`(?:[^`]|``)*`|[a-z_$@][\w$@]*|\S", re.I)
+
+_READ_VERBS = frozenset({"select", "show", "describe", "desc", "explain", "table", "values", "help"})
+_MAIN_VERBS = frozenset({"select", "insert", "update", "delete", "replace", "table", "values"})
+DANGEROUS_VERBS = frozenset({"drop", "truncate", "alter"})
+_TABLE_KEYWORDS = frozenset({"from", "join", "straight_join", "into", "update", "table"})
+_INSERT_MODIFIERS = frozenset({"low_priority", "delayed", "high_priority", "ignore"})
+# Modifiers that can sit between UPDATE / DELETE ... FROM and the table name
+_TABLE_MODIFIERS = _INSERT_MODIFIERS | {"quick"}
+# Words that can follow a table name without being its alias
+_NOT_ALIAS = frozenset({
+    "where", "join", "inner", "left", "right", "cross", "natural", "straight_join", "outer", "on",
+    "using", "group", "order", "limit", "having", "window", "union", "except", "intersect", "set",
+    "values", "value", "select", "partition", "for", "lock", "into", "force", "use", "ignore",
+    "as", "with", "default", "like", "to", "rename", "add", "drop", "modify", "change",
+})
+# What must follow the table list of a data-changing statement for it to be understood
+_WRITE_SHAPE = {
+    "update": frozenset({"set"}),
+    "insert": frozenset({"values", "value", "select", "set", "table", "with"}),
+    "replace": frozenset({"values", "value", "select", "set", "table", "with"}),
+    "delete": frozenset({"from"}),
+}
+_NOT_TABLE = frozenset({"select", "with", "values", "lateral", "dual", "json_table", "outfile", "dumpfile"})
+_NONDETERMINISTIC = frozenset({
+    "now", "rand", "uuid", "uuid_short", "sysdate", "curdate", "curtime", "unix_timestamp",
+    "utc_date", "utc_time", "utc_timestamp", "localtime", "localtimestamp", "connection_id",
+    "last_insert_id", "found_rows", "row_count", "sleep", "get_lock", "release_lock",
+})
+
+
+class SqlInfo(NamedTuple):
+    verbs: tuple           # leading keyword of each statement, e.g. ("select",)
+    write: bool            # must run on the master
+    locking: bool          # SELECT ... FOR UPDATE / FOR SHARE / LOCK IN SHARE MODE
+    dangerous: bool        # DROP / TRUNCATE / ALTER anywhere in the input
+    deterministic: bool    # no NOW(), RAND(), @variables, ...
+    tables: frozenset      # "table" or "db.table", lowercased, backticks stripped
+    tables_known: bool     # tables found where the statement's shape says they are: trust them for invalidation
+
+
+def _digest_part(m) -> str:
+    if m.group("ident") is not None:
+        return m.group("ident")
+    if m.group("exec") is not None:
+        return f" {m.group('exec')} "
+    if m.group("comment") is not None:
+        return " "
+    return "?"
+
+
+def digest(sql: str) -> str:
+    """Statement text with comments removed, literals replaced by ? and whitespace collapsed."""
+    return " ".join(_DIGEST_RE.sub(_digest_part, sql or "").split())
+
+
+# Runs of placeholders: IN (?, ?, ?) and VALUES (?, ?), (?, ?) collapse to one group
+_PLACEHOLDERS_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_ROW_GROUPS_RE = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+
+
+@lru_cache(maxsize=CLASSIFY_CACHE_SIZE)
+def fingerprint(sql: str) -> str:
+    """Digest with %s parameters as ? and placeholder lists folded, so batch sizes share a fingerprint."""
+    text = _PLACEHOLDERS_RE.sub("(...)", digest(sql).replace("%s", "?"))
+    return _ROW_GROUPS_RE.sub("(...)", text)
+
+
+def _tokens(text: str) -> list:
+    # Keywords and bare names lowercased; backticked names kept quoted so they never read as keywords
+    return [t if t[0] == "`" else t.lower() for t in _TOKEN_RE.findall(text)]
+
+
+def _is_name(t: str) -> bool:
+    return t[0] == "`" or ((t[0].isalpha() or t[0] in "_$") and t not in _NOT_TABLE)
+
+
+def _bare(t: str) -> str:
+    return t[1:-1].replace("``", "`").lower() if t[0] == "`" else t
+
+
+def _names(toks: list, j: int, out: set):
+    """Collect `name [AS alias], name ...` starting at toks[j]."""
+    n = len(toks)
+    while j < n and toks[j] in _TABLE_MODIFIERS:
+        j += 1  # UPDATE LOW_PRIORITY IGNORE t, DELETE QUICK FROM t
+    if j + 1 < n and toks[j] == "if":
+        j += 3 if toks[j + 1] == "not" else 2  # IF [NOT] EXISTS
+    while j < n and _is_name(toks[j]):
+        name = _bare(toks[j])
+        j += 1
+        if j + 1 < n and toks[j] == "." and _is_name(toks[j + 1]):
+            name = f"{name}.{_bare(toks[j + 1])}"
+            j += 2
+        out.add(name)
+        if j < n and toks[j] == "as":
+            j += 2
+        elif j < n and _is_name(toks[j]) and toks[j] not in _NOT_ALIAS:
+            j += 1
+        if j < n and toks[j] == ",":
+            j += 1
+            continue
+        break
+
+
+def _statement(toks: list):
+    """(verb, write, locking, deterministic, tables, tables_known) for one statement's tokens."""
+    i = 0
+    while i < len(toks) and toks[i] == "(":
+        i += 1
+    verb = toks[i] if i < len(toks) else ""
+    if verb == "with":
+        # The statement proper is the first verb outside the CTE definitions
+        depth = 0
+        for t in toks[i + 1:]:
+            if t == "(":
+                depth += 1
+            elif t == ")":
+                depth -= 1
+            elif depth == 0 and t in _MAIN_VERBS:
+                verb = t
+                break
+
+    tables = set()
+    locking = into = False
+    deterministic = True
+    for k, t in enumerate(toks):
+        prev = toks[k - 1] if k else ""
+        nxt = toks[k + 1] if k + 1 < len(toks) else ""
+        if t == "update" and prev in ("for", "key"):
+            locking = locking or prev == "for"   # FOR UPDATE, not ON DUPLICATE KEY UPDATE
+            continue
+        if (t == "share" and prev == "for") or (t == "lock" and nxt == "in"):
+            locking = True
+        elif t == "into":
+            into = True
+        if t in _TABLE_KEYWORDS:
+            _names(toks, k + 1, tables)
+        elif t in ("insert", "replace") and k == i:
+            j = k + 1
+            while j < len(toks) and toks[j] in _INSERT_MODIFIERS:
+                j += 1
+            if j < len(toks) and toks[j] != "into":
+                _names(toks, j, tables)
+        if t in _NONDETERMINISTIC or t.startswith(("current_", "@")):
+            deterministic = False
+
+    # SELECT ... INTO writes a file or session variables; locking reads need the master's locks
+    write = verb not in _READ_VERBS or locking or (verb == "select" and into)
+    # A keyword taken for a name, or no table where the shape needs one: the set may be wrong
+    known = bool(tables) and not (tables & (_TABLE_MODIFIERS | _NOT_TABLE))
+    if verb in _WRITE_SHAPE:
+        known = known and not _WRITE_SHAPE[verb].isdisjoint(toks)
+    return verb, write, locking, deterministic, tables, known
+
+
+def _split(toks: list) -> list:
+    stmts, cur = [], []
+    for t in toks:
+        if t == ";":
+            if cur:
+                stmts.append(cur)
+            cur = []
+        else:
+            cur.append(t)
+    if cur:
+        stmts.append(cur)
+    return stmts
+
+
+@lru_cache(maxsize=CLASSIFY_CACHE_SIZE)
+def classify_digest(text: str) -> SqlInfo:
+    parts = [_statement(s) for s in _split(_tokens(text))]
+    if not parts:
+        # Nothing recognisable: treat as a write so it lands on the master
+        return SqlInfo((), True, False, False, False, frozenset(), False)
+    return SqlInfo(
+        verbs=tuple(p[0] for p in parts),
+        write=any(p[1] for p in parts),
+        locking=any(p[2] for p in parts),
+        dangerous=any(p[0] in DANGEROUS_VERBS for p in parts),
+        deterministic=all(p[3] for p in parts),
+        tables=frozenset().union(*(p[4] for p in parts)),
+        tables_known=all(p[5] for p in parts),
+    )
+
+
+@lru_cache(maxsize=CLASSIFY_CACHE_SIZE)
+def classify(sql: str) -> SqlInfo:
+    """Classification of `sql`; the exact text is memoized in front of the digest memo."""
+    return classify_digest(digest(sql))
+
+
+def cache_stats() -> dict:
+    return {name: f.cache_info()._asdict() for name, f in (("text", classify), ("digest", classify_digest))}
+
+
+# (statement, expected write, expected tables[, expected tables_known, default True])
+CHECKS = [
+    ("SELECT * FROM actor WHERE actor_id = 1", False, {"actor"}),
+    ("SELECT a.x FROM sakila.actor a JOIN film_actor fa ON fa.actor_id = a.actor_id", False,
+     {"sakila.actor", "film_actor"}),
+    ("INSERT INTO actor (first_name) VALUES ('x')", True, {"actor"}),
+    ("INSERT IGNORE INTO actor (first_name) VALUES ('x')", True, {"actor"}),
+    ("UPDATE actor SET first_name = 'x' WHERE actor_id = 1", True, {"actor"}),
+    ("UPDATE LOW_PRIORITY actor SET first_name = 'x'", True, {"actor"}),
+    ("UPDATE IGNORE actor SET first_name = 'x'", True, {"actor"}),
+    ("UPDATE LOW_PRIORITY IGNORE `actor` SET first_name = 'x'", True, {"actor"}),
+    ("DELETE LOW_PRIORITY QUICK IGNORE FROM actor WHERE actor_id = 1", True, {"actor"}),
+    ("SELECT * FROM film INTO OUTFILE '/tmp/x'", True, {"film"}),
+    ("SELECT title INTO DUMPFILE '/tmp/x' FROM film LIMIT 1", True, {"film"}),
+    ("SELECT title INTO @t FROM film LIMIT 1", True, {"film"}),
+    ("SELECT * FROM actor FOR UPDATE", True, {"actor"}),
+    ("WITH x AS (SELECT 1) SELECT * FROM x", False, {"x"}),
+    # Writes whose table set cannot be vouched for: the proxy invalidates everything
+    ("UPDATE actor", True, {"actor"}, False),
+    ("DELETE actor", True, set(), False),
+    ("UPDATE `ignore` SET x = 1", True, {"ignore"}, False),
+    ("TRUNCATE actor", True, set(), False),
+    ("SET @x = 1", True, set(), False),
+    ("SELECT 1", False, set(), False),
+]
+
+
+def self_check() -> list:
+    """Failures among CHECKS, as messages."""
+    failed = []
+    for sql, write, tables, *known in CHECKS:
+        known = known[0] if known else True
+        info = classify(sql)
+        if info.write != write or info.tables != frozenset(tables) or info.tables_known != known:
+            failed.append(f"{sql!r}: write={info.write} tables={sorted(info.tables)} known={info.tables_known}, "
+                          f"expected write={write} tables={sorted(tables)} known={known}")
+    return failed
+
+
+if __name__ == "__main__":
+    problems = self_check()
+    print("\n".join(problems) or f"{len(CHECKS)} checks ok")
+    raise SystemExit(1 if problems else 0)
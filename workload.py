@@ -0,0 +1,212 @@
+"""Workload mixes for benchmark.py: weighted query templates over sakila with skewed keys.
+
+A workload is a JSON file (see workloads/sakila_mix.json):
+
+    {"name": "sakila-mix", "requests": 5000, "read_ratio": 0.9,
+     "distribution": {"type": "zipfian", "theta": 0.99},
+     "keys": {"film": [1, 1000], ...},
+     "templates": [
+        {"name": "film_detail", "kind": "read", "weight": 5,
+         "sql": "SELECT ... WHERE f.film_id = %s", "params": [{"key": "film"}]},
+        ...]}
+
+read_ratio picks reads vs writes, then weight picks the template within its kind
+(without read_ratio, weights are taken across all templates). Parameters are
+{"key": name} (drawn from keys[name] with the workload's distribution, or the
+parameter's own "distribution"), {"int": [lo, hi]}, {"choice": [...]}, {"const": v}
+or {"seq": true} (a counter unique within the run, for keys that must not collide;
+it starts at a random offset below SEQ_SPAN so runs against the same database
+rarely reuse values).
+
+Drawing a request is a couple of random() calls and a bisect: zeta sums and
+cumulative weights are computed once, when the workload is loaded.
+"""
+import json
+import random
+from bisect import bisect
+from functools import lru_cache
+from itertools import accumulate, count
+
+# Id ranges of the stock sakila tables
+SAKILA_KEYS = {
+    "actor": [1, 200],
+    "category": [1, 16],
+    "customer": [1, 599],
+    "film": [1, 1000],
+    "inventory": [1, 4581],
+    "rental": [1, 16049],
+    "staff": [1, 2],
+    "store": [1, 2],
+}
+DISTRIBUTIONS = ("uniform", "zipfian", "hotspot")
+# {"seq": true} counters start at a random offset below this
+SEQ_SPAN = 10 ** 8
+
+# -----------------------------
+# Key distributions
+# -----------------------------
+
+class Uniform:
+    def __init__(self, lo: int, hi: int):
+        self.lo, self.n = lo, hi - lo + 1
+
+    def __call__(self) -> int:
+        return self.lo + int(random.random() * self.n)
+
+
+@lru_cache(maxsize=None)
+def _zeta(n: int, theta: float) -> float:
+    return sum(1.0 / i ** theta for i in range(1, n + 1))
+
+
+class Zipfian:
+    """Key lo is the most popular, then lo + 1, ... (Gray et al., as in YCSB); theta in (0, 1)."""
+
+    def __init__(self, lo: int, hi: int, theta: float = 0.99):
+        if not 0.0 < theta < 1.0:
+            # theta = 1 divides by zero below; the approximation only holds inside (0, 1)
+            raise ValueError(f"zipfian theta must be between 0 and 1 (exclusive), got {theta!r}")
+        n = hi - lo + 1
+        self.lo, self.n, self.theta = lo, n, theta
+        self.zetan = _zeta(n, theta)
+        self.alpha = 1.0 / (1.0 - theta)
+        self.half_pow = 0.5 ** theta
+        self.eta = (1.0 - (2.0 / n) ** (1.0 - theta)) / (1.0 - _zeta(2, theta) / self.zetan) if n > 2 else 0.0
+
+    def __call__(self) -> int:
+        u = random.random()
+        uz = u * self.zetan
+        if uz < 1.0 or self.n == 1:
+            return self.lo
+        if uz < 1.0 + self.half_pow or self.n == 2:
+            return self.lo + 1
+        return self.lo + min(int(self.n * (self.eta * u - self.eta + 1.0) ** self.alpha), self.n - 1)
+
+
+class Hotspot:
+    """hot_share of the draws go to the first hot_fraction of the keys, uniformly within each part."""
+
+    def __init__(self, lo: int, hi: int, hot_fraction: float = 0.2, hot_share: float = 0.8):
+        n = hi - lo + 1
+        self.lo, self.share = lo, hot_share
+        self.hot = min(max(int(n * hot_fraction), 1), n)
+        self.cold = n - self.hot
+
+    def __call__(self) -> int:
+        if random.random() < self.share or not self.cold:
+            return self.lo + int(random.random() * self.hot)
+        return self.lo + self.hot + int(random.random() * self.cold)
+
+
+def make_distribution(spec, lo: int, hi: int):
+    """spec: "uniform" | "zipfian" | "hotspot", or {"type": ..., parameters...}."""
+    if isinstance(spec, str):
+        spec = {"type": spec}
+    options = {k: v for k, v in spec.items() if k != "type"}
+    kind = spec.get("type", "uniform")
+    cls = {"uniform": Uniform, "zipfian": Zipfian, "hotspot": Hotspot}.get(kind)
+    if cls is None:
+        raise ValueError(f"Unknown distribution {kind!r}, expected one of {', '.join(DISTRIBUTIONS)}")
+    try:
+        return cls(lo, hi, **options)
+    except TypeError:
+        raise ValueError(f"Bad {kind} parameters {options!r}") from None
+
+# -----------------------------
+# Templates
+# -----------------------------
+
+class Template:
+    def __init__(self, spec: dict, keys: dict, distribution, seq):
+        self.name = spec["name"]
+        self.kind = spec.get("kind", "read")
+        if self.kind not in ("read", "write"):
+            raise ValueError(f"{self.name}: kind must be read or write")
+        self.sql = spec["sql"]
+        self.weight = float(spec.get("weight", 1))
+        self.params = [self._param(p, keys, distribution, seq) for p in spec.get("params", [])]
+
+    def _param(self, p: dict, keys: dict, distribution, seq):
+        if "key" in p:
+            if p["key"] not in keys:
+                raise ValueError(f"{self.name}: no key range for {p['key']!r}")
+            lo, hi = keys[p["key"]]
+            try:
+                return make_distribution(p.get("distribution", distribution), lo, hi)
+            except ValueError as e:
+                raise ValueError(f"{self.name}: {e}") from None
+        if "int" in p:
+            return Uniform(*p["int"])
+        if "choice" in p:
+            choices = list(p["choice"])
+            return lambda: random.choice(choices)
+        if "const" in p:
+            return lambda: p["const"]
+        if p.get("seq"):
+            return lambda: next(seq)
+        raise ValueError(f"{self.name}: unknown parameter {p!r}")
+
+    def render(self) -> tuple:
+        """(sql, params) for one request."""
+        return self.sql, [gen() for gen in self.params]
+
+
+class _Picker:
+    def __init__(self, templates: list):
+        self.templates = templates
+        self.cum = list(accumulate(t.weight for t in templates))
+
+    def __call__(self) -> Template:
+        return self.templates[bisect(self.cum, random.random() * self.cum[-1])]
+
+
+class Workload:
+    def __init__(self, spec: dict, requests: int = None, read_ratio: float = None, distribution=None):
+        self.name = spec.get("name", "workload")
+        self.requests = int(requests or spec.get("requests", 1000))
+        self.read_ratio = read_ratio if read_ratio is not None else spec.get("read_ratio")
+        if self.read_ratio is not None:
+            try:
+                ok = 0.0 <= float(self.read_ratio) <= 1.0
+            except (TypeError, ValueError):
+                ok = False
+            if not ok:
+                raise ValueError(f"read_ratio must be between 0 and 1, got {self.read_ratio!r}")
+            self.read_ratio = float(self.read_ratio)
+        self.distribution = distribution or spec.get("distribution", "uniform")
+        keys = {**SAKILA_KEYS, **spec.get("keys", {})}
+        # Checked here even if no template draws from it, so a bad spec fails at load time
+        make_distribution(self.distribution, 1, 1)
+        seq = count(random.randrange(1, SEQ_SPAN))  # next() on it is atomic: shared by the benchmark's worker threads
+        self.templates = [Template(t, keys, self.distribution, seq) for t in spec["templates"]]
+        if not self.templates:
+            raise ValueError("A workload needs at least one template")
+
+        reads = [t for t in self.templates if t.kind == "read"]
+        writes = [t for t in self.templates if t.kind == "write"]
+        if self.read_ratio is None or not reads or not writes:
+            self._all = _Picker(self.templates)
+        else:
+            self._all = None
+            self._reads, self._writes = _Picker(reads), _Picker(writes)
+
+    def pick(self) -> Template:
+        if self._all is not None:
+            return self._all()
+        return self._reads() if random.random() < self.read_ratio else self._writes()
+
+    def describe(self) -> dict:
+        """The workload as recorded in a result file's config."""
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "read_ratio": self.read_ratio,
+            "distribution": self.distribution,
+            "templates": {t.name: {"kind": t.kind, "weight": t.weight} for t in self.templates},
+        }
+
+
+def load(path: str, **overrides) -> Workload:
+    """Workload from a JSON file; requests, read_ratio and distribution override the file's."""
+    with open(path, "r", encoding="utf-8") as fh:
+        return Workload(json.load(fh), **overrides)